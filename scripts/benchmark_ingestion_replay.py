@@ -0,0 +1,377 @@
+"""
+Benchmark the ingestion (slurm_state.mongo_update) by replaying a directory of
+recorded sacct and sinfo reports against a throwaway database.
+
+The reports are replayed in the order of their names, one per tick, through
+main_read_report_and_update_collection, as done by read_report_commit_to_db.py.
+The files whose names contain "sacct" are jobs reports, and those whose names
+contain "sinfo" are nodes reports. They can be real reports or reports produced
+by slurm_state/anonymize_report.py, as long as their names sort chronologically
+(sacct_0001, sinfo_0001, sacct_0002, ...).
+
+For each tick, the following is recorded:
+    latency         Duration of the call, in seconds
+    stages          Duration of each stage of the run (see slurm_state.ingest_metrics)
+    writes          Numbers of documents inserted, upserted and modified
+    documents       Number of documents of the collection after the tick
+    size_bytes      Size of the collection after the tick (collStats), if available
+
+The results can be compared with a baseline, produced by a previous run of this
+script with --output: the script then exits with status 1 if the mean latency of
+an entity grew by more than --tolerance, or if the writes or the final number of
+documents changed. This way, a regression in mongo_update.py is seen before it is
+deployed.
+
+The database is either the one of --mongodb_connection_string, or a mongod started
+for the benchmark (--mongod) on a temporary directory, which is removed afterwards.
+In both cases, the database --database_name is dropped before and after the replay.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from slurm_state.config import get_config
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.mongo_update import main_read_report_and_update_collection
+
+# Counters of the run reports summed as the writes of a tick
+WRITE_COUNTERS = ["nInserted", "nUpserted", "nModified"]
+
+# Number of seconds to wait for a mongod started for the benchmark
+MONGOD_STARTUP_TIMEOUT = 30
+
+
+def list_replay_ticks(reports_dir):
+    """
+    Return the (entity, report path) of the reports of the directory,
+    in the order in which they are replayed.
+    """
+    L_ticks = []
+    for file_name in sorted(os.listdir(reports_dir)):
+        if "sacct" in file_name:
+            L_ticks.append(("jobs", os.path.join(reports_dir, file_name)))
+        elif "sinfo" in file_name:
+            L_ticks.append(("nodes", os.path.join(reports_dir, file_name)))
+        else:
+            print(f"Skip {file_name}, which is neither a sacct nor a sinfo report.")
+    return L_ticks
+
+
+def start_throwaway_mongod(mongod_binary, db_path):
+    """
+    Start a mongod storing its data in db_path, on a free port.
+
+    Returns:
+        A tuple (mongod process, connection string)
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            mongod_binary,
+            "--dbpath",
+            db_path,
+            "--port",
+            str(port),
+            "--bind_ip",
+            "127.0.0.1",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    connection_string = f"mongodb://127.0.0.1:{port}/"
+    deadline = time.time() + MONGOD_STARTUP_TIMEOUT
+    # Each ping waits at most one second for the server to be available
+    client = MongoClient(connection_string, serverSelectionTimeoutMS=1000)
+    try:
+        while True:
+            try:
+                client.admin.command("ping")
+                return process, connection_string
+            except PyMongoError:
+                if process.poll() is not None or time.time() > deadline:
+                    process.kill()
+                    raise RuntimeError(f"Failed to start {mongod_binary}.")
+    finally:
+        client.close()
+
+
+def get_collection_size(database, collection_name):
+    """
+    Return the size in bytes of the documents of a collection, or None
+    if the server does not provide it.
+    """
+    try:
+        return database.command({"collStats": collection_name})["size"]
+    except (OperationFailure, NotImplementedError):
+        return None
+
+
+def read_last_run_report(run_report_file):
+    with open(run_report_file, "r") as f:
+        L_lines = f.readlines()
+    return json.loads(L_lines[-1])
+
+
+def replay_reports(database, cluster_name, L_ticks, run_report_file):
+    """
+    Replay the reports through main_read_report_and_update_collection.
+
+    Returns:
+        The list of the records of the ticks
+    """
+    D_collections = {"jobs": database["jobs"], "nodes": database["nodes"]}
+    # The same indexes as read_report_commit_to_db.py
+    D_collections["jobs"].create_index(
+        [("slurm.job_id", 1), ("slurm.cluster_name", 1)],
+        name="job_id_and_cluster_name",
+    )
+    D_collections["nodes"].create_index(
+        [("slurm.name", 1), ("slurm.cluster_name", 1)],
+        name="name_and_cluster_name",
+    )
+
+    LD_ticks = []
+    print(
+        f"{'tick':>5} {'entity':>6} {'seconds':>9} {'writes':>8} {'documents':>10} {'bytes':>12}  report"
+    )
+    for tick, (entity, report_path) in enumerate(L_ticks):
+        collection = D_collections[entity]
+        timestamp_start = time.perf_counter()
+        if not main_read_report_and_update_collection(
+            entity,
+            collection,
+            database["users"],
+            cluster_name,
+            report_path,
+            from_file=True,
+            want_commit_to_db=True,
+        ):
+            # The timings of a partially written report are not comparable
+            raise RuntimeError(
+                f"Tick {tick}: the {entity} report {report_path} could not be fully written to the database."
+            )
+        latency = time.perf_counter() - timestamp_start
+
+        D_run = read_last_run_report(run_report_file)
+        D_writes = {
+            counter: D_run["counts"].get(counter, 0) for counter in WRITE_COUNTERS
+        }
+        D_tick = {
+            "tick": tick,
+            "report": os.path.basename(report_path),
+            "entity": entity,
+            "latency": latency,
+            "stages": D_run["stages"],
+            "writes": D_writes,
+            "documents": collection.count_documents({}),
+            "size_bytes": get_collection_size(database, collection.name),
+        }
+        LD_ticks.append(D_tick)
+        print(
+            f"{tick:>5} {entity:>6} {latency:>9.3f} {sum(D_writes.values()):>8} "
+            f"{D_tick['documents']:>10} {str(D_tick['size_bytes']):>12}  {D_tick['report']}"
+        )
+    return LD_ticks
+
+
+def summarize_ticks(LD_ticks):
+    """
+    Return, for each entity, the latencies, writes and final size of its ticks.
+    """
+    DD_summary = {}
+    for entity in ["jobs", "nodes"]:
+        LD_entity_ticks = [D_tick for D_tick in LD_ticks if D_tick["entity"] == entity]
+        if not LD_entity_ticks:
+            continue
+        L_latencies = sorted(D_tick["latency"] for D_tick in LD_entity_ticks)
+        DD_summary[entity] = {
+            "nbr_ticks": len(LD_entity_ticks),
+            "total_latency": sum(L_latencies),
+            "mean_latency": sum(L_latencies) / len(L_latencies),
+            "median_latency": L_latencies[len(L_latencies) // 2],
+            "max_latency": L_latencies[-1],
+            "writes": {
+                counter: sum(D_tick["writes"][counter] for D_tick in LD_entity_ticks)
+                for counter in WRITE_COUNTERS
+            },
+            "final_documents": LD_entity_ticks[-1]["documents"],
+            "final_size_bytes": LD_entity_ticks[-1]["size_bytes"],
+        }
+    return DD_summary
+
+
+def compare_with_baseline(DD_summary, DD_baseline_summary, tolerance):
+    """
+    Compare the summary of the replay with the one of a baseline.
+
+    Returns:
+        The list of the regressions found, as messages
+    """
+    L_regressions = []
+    for entity, D_baseline in DD_baseline_summary.items():
+        if entity not in DD_summary:
+            L_regressions.append(f"{entity}: no tick replayed.")
+            continue
+        D_summary = DD_summary[entity]
+        ratio = D_summary["mean_latency"] / max(D_baseline["mean_latency"], 1e-9)
+        print(
+            f"{entity}: mean latency {D_summary['mean_latency']:.3f}s "
+            f"(baseline {D_baseline['mean_latency']:.3f}s, x{ratio:.2f})."
+        )
+        if ratio > 1 + tolerance:
+            L_regressions.append(
+                f"{entity}: the mean latency grew by {100 * (ratio - 1):.0f}%."
+            )
+        # The same reports must produce the same writes
+        for key in ["writes", "final_documents"]:
+            if D_summary[key] != D_baseline[key]:
+                L_regressions.append(
+                    f"{entity}: {key} is {D_summary[key]} instead of {D_baseline[key]}."
+                )
+    return L_regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Replay recorded sacct and sinfo reports through the ingestion, and measure it.",
+    )
+    parser.add_argument(
+        "--reports_dir",
+        required=True,
+        help="Directory of the reports, replayed in the order of their names.",
+    )
+    parser.add_argument(
+        "--cluster_name",
+        required=True,
+        help="Name of the (configured) cluster which produced the reports.",
+    )
+    parser.add_argument(
+        "--mongod",
+        default=None,
+        help="Path of a mongod binary, started for the benchmark on a temporary directory.",
+    )
+    parser.add_argument(
+        "--mongodb_connection_string",
+        default=None,
+        help="Connection string of the database to use when --mongod is not given. Default is the configured database.",
+    )
+    parser.add_argument(
+        "--database_name",
+        default="clockwork_replay_benchmark",
+        help="Name of the throwaway database. It is dropped before and after the replay.",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Optional JSON file written by a previous run with --output, to compare with.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative growth of the mean latency above which it is a regression. Default is 0.2.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Optional JSON file in which the results are written.",
+    )
+    args = parser.parse_args(argv[1:])
+
+    L_ticks = list_replay_ticks(args.reports_dir)
+    assert L_ticks, f"No sacct or sinfo report found in {args.reports_dir}."
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        mongod_process = None
+        if args.mongod is not None:
+            db_path = os.path.join(work_dir, "db")
+            os.makedirs(db_path)
+            mongod_process, connection_string = start_throwaway_mongod(
+                args.mongod, db_path
+            )
+            client = MongoClient(connection_string)
+        elif args.mongodb_connection_string is not None:
+            client = MongoClient(args.mongodb_connection_string)
+        else:
+            client = get_mongo_client()
+            # Do not drop the database of the deployment
+            assert args.database_name != get_config(
+                "mongo.database_name"
+            ), "The benchmark database must not be the configured one."
+
+        # The metrics of each tick are read from the run reports
+        run_report_file = os.path.join(work_dir, "ingest_runs.jsonl")
+        get_config("ingest_metrics")["run_report_file"] = run_report_file
+        # Neither replay nor fill the spool of the deployment, and do not
+        # overwrite its Prometheus metrics
+        get_config("spool")["directory"] = ""
+        get_config("ingest_metrics")["prometheus_textfile_dir"] = ""
+
+        client.drop_database(args.database_name)
+        try:
+            LD_ticks = replay_reports(
+                client[args.database_name], args.cluster_name, L_ticks, run_report_file
+            )
+        finally:
+            client.drop_database(args.database_name)
+            if mongod_process is not None:
+                mongod_process.terminate()
+                mongod_process.wait()
+
+    DD_summary = summarize_ticks(LD_ticks)
+    for entity, D_summary in DD_summary.items():
+        print(
+            f"{entity}: {D_summary['nbr_ticks']} ticks, mean latency {D_summary['mean_latency']:.3f}s, "
+            f"max {D_summary['max_latency']:.3f}s, writes {D_summary['writes']}."
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "cluster_name": args.cluster_name,
+                    "reports": [os.path.basename(path) for _, path in L_ticks],
+                    "summary": DD_summary,
+                    "ticks": LD_ticks,
+                },
+                f,
+                indent=4,
+            )
+        print(f"Wrote {args.output}.")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            D_baseline = json.load(f)
+        L_regressions = compare_with_baseline(
+            DD_summary, D_baseline["summary"], args.tolerance
+        )
+        for regression in L_regressions:
+            print(f"Regression. {regression}")
+        if L_regressions:
+            sys.exit(1)
+        print("No regression compared with the baseline.")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+"""
+python3 scripts/benchmark_ingestion_replay.py \
+    --reports_dir ${HOME}/recorded_reports/mila --cluster_name mila \
+    --mongod /usr/bin/mongod --output replay.json
+
+python3 scripts/benchmark_ingestion_replay.py \
+    --reports_dir ${HOME}/recorded_reports/mila --cluster_name mila \
+    --mongod /usr/bin/mongod --baseline replay.json
+"""
@@ -0,0 +1,187 @@
+"""
+Benchmark the JSON backends (see slurm_state.helpers.json_codec) on the
+processing of sacct reports: parse -> translate -> dump.
+
+Reports of the requested sizes are built by replicating the jobs of a
+recorded sacct report, with new job IDs. Then, for each size and each
+backend, the following stages are timed:
+    load        Decode the whole report with the backend
+    translate   Translate the jobs to the Clockwork format (JOB_FIELD_MAP)
+    dump        Write the Clockwork jobs to an indented dump file, as done
+                by read_report_commit_to_db.py with --cw_jobs_file
+
+The streaming parser used for the ingestion (job_parser), which decodes and
+translates the jobs one at a time, is also timed for each size. It does not
+depend on the backend.
+
+Note that loading a report of 1M jobs at once takes several GB of memory.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from slurm_state.helpers.json_codec import get_available_json_backends, get_json_codec
+from slurm_state.mongo_update import slurm_job_to_clockwork_job
+from slurm_state.sacct_parser import job_parser, translate_job
+
+
+def build_report(L_template_jobs, nbr_jobs, report_path):
+    """
+    Write a sacct report containing nbr_jobs jobs, copied from the template jobs.
+    The jobs are written one at a time, so that large reports can be built.
+    """
+    with open(report_path, "w") as f:
+        f.write('{"meta": {}, "errors": [], "jobs": [\n')
+        for job_index in range(nbr_jobs):
+            D_job = L_template_jobs[job_index % len(L_template_jobs)]
+            # Only change the IDs: the other fields share the template values
+            D_job = dict(D_job, job_id=1000000 + job_index)
+            if job_index:
+                f.write(",\n")
+            f.write(json.dumps(D_job))
+        f.write("\n]}\n")
+
+
+def timed(function, *args):
+    """
+    Return the result of function(*args) and the number of seconds it took.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_stream_parser(report_path):
+    def parse():
+        with open(report_path, "rb") as f:
+            return sum(1 for _ in job_parser(f))
+
+    return timed(parse)
+
+
+def benchmark_backend(backend, report_path, dump_path):
+    """
+    Time the load, translate and dump stages with a backend.
+
+    Returns:
+        A dictionary associating its duration to each stage
+    """
+    codec = get_json_codec(backend)
+
+    def load():
+        with open(report_path, "rb") as f:
+            return codec.load(f)
+
+    def translate(D_report):
+        return [
+            slurm_job_to_clockwork_job(translate_job(D_job))
+            for D_job in D_report["jobs"]
+        ]
+
+    def dump(LD_jobs):
+        with open(dump_path, "wb") as f:
+            codec.dump(LD_jobs, f, indent=True)
+
+    D_report, load_duration = timed(load)
+    LD_jobs, translate_duration = timed(translate, D_report)
+    del D_report
+    _, dump_duration = timed(dump, LD_jobs)
+    os.remove(dump_path)
+
+    return {
+        "load": load_duration,
+        "translate": translate_duration,
+        "dump": dump_duration,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Benchmark the JSON backends on the parsing, translation and dump of sacct reports.",
+    )
+    parser.add_argument(
+        "--report",
+        default="slurm_state_test/files/sacct_1",
+        help="Recorded sacct report whose jobs are replicated.",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=[10000, 100000, 1000000],
+        help="Numbers of jobs of the benchmarked reports.",
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="*",
+        default=get_available_json_backends(),
+        help="JSON backends to benchmark. Default is all the installed ones.",
+    )
+    parser.add_argument(
+        "--work_dir",
+        default=None,
+        help="Directory in which the reports are built. Default is a temporary directory.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Optional JSON file in which the results are written.",
+    )
+    args = parser.parse_args(argv[1:])
+
+    with open(args.report, "r") as f:
+        L_template_jobs = json.load(f)["jobs"]
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        LD_results = []
+        print(f"{'jobs':>10} {'backend':>10} {'stage':>10} {'seconds':>10}")
+        for nbr_jobs in args.sizes:
+            report_path = os.path.join(work_dir, f"sacct_{nbr_jobs}.json")
+            build_report(L_template_jobs, nbr_jobs, report_path)
+
+            nbr_parsed, duration = benchmark_stream_parser(report_path)
+            assert nbr_parsed == nbr_jobs
+            LD_results.append(
+                {
+                    "nbr_jobs": nbr_jobs,
+                    "backend": "stream",
+                    "stage": "parse",
+                    "seconds": duration,
+                }
+            )
+            print(f"{nbr_jobs:>10} {'stream':>10} {'parse':>10} {duration:>10.3f}")
+
+            for backend in args.backends:
+                D_durations = benchmark_backend(
+                    backend, report_path, os.path.join(work_dir, "dump.json")
+                )
+                for stage, duration in D_durations.items():
+                    LD_results.append(
+                        {
+                            "nbr_jobs": nbr_jobs,
+                            "backend": backend,
+                            "stage": stage,
+                            "seconds": duration,
+                        }
+                    )
+                    print(f"{nbr_jobs:>10} {backend:>10} {stage:>10} {duration:>10.3f}")
+
+            os.remove(report_path)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(LD_results, f, indent=4)
+        print(f"Wrote {args.output}.")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+"""
+python3 scripts/benchmark_report_parsing.py --sizes 10000 100000 1000000
+"""
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark of the translation of the jobs and nodes of the reports
+(see JOB_FIELD_MAP and NODE_FIELD_MAP), in entities per second.
+
+The entities of recorded reports are decoded once, then translated
+repeatedly with:
+    loop        translate_with_field_map, which loops over all the fields
+                of each entity and looks up their translator in the map
+    compiled    the functions built by compile_field_map (translate_job
+                and translate_node), which are used by the parsers
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from slurm_state.helpers.parser_helper import translate_with_field_map
+from slurm_state.sacct_parser import JOB_FIELD_MAP, translate_job
+from slurm_state.sinfo_parser import NODE_FIELD_MAP, translate_node
+
+
+def get_entities_per_second(translate, L_entities, nbr_entities):
+    """
+    Translate nbr_entities entities, picked from L_entities, and return the
+    number of entities translated per second.
+    """
+    nbr_repetitions = max(1, nbr_entities // len(L_entities))
+    start = time.perf_counter()
+    for _ in range(nbr_repetitions):
+        for D_entity in L_entities:
+            translate(D_entity)
+    return nbr_repetitions * len(L_entities) / (time.perf_counter() - start)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Benchmark the translation of the jobs and nodes of the Slurm reports.",
+    )
+    parser.add_argument(
+        "--sacct_report",
+        default="slurm_state_test/files/sacct_1",
+        help="Recorded sacct report.",
+    )
+    parser.add_argument(
+        "--sinfo_report",
+        default="slurm_state_test/files/sinfo_1",
+        help="Recorded sinfo report.",
+    )
+    parser.add_argument(
+        "--nbr_entities",
+        type=int,
+        default=200000,
+        help="Number of jobs and nodes translated by each method.",
+    )
+    args = parser.parse_args(argv[1:])
+
+    for entity, report_path, field_map, translate_compiled in [
+        ("jobs", args.sacct_report, JOB_FIELD_MAP, translate_job),
+        ("nodes", args.sinfo_report, NODE_FIELD_MAP, translate_node),
+    ]:
+        with open(report_path, "r") as f:
+            L_entities = json.load(f)[entity]
+
+        # Both methods must give the same translations
+        for D_entity in L_entities:
+            assert translate_compiled(D_entity) == translate_with_field_map(
+                D_entity, field_map
+            )
+
+        loop_speed = get_entities_per_second(
+            lambda D_entity: translate_with_field_map(D_entity, field_map),
+            L_entities,
+            args.nbr_entities,
+        )
+        compiled_speed = get_entities_per_second(
+            translate_compiled, L_entities, args.nbr_entities
+        )
+        print(
+            f"{entity}: loop {loop_speed:.0f}/s, compiled {compiled_speed:.0f}/s "
+            f"(x{compiled_speed / loop_speed:.2f})"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+"""
+python3 scripts/benchmark_translators.py
+"""
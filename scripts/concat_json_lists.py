@@ -13,6 +13,9 @@ import numpy as np
 import argparse
 import json
 
+# Reads the JSON lists as well as the JSON Lines dump files (compressed or not)
+from slurm_state.helpers.dump_file import load_dump_file
+
 
 def main(argv):
 
@@ -26,9 +29,7 @@ def main(argv):
 
     L = []
     for input_path in args.inputs:
-        with open(input_path, "r") as f:
-            E = json.load(f)
-            L.extend(E)
+        L.extend(load_dump_file(input_path))
 
     if args.keep is not None:
         assert 0 < args.keep
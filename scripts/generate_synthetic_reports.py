@@ -0,0 +1,517 @@
+"""
+Generate synthetic sacct and sinfo reports (in the JSON format of the Slurm
+commands, as read by slurm_state.sacct_parser and slurm_state.sinfo_parser),
+at any scale, in order to load test the ingestion and the web server.
+
+Unlike anonymize_report.py, which reshapes recorded reports, the jobs and the
+nodes are drawn from the following distributions:
+    submission      Poisson arrivals over the --duration_days days before --end
+    users           Zipf-like: a few users submit most of the jobs
+    arrays          A fraction of the submissions are job arrays of several tasks,
+                    sharing the same submission time
+    wait time       Log-normal (median of a few minutes)
+    run time        Log-normal (median of half an hour). The jobs running longer
+                    than their time limit end as TIMEOUT
+    final state     Mostly COMPLETED, then FAILED, CANCELLED (before or after the
+                    start of the job), OUT_OF_MEMORY and NODE_FAIL
+    nodes state     Mostly mixed, allocated or idle, some drained or down
+The state of a job in a report follows its timeline: PENDING before its start,
+RUNNING before its end, and its final state afterwards.
+
+The users follow the conventions of produce_fake_users.py (milauser<n> on the mila
+cluster, ccuser<n> with the fake allocations on the other ones), so that the jobs
+can be associated to the users of the fake data.
+
+The reports are written in <output_dir>/<cluster_name>/. With --nbr_ticks 1 (default),
+a single "sacct" and "sinfo" report describe the state at --end. Otherwise, the
+reports <tick>_sacct and <tick>_sinfo describe the successive ticks, --tick_interval
+seconds apart and ending at --end: the first sacct report contains all the jobs
+submitted before its tick, and the next ones the jobs active since the previous
+tick, as an incremental sacct call would. They can be replayed with
+benchmark_ingestion_replay.py.
+
+The jobs are generated again for each tick, and written one at a time: the memory
+does not depend on the number of jobs. The same --seed and --end always produce
+the same reports.
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+
+# Accounts of the fake users on the clusters other than mila (see produce_fake_users.py)
+FAKE_CC_ACCOUNTS = [
+    "def-patate-rrg",
+    "def-pomme-rrg",
+    "def-cerise-rrg",
+    "def-citron-rrg",
+]
+
+# Final states of the jobs which do not exceed their time limit, and their weights
+JOB_FINAL_STATES = {
+    "COMPLETED": 0.70,
+    "FAILED": 0.15,
+    "CANCELLED": 0.10,
+    "OUT_OF_MEMORY": 0.03,
+    "NODE_FAIL": 0.02,
+}
+# Fraction of the cancelled jobs which are cancelled before they start
+CANCELLED_BEFORE_START_FRACTION = 0.3
+
+# Time limits of the jobs, in minutes, and their weights
+JOB_TIME_LIMITS = {60: 0.2, 180: 0.25, 720: 0.2, 1440: 0.2, 2880: 0.1, 10080: 0.05}
+# Log-normal distributions (median in seconds, sigma) of the wait and run times
+JOB_WAIT_TIME = (180, 1.5)
+JOB_RUN_TIME = (1800, 1.7)
+
+# Resources requested by the jobs, and their weights
+JOB_CPUS = {1: 0.2, 2: 0.2, 4: 0.3, 8: 0.2, 16: 0.1}
+JOB_GPUS = {0: 0.35, 1: 0.45, 2: 0.1, 4: 0.1}
+JOB_MEMORY_PER_CPU = 8192
+
+JOB_PARTITIONS = ["long", "main", "short-unkillable", "unkillable"]
+
+# GPU models of the nodes: (name in the gres, architecture, memory in GB)
+NODE_GPU_MODELS = [
+    ("a100", "ampere", 80),
+    ("v100", "volta", 32),
+    ("rtx8000", "turing", 48),
+]
+# Fraction of the nodes with GPUs
+NODE_GPU_FRACTION = 0.8
+# States of the nodes in a report, and their weights
+NODE_STATES = {
+    "mixed": 0.40,
+    "allocated": 0.25,
+    "idle": 0.25,
+    "drained": 0.05,
+    "down": 0.03,
+    "reserved": 0.02,
+}
+
+# The "meta" part of the reports, as produced by Slurm 21.08
+SACCT_META = {
+    "plugin": {"type": "openapi/dbv0.0.37", "name": "Slurm OpenAPI DB v0.0.37"},
+    "Slurm": {"version": {"major": 21, "micro": 8, "minor": 8}, "release": "21.08.8-2"},
+}
+SINFO_META = {
+    "plugin": {"type": "openapi/v0.0.37", "name": "Slurm OpenAPI v0.0.37"},
+    "Slurm": {"version": {"major": 21, "micro": 8, "minor": 8}, "release": "21.08.8-2"},
+}
+
+# First job ID of each cluster
+FIRST_JOB_ID = 1000000
+
+
+def get_cumulative_weights(D_weights):
+    return list(D_weights.keys()), list(itertools.accumulate(D_weights.values()))
+
+
+def choose(rng, L_values, L_cum_weights):
+    """
+    Faster equivalent of rng.choices(L_values, cum_weights=L_cum_weights)[0].
+    """
+    return L_values[bisect.bisect(L_cum_weights, rng.random() * L_cum_weights[-1])]
+
+
+def lognormal(rng, median, sigma):
+    return int(rng.lognormvariate(math.log(median), sigma))
+
+
+def get_user(cluster_name, user_index):
+    """
+    Return the username and the account of a fake user on a cluster,
+    following the conventions of produce_fake_users.py.
+    """
+    if cluster_name == "mila":
+        return "milauser%0.2d" % user_index, "mila"
+    return "ccuser%0.2d" % user_index, FAKE_CC_ACCOUNTS[user_index % 2]
+
+
+def get_node_name(cluster_name, node_index):
+    return f"{cluster_name[:2]}-n{node_index:05d}"
+
+
+def generate_job_timelines(cluster_name, args):
+    """
+    Generate the jobs of a cluster submitted until --end, in the order of their
+    submission, with their whole timeline (submission, start and end, None if
+    they do not happen) and their final state. The rate of the submissions is
+    such that the expected number of jobs is --nbr_jobs.
+    """
+    rng = random.Random(f"{args.seed}:jobs:{cluster_name}")
+    L_states, L_states_cum_weights = get_cumulative_weights(JOB_FINAL_STATES)
+    L_limits, L_limits_cum_weights = get_cumulative_weights(JOB_TIME_LIMITS)
+    L_cpus, L_cpus_cum_weights = get_cumulative_weights(JOB_CPUS)
+    L_gpus, L_gpus_cum_weights = get_cumulative_weights(JOB_GPUS)
+    # Zipf-like distribution of the users
+    L_users_cum_weights = list(
+        itertools.accumulate(1 / (rank + 1) for rank in range(args.nbr_users))
+    )
+    L_users = list(range(args.nbr_users))
+
+    duration = args.duration_days * 86400
+    # Mean number of seconds between two submissions (of a job or a job array)
+    mean_array_size = 1 + args.array_job_fraction * args.max_array_size / 2
+    mean_interval = duration / max(1, args.nbr_jobs / mean_array_size)
+
+    submit_time = args.end - duration
+    job_id = FIRST_JOB_ID
+    while True:
+        submit_time += rng.expovariate(1 / mean_interval)
+        if submit_time > args.end:
+            return
+
+        # Shared by the tasks of an array
+        username, account = get_user(
+            cluster_name, choose(rng, L_users, L_users_cum_weights)
+        )
+        time_limit = choose(rng, L_limits, L_limits_cum_weights)
+        nbr_cpus = choose(rng, L_cpus, L_cpus_cum_weights)
+        nbr_gpus = choose(rng, L_gpus, L_gpus_cum_weights)
+        partition = JOB_PARTITIONS[rng.randrange(len(JOB_PARTITIONS))]
+        if rng.random() < args.array_job_fraction:
+            array_size = rng.randint(2, args.max_array_size)
+            array_job_id = job_id
+        else:
+            array_size = 1
+            array_job_id = 0
+
+        for task_id in range(array_size):
+            state = choose(rng, L_states, L_states_cum_weights)
+            start_time = int(submit_time) + lognormal(rng, *JOB_WAIT_TIME)
+            run_time = lognormal(rng, *JOB_RUN_TIME)
+            if state == "CANCELLED" and rng.random() < CANCELLED_BEFORE_START_FRACTION:
+                end_time = start_time
+                start_time = None
+            elif run_time > time_limit * 60:
+                state = "TIMEOUT"
+                end_time = start_time + time_limit * 60
+            else:
+                end_time = start_time + run_time
+
+            yield {
+                "job_id": job_id,
+                "array_job_id": array_job_id,
+                "array_task_id": task_id if array_job_id else None,
+                "name": f"job_{job_id - task_id if array_job_id else job_id}",
+                "username": username,
+                "account": account,
+                "partition": partition,
+                "time_limit": time_limit,
+                "nbr_cpus": nbr_cpus,
+                "nbr_gpus": nbr_gpus,
+                "node": get_node_name(cluster_name, rng.randrange(args.nbr_nodes)),
+                "submit_time": int(submit_time),
+                "start_time": start_time,
+                "end_time": end_time,
+                "final_state": state,
+            }
+            job_id += 1
+
+
+def get_sacct_job(cluster_name, D_timeline, now):
+    """
+    Return a job as reported by sacct at the time now.
+    """
+    start_time = D_timeline["start_time"]
+    end_time = D_timeline["end_time"]
+    if end_time <= now:
+        state = D_timeline["final_state"]
+    elif start_time is not None and start_time <= now:
+        state = "RUNNING"
+        end_time = None
+    else:
+        state = "PENDING"
+        start_time = None
+        end_time = None
+    if start_time is None:
+        # A job cancelled before its start has an end, but no start
+        node = "None assigned"
+    else:
+        node = D_timeline["node"]
+
+    if state in ["COMPLETED", "RUNNING", "PENDING"]:
+        exit_code = {"status": "SUCCESS", "return_code": 0}
+    elif state == "CANCELLED":
+        exit_code = {"status": "SIGNALED", "return_code": 0}
+    else:
+        exit_code = {"status": "FAILED", "return_code": 1}
+
+    L_tres = [
+        {"type": "cpu", "name": None, "id": 1, "count": D_timeline["nbr_cpus"]},
+        {
+            "type": "mem",
+            "name": None,
+            "id": 2,
+            "count": D_timeline["nbr_cpus"] * JOB_MEMORY_PER_CPU,
+        },
+        {"type": "node", "name": None, "id": 4, "count": 1},
+        {"type": "billing", "name": None, "id": 5, "count": D_timeline["nbr_cpus"]},
+    ]
+    if D_timeline["nbr_gpus"]:
+        L_tres.append(
+            {"type": "gres", "name": "gpu", "id": 1001, "count": D_timeline["nbr_gpus"]}
+        )
+
+    return {
+        "account": D_timeline["account"],
+        "array": {
+            "job_id": D_timeline["array_job_id"],
+            "limits": {"max": {"running": {"tasks": 0}}},
+            "task": None,
+            "task_id": D_timeline["array_task_id"],
+        },
+        "cluster": cluster_name,
+        "exit_code": exit_code,
+        "job_id": D_timeline["job_id"],
+        "name": D_timeline["name"],
+        "nodes": node,
+        "partition": D_timeline["partition"],
+        "state": {"current": state, "reason": "None"},
+        "time": {
+            "elapsed": (0 if start_time is None else (end_time or now) - start_time),
+            "eligible": D_timeline["submit_time"],
+            "end": end_time or 0,
+            "start": start_time or 0,
+            "submission": D_timeline["submit_time"],
+            "limit": D_timeline["time_limit"],
+        },
+        "tres": {
+            "allocated": L_tres if start_time is not None else [],
+            "requested": L_tres,
+        },
+        "user": D_timeline["username"],
+        "working_directory": f"/home/{D_timeline['username']}",
+    }
+
+
+def get_sinfo_node(cluster_name, node_index, rng, now):
+    """
+    Return a node as reported by sinfo. Its hardware only depends on its
+    index, while its state is drawn with rng.
+    """
+    name = get_node_name(cluster_name, node_index)
+    # The hardware of a node does not change between the ticks
+    node_rng = random.Random(f"{cluster_name}:{node_index}")
+    nbr_cpus = node_rng.choice([32, 48, 64, 128])
+    memory = nbr_cpus * JOB_MEMORY_PER_CPU
+    if node_rng.random() < NODE_GPU_FRACTION:
+        gpu_name, architecture, gpu_memory = node_rng.choice(NODE_GPU_MODELS)
+        nbr_gpus = node_rng.choice([4, 8])
+        gres = f"gpu:{gpu_name}:{nbr_gpus}(S:0-1)"
+        features = f"x86_64,{architecture},{gpu_memory}gb"
+    else:
+        gpu_name = None
+        nbr_gpus = 0
+        gres = ""
+        features = "x86_64"
+
+    state = choose(rng, *get_cumulative_weights(NODE_STATES))
+    if state == "idle":
+        alloc_cpus = 0
+    elif state == "allocated":
+        alloc_cpus = nbr_cpus
+    elif state == "mixed":
+        alloc_cpus = rng.randrange(1, nbr_cpus)
+    else:
+        alloc_cpus = 0
+    nbr_used_gpus = round(nbr_gpus * alloc_cpus / nbr_cpus)
+
+    return {
+        "architecture": "x86_64",
+        "boards": 1,
+        "boot_time": int(now) - 86400 * node_rng.randint(1, 100),
+        "comment": "",
+        "cores": nbr_cpus // 2,
+        "cpus": nbr_cpus,
+        "last_busy": int(now),
+        "features": features,
+        "active_features": features,
+        "gres": gres,
+        "gres_drained": "N/A",
+        "gres_used": f"gpu:{gpu_name}:{nbr_used_gpus}(IDX:N/A)" if nbr_gpus else "",
+        "name": name,
+        "address": name,
+        "hostname": name,
+        "state": state,
+        "state_flags": ["DRAIN"] if state == "drained" else [],
+        "operating_system": "Linux",
+        "partitions": JOB_PARTITIONS,
+        "real_memory": memory,
+        "reason": "Synthetic maintenance" if state in ["drained", "down"] else "",
+        "sockets": 2,
+        "threads": 1,
+        "tres": f"cpu={nbr_cpus},mem={memory}M,billing={nbr_cpus}"
+        + (f",gres/gpu={nbr_gpus}" if nbr_gpus else ""),
+        "alloc_memory": alloc_cpus * JOB_MEMORY_PER_CPU,
+        "alloc_cpus": alloc_cpus,
+        "idle_cpus": nbr_cpus - alloc_cpus,
+        "tres_used": f"cpu={alloc_cpus}" if alloc_cpus else None,
+    }
+
+
+def write_report(report_path, meta, entity_key, I_entities):
+    """
+    Write a report, one entity at a time.
+
+    Returns:
+        The number of entities written
+    """
+    nbr_entities = 0
+    with open(report_path, "w") as f:
+        f.write(f'{{"meta": {json.dumps(meta)}, "errors": [], "{entity_key}": [\n')
+        for D_entity in I_entities:
+            if nbr_entities:
+                f.write(",\n")
+            f.write(json.dumps(D_entity))
+            nbr_entities += 1
+        f.write("\n]}\n")
+    return nbr_entities
+
+
+def get_tick_times(args):
+    return [
+        args.end - (args.nbr_ticks - 1 - tick) * args.tick_interval
+        for tick in range(args.nbr_ticks)
+    ]
+
+
+def generate_cluster_reports(cluster_name, args):
+    """
+    Write the sacct and sinfo reports of a cluster for all the ticks.
+    """
+    cluster_dir = os.path.join(args.output_dir, cluster_name)
+    os.makedirs(cluster_dir, exist_ok=True)
+
+    previous_tick_time = None
+    for tick, tick_time in enumerate(get_tick_times(args)):
+        prefix = "" if args.nbr_ticks == 1 else f"{tick:06d}_"
+
+        def get_jobs():
+            for D_timeline in generate_job_timelines(cluster_name, args):
+                if D_timeline["submit_time"] > tick_time:
+                    # The jobs are generated in the order of their submission
+                    return
+                # Only the jobs active since the previous tick
+                if (
+                    previous_tick_time is not None
+                    and D_timeline["end_time"] < previous_tick_time
+                ):
+                    continue
+                yield get_sacct_job(cluster_name, D_timeline, tick_time)
+
+        timestamp_start = time.time()
+        nbr_jobs = write_report(
+            os.path.join(cluster_dir, f"{prefix}sacct"), SACCT_META, "jobs", get_jobs()
+        )
+
+        rng = random.Random(f"{args.seed}:nodes:{cluster_name}:{tick}")
+        nbr_nodes = write_report(
+            os.path.join(cluster_dir, f"{prefix}sinfo"),
+            SINFO_META,
+            "nodes",
+            (
+                get_sinfo_node(cluster_name, node_index, rng, tick_time)
+                for node_index in range(args.nbr_nodes)
+            ),
+        )
+        print(
+            f"{cluster_name}, tick {tick}: wrote {nbr_jobs} jobs and {nbr_nodes} nodes "
+            f"in {time.time() - timestamp_start:.1f} seconds."
+        )
+        previous_tick_time = tick_time
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Generate synthetic sacct and sinfo reports for load tests.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        required=True,
+        help="Directory in which the reports of each cluster are written.",
+    )
+    parser.add_argument(
+        "--clusters",
+        nargs="*",
+        default=["mila", "beluga", "cedar", "graham", "narval"],
+        help="Names of the clusters.",
+    )
+    parser.add_argument(
+        "--nbr_jobs",
+        type=int,
+        default=10000,
+        help="Expected number of jobs of each cluster, array tasks included.",
+    )
+    parser.add_argument(
+        "--nbr_nodes", type=int, default=100, help="Number of nodes of each cluster."
+    )
+    parser.add_argument(
+        "--nbr_users", type=int, default=100, help="Number of users submitting jobs."
+    )
+    parser.add_argument(
+        "--array_job_fraction",
+        type=float,
+        default=0.05,
+        help="Fraction of the submissions which are job arrays. Default is 0.05.",
+    )
+    parser.add_argument(
+        "--max_array_size",
+        type=int,
+        default=20,
+        help="Maximum number of tasks of a job array. Default is 20.",
+    )
+    parser.add_argument(
+        "--duration_days",
+        type=float,
+        default=7,
+        help="Number of days before --end during which the jobs are submitted. Default is 7.",
+    )
+    parser.add_argument(
+        "--end",
+        type=int,
+        default=None,
+        help="Timestamp of the last report. Default is now.",
+    )
+    parser.add_argument(
+        "--nbr_ticks",
+        type=int,
+        default=1,
+        help="Number of successive reports of each cluster. Default is 1.",
+    )
+    parser.add_argument(
+        "--tick_interval",
+        type=int,
+        default=600,
+        help="Number of seconds between two successive reports. Default is 600.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the random generators."
+    )
+    args = parser.parse_args(argv[1:])
+    if args.end is None:
+        args.end = int(time.time())
+    assert args.nbr_users > 0 and args.nbr_nodes > 0 and args.max_array_size >= 2
+
+    for cluster_name in args.clusters:
+        generate_cluster_reports(cluster_name, args)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+"""
+python3 scripts/generate_synthetic_reports.py --output_dir tmp/synthetic \
+    --nbr_jobs 10000000 --nbr_nodes 2000 --nbr_users 3000 --seed 1
+
+python3 scripts/generate_synthetic_reports.py --output_dir tmp/synthetic_ticks \
+    --clusters mila --nbr_jobs 100000 --nbr_ticks 12 --end 1700000000
+"""
@@ -0,0 +1,101 @@
+"""
+Tests that the synthetic reports have the format of the sacct and sinfo
+reports, that their jobs follow their timelines from one tick to the next,
+and that they only depend on the seed.
+"""
+
+import json
+import os
+
+from scripts import generate_synthetic_reports
+
+
+def generate(output_dir, *extra_args):
+    generate_synthetic_reports.main(
+        [
+            "generate_synthetic_reports.py",
+            "--output_dir",
+            str(output_dir),
+            "--clusters",
+            "mila",
+            "cedar",
+            "--nbr_jobs",
+            "2000",
+            "--nbr_nodes",
+            "10",
+            "--nbr_users",
+            "5",
+            "--end",
+            "1700000000",
+            *extra_args,
+        ]
+    )
+
+
+def load_report(path, entity_key):
+    with open(path, "r") as f:
+        return json.load(f)[entity_key]
+
+
+def test_generate_synthetic_reports(tmp_path):
+    generate(tmp_path / "a", "--seed", "1")
+    generate(tmp_path / "b", "--seed", "1")
+    generate(tmp_path / "c", "--seed", "2")
+
+    LD_jobs = load_report(tmp_path / "a" / "cedar" / "sacct", "jobs")
+    # The number of jobs is random, but close to the requested one
+    assert 1000 < len(LD_jobs) < 3000
+    assert len(set(D_job["job_id"] for D_job in LD_jobs)) == len(LD_jobs)
+    for D_job in LD_jobs:
+        assert D_job["cluster"] == "cedar"
+        assert D_job["user"].startswith("ccuser")
+        assert D_job["time"]["submission"] <= 1700000000
+        if D_job["state"]["current"] == "PENDING":
+            assert D_job["time"]["start"] == 0
+        if D_job["state"]["current"] == "RUNNING":
+            assert D_job["time"]["end"] == 0
+    assert all(
+        D_job["user"].startswith("milauser")
+        for D_job in load_report(tmp_path / "a" / "mila" / "sacct", "jobs")
+    )
+    assert len(load_report(tmp_path / "a" / "cedar" / "sinfo", "nodes")) == 10
+
+    # The reports only depend on the seed
+    for cluster_name in ["mila", "cedar"]:
+        for report_name in ["sacct", "sinfo"]:
+            with open(tmp_path / "a" / cluster_name / report_name, "rb") as f_a:
+                with open(tmp_path / "b" / cluster_name / report_name, "rb") as f_b:
+                    assert f_a.read() == f_b.read()
+    assert LD_jobs != load_report(tmp_path / "c" / "cedar" / "sacct", "jobs")
+
+
+def test_generate_synthetic_reports_ticks(tmp_path):
+    generate(tmp_path, "--nbr_ticks", "3", "--tick_interval", "3600")
+    assert sorted(os.listdir(tmp_path / "mila")) == [
+        "000000_sacct",
+        "000000_sinfo",
+        "000001_sacct",
+        "000001_sinfo",
+        "000002_sacct",
+        "000002_sinfo",
+    ]
+
+    LD_first_jobs = load_report(tmp_path / "mila" / "000000_sacct", "jobs")
+    LD_last_jobs = load_report(tmp_path / "mila" / "000002_sacct", "jobs")
+    # The next ticks only contain the jobs active since the previous one
+    assert len(LD_last_jobs) < len(LD_first_jobs)
+    assert all(
+        D_job["time"]["submission"] <= 1700000000 - 7200 for D_job in LD_first_jobs
+    )
+    assert all(
+        D_job["time"]["end"] == 0 or D_job["time"]["end"] >= 1700000000 - 3600
+        for D_job in LD_last_jobs
+    )
+
+    # A job running at the first tick has the same timeline at the last one
+    D_first_jobs = {D_job["job_id"]: D_job for D_job in LD_first_jobs}
+    for D_job in LD_last_jobs:
+        if D_job["job_id"] in D_first_jobs:
+            D_first_job = D_first_jobs[D_job["job_id"]]
+            assert D_first_job["state"]["current"] in ["PENDING", "RUNNING"]
+            assert D_first_job["time"]["submission"] == D_job["time"]["submission"]
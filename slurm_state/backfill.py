@@ -0,0 +1,520 @@
+"""
+Load the history of the jobs in the database, for instance to rebuild the jobs
+collection after a change of schema, or to load the history of a new cluster.
+
+The jobs can be loaded:
+    - from saved sacct reports. The clusters are loaded one after the other:
+      the reports of a cluster are parsed in parallel by a pool of processes.
+      When a job appears in several reports, the state with the latest event
+      (submission, start or end) is kept, or the one of the last report in case
+      of a tie. The deduplicated jobs are then merged with the stored jobs and
+      written through the bulk writer, as done by
+      main_read_report_and_update_collection.
+    - from sacct, between two dates. The range is split into slices (of a day
+      or an hour), retrieved by several concurrent sacct calls. Each slice is
+      committed on its own, and recorded as completed in the database, so that
+      an interrupted backfill resumes where it stopped.
+"""
+
+import argparse
+import collections
+import glob
+import itertools
+import os
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from slurm_state.bulk_writer import BulkWriter
+from slurm_state.config import get_config
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.ingestion_state import (
+    get_ingestion_state_collection,
+    get_time_slices,
+    get_completed_backfill_slices,
+    mark_backfill_slice_completed,
+)
+from slurm_state.mongo_update import (
+    UserAccountCache,
+    fetch_slurm_report,
+    get_jobs_updates_and_insertions,
+    main_read_report_and_update_collection,
+    slurm_job_to_clockwork_job,
+)
+from slurm_state.sacct_parser import job_parser, job_parser_parsable2
+
+# Number of jobs merged with the stored jobs at once
+BACKFILL_CHUNK_SIZE = 10000
+
+# Durations, in seconds, of the slices of the sacct backfills
+BACKFILL_SLICE_DURATIONS = {"day": 24 * 3600, "hour": 3600}
+
+
+def find_report_files(L_report_specs):
+    """
+    Find the report files to load.
+
+    Parameters:
+        L_report_specs  List of strings "<cluster_name>=<path>", where the path is a
+                        report file, a directory containing report files, or a glob
+                        pattern (such as "reports/cedar/**/sacct_*.json")
+
+    Returns:
+        A list of (cluster_name, report_path) tuples, in the order of the report specs,
+        and in the order of their paths for each report spec
+    """
+    clusters = get_config("clusters")
+    LT_reports = []
+    for report_spec in L_report_specs:
+        cluster_name, separator, path = report_spec.partition("=")
+        assert separator, f'Expected "<cluster_name>=<path>", got "{report_spec}".'
+        assert cluster_name in clusters, f"{cluster_name} not configured"
+
+        if os.path.isdir(path):
+            L_paths = [os.path.join(path, file_name) for file_name in os.listdir(path)]
+        else:
+            L_paths = glob.glob(path, recursive=True)
+        # The modification times are not used, as they change when the reports
+        # are copied: the order only matters for the jobs whose states have the
+        # same last event time (see get_job_last_event_time)
+        for report_path in sorted(L_paths):
+            if os.path.isfile(report_path):
+                LT_reports.append((cluster_name, report_path))
+
+    return LT_reports
+
+
+def get_report_job_parser(report_path):
+    """
+    Return the parser of a saved sacct report, according to its format (JSON
+    or parsable2), as the format of the reports of a cluster could have changed.
+    """
+    with open(report_path, "rb") as f:
+        beginning = f.read(1024).lstrip()
+    if beginning.startswith(b"{"):
+        return job_parser
+    return job_parser_parsable2
+
+
+def parse_report_file(cluster_name, report_path):
+    """
+    Parse and translate the jobs of a saved sacct report. This function
+    is run in the processes of the pool.
+
+    Returns:
+        The list of the jobs of the report, in the format returned by the parser
+    """
+    return list(
+        fetch_slurm_report(
+            get_report_job_parser(report_path), cluster_name, report_path
+        )
+    )
+
+
+def get_job_last_event_time(D_job):
+    """
+    Return the time of the last event (submission, start or end) of a job,
+    in the format returned by the parser. The state of a job with the latest
+    event is the newest one.
+    """
+    return max(D_job.get(key) or 0 for key in ["submit_time", "start_time", "end_time"])
+
+
+def iter_parsed_reports(executor, cluster_name, L_report_paths, max_pending_reports):
+    """
+    Parse the reports of a cluster in the processes of the executor, and yield
+    the list of the jobs of each report, in the order of the reports. At most
+    max_pending_reports reports are parsed ahead, so that the results which
+    have not been consumed yet do not accumulate in memory.
+    """
+    I_report_paths = iter(L_report_paths)
+    Q_pending = collections.deque(
+        executor.submit(parse_report_file, cluster_name, report_path)
+        for report_path in itertools.islice(I_report_paths, max_pending_reports)
+    )
+    while Q_pending:
+        L_jobs = Q_pending.popleft().result()
+        for report_path in itertools.islice(I_report_paths, 1):
+            Q_pending.append(
+                executor.submit(parse_report_file, cluster_name, report_path)
+            )
+        yield L_jobs
+
+
+def parse_and_deduplicate_reports(
+    cluster_name, L_report_paths, executor, max_pending_reports
+):
+    """
+    Parse the reports of a cluster in parallel, and keep the newest state of each job.
+
+    Parameters:
+        cluster_name            Name of the cluster of the reports
+        L_report_paths          List of the paths of the reports. When the states of a job have
+                                the same last event time, the one of the last report is kept
+        executor                ProcessPoolExecutor parsing the reports
+        max_pending_reports     Maximum number of reports parsed ahead of the deduplication
+
+    Returns:
+        A dictionary of the jobs of the cluster, indexed by job ID
+    """
+    D_cluster_jobs = {}
+    nbr_parsed_jobs = 0
+    timestamp_start = time.time()
+
+    for report_index, L_jobs in enumerate(
+        iter_parsed_reports(executor, cluster_name, L_report_paths, max_pending_reports)
+    ):
+        for D_job in L_jobs:
+            D_known_job = D_cluster_jobs.get(D_job["job_id"])
+            if D_known_job is None or get_job_last_event_time(
+                D_job
+            ) >= get_job_last_event_time(D_known_job):
+                D_cluster_jobs[D_job["job_id"]] = D_job
+        nbr_parsed_jobs += len(L_jobs)
+
+        duration = max(time.time() - timestamp_start, 1e-6)
+        print(
+            f"{cluster_name}: parsed {report_index + 1}/{len(L_report_paths)} reports: {nbr_parsed_jobs} jobs "
+            f"({nbr_parsed_jobs / duration:.0f} jobs/s), {len(D_cluster_jobs)} distinct jobs."
+        )
+
+    return D_cluster_jobs
+
+
+def store_jobs(
+    I_jobs,
+    cluster_name,
+    jobs_collection,
+    users_collection,
+    user_account_cache=None,
+):
+    """
+    Merge the jobs of a cluster with the stored jobs, and write them by chunks
+    through a BulkWriter.
+
+    Parameters:
+        I_jobs              Iterable of the jobs of the cluster, in the format returned by the parser.
+                            It is consumed by chunks
+        cluster_name        Name of the cluster of the jobs
+        jobs_collection     Collection of the jobs in the database
+        users_collection    Collection of the users in the database
+        user_account_cache  UserAccountCache used to retrieve the users associated to the jobs.
+                            Default is None, which means a new cache is used
+
+    Returns:
+        A dictionary containing the numbers of "inserted", (partially) "updated" and "unchanged" jobs
+    """
+    if user_account_cache is None:
+        user_account_cache = UserAccountCache()
+    updates_writer = BulkWriter.for_cluster(jobs_collection, cluster_name)
+    D_counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    timestamp_start = time.time()
+
+    I_jobs = iter(I_jobs)
+    nbr_processed = 0
+    while True:
+        L_chunk = list(itertools.islice(I_jobs, BACKFILL_CHUNK_SIZE))
+        if not L_chunk:
+            break
+        _, L_users_updates, _, D_chunk_counts = get_jobs_updates_and_insertions(
+            map(slurm_job_to_clockwork_job, L_chunk),
+            cluster_name,
+            jobs_collection,
+            users_collection,
+            user_account_cache=user_account_cache,
+            updates_writer=updates_writer,
+        )
+        if L_users_updates:
+            users_collection.bulk_write(L_users_updates)
+        for key in D_counts:
+            D_counts[key] += D_chunk_counts[key]
+
+        nbr_processed += len(L_chunk)
+        duration = max(time.time() - timestamp_start, 1e-6)
+        print(
+            f"{cluster_name}: merged {nbr_processed} jobs "
+            f"({nbr_processed / duration:.0f} jobs/s)."
+        )
+
+    D_bulk_summary = updates_writer.close()
+    print(f"{cluster_name}: {D_bulk_summary}")
+    return D_counts
+
+
+def parse_cluster_date(date, cluster_name):
+    """
+    Convert a date in ISO format, such as "2023-03-30" or "2023-03-30T12:00",
+    to a timestamp. If no timezone is given, the date is in the timezone of the cluster.
+    """
+    D_date = datetime.fromisoformat(date)
+    if D_date.tzinfo is None:
+        D_date = D_date.replace(tzinfo=get_config("clusters")[cluster_name]["timezone"])
+    return int(D_date.timestamp())
+
+
+def backfill_from_sacct(
+    cluster_name,
+    start,
+    end,
+    jobs_collection,
+    users_collection,
+    reports_dir,
+    slice_duration=BACKFILL_SLICE_DURATIONS["day"],
+    nbr_concurrent_slices=2,
+    want_commit_to_db=True,
+):
+    """
+    Retrieve the jobs of a cluster between two dates through sacct, by slices.
+
+    The slices already recorded as completed by a previous backfill of the cluster
+    are skipped. Each slice is committed on its own and then recorded as completed,
+    so that an interrupted backfill resumes where it stopped.
+
+    Parameters:
+        cluster_name            Name of the cluster on which sacct is launched
+        start                   Timestamp of the beginning of the range to retrieve
+        end                     Timestamp of the end of the range to retrieve
+        jobs_collection         Collection of the jobs in the database. The completed slices
+                                are recorded in the same database
+        users_collection        Collection of the users in the database
+        reports_dir             Directory in which the report of each slice is written
+        slice_duration          Duration of the slices, in seconds. Default is a day
+        nbr_concurrent_slices   Maximum number of slices retrieved at the same time. Default is 2
+        want_commit_to_db       Boolean indicating whether or not the jobs are stored in the database.
+                                If False, the slices are not recorded as completed. Default is True
+
+    Returns:
+        The list of the (start, end) slices which could not be retrieved or written
+    """
+    os.makedirs(reports_dir, exist_ok=True)
+    L_slices = get_time_slices(start, end, slice_duration)
+    state_collection = None
+    S_completed_slices = set()
+    if want_commit_to_db:
+        state_collection = get_ingestion_state_collection(jobs_collection)
+        S_completed_slices = get_completed_backfill_slices(
+            state_collection, cluster_name
+        )
+    L_slices_to_do = [
+        time_slice for time_slice in L_slices if time_slice not in S_completed_slices
+    ]
+    print(
+        f"{cluster_name}: {len(L_slices_to_do)} slices to retrieve, "
+        f"{len(L_slices) - len(L_slices_to_do)} already completed."
+    )
+
+    user_account_cache = UserAccountCache()
+    timestamp_start = time.time()
+
+    def backfill_slice(time_slice):
+        report_file_path = os.path.join(
+            reports_dir, f"{cluster_name}_sacct_{time_slice[0]}_{time_slice[1]}.json"
+        )
+        try:
+            # False if the report could not be retrieved, or if some of
+            # its jobs could not be written (write errors)
+            committed = main_read_report_and_update_collection(
+                "jobs",
+                jobs_collection,
+                users_collection,
+                cluster_name,
+                report_file_path,
+                from_file=False,
+                want_commit_to_db=want_commit_to_db,
+                user_account_cache=user_account_cache,
+                sacct_window=time_slice,
+                # The slices are distinct windows, ingested concurrently.
+                # The spool is left to the regular runs, which hold the lease
+                use_lease=False,
+                use_spool=False,
+            )
+        except Exception:
+            # The other slices go on, and this one is retried by the next backfill
+            print(
+                f"Error while retrieving the jobs of {cluster_name} between {time_slice[0]} and {time_slice[1]}."
+            )
+            traceback.print_exc()
+            return False
+        if not committed:
+            return False
+        if want_commit_to_db:
+            mark_backfill_slice_completed(
+                state_collection, cluster_name, time_slice, time.time()
+            )
+        return True
+
+    L_failed_slices = []
+    with ThreadPoolExecutor(max_workers=nbr_concurrent_slices) as executor:
+        for slice_index, (time_slice, success) in enumerate(
+            zip(L_slices_to_do, executor.map(backfill_slice, L_slices_to_do))
+        ):
+            if not success:
+                L_failed_slices.append(time_slice)
+            print(
+                f"{cluster_name}: {slice_index + 1}/{len(L_slices_to_do)} slices done "
+                f"({len(L_failed_slices)} failed) in {time.time() - timestamp_start:.1f} seconds."
+            )
+
+    if L_failed_slices:
+        print(
+            f"{cluster_name}: {len(L_failed_slices)} slices could not be retrieved. "
+            "Run the backfill again to retry them."
+        )
+    return L_failed_slices
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Load the history of the jobs of one or more clusters in the database, "
+        "from saved sacct reports (--reports) or from sacct (--cluster_name, --start and --end).",
+    )
+    parser.add_argument(
+        "--reports",
+        nargs="+",
+        default=None,
+        help='Reports to load, as "<cluster_name>=<path>" where the path is a report file, a directory or a glob pattern.',
+    )
+    parser.add_argument(
+        "--nbr_processes",
+        type=int,
+        default=None,
+        help="Number of processes parsing the reports. Default is the number of CPUs.",
+    )
+    parser.add_argument(
+        "--cluster_name",
+        default=None,
+        help="Cluster on which sacct is launched to retrieve the jobs between --start and --end.",
+    )
+    parser.add_argument(
+        "--start",
+        default=None,
+        help="Beginning of the range to retrieve through sacct, such as 2023-03-01. Default timezone is the cluster one.",
+    )
+    parser.add_argument(
+        "--end",
+        default=None,
+        help="End of the range to retrieve through sacct, such as 2023-04-01. Default timezone is the cluster one.",
+    )
+    parser.add_argument(
+        "--slice",
+        choices=list(BACKFILL_SLICE_DURATIONS.keys()),
+        default="day",
+        help="Duration of the slices retrieved by each sacct call.",
+    )
+    parser.add_argument(
+        "--nbr_concurrent_slices",
+        type=int,
+        default=2,
+        help="Maximum number of concurrent sacct calls.",
+    )
+    parser.add_argument(
+        "--reports_dir",
+        default=None,
+        help="Directory in which the reports of the slices are kept. Default is a temporary directory.",
+    )
+    parser.add_argument(
+        "--store_in_db",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether or not the jobs are stored in db.",
+    )
+    parser.add_argument(
+        "--mongodb_collection", default="clockwork", help="Collection to populate."
+    )
+    args = parser.parse_args(argv[1:])
+
+    if args.reports is None and not (args.cluster_name and args.start and args.end):
+        parser.error(
+            "Either --reports, or --cluster_name, --start and --end are required."
+        )
+
+    timestamp_start = time.time()
+
+    client = get_mongo_client()
+    jobs_collection = client[args.mongodb_collection]["jobs"]
+    users_collection = client[args.mongodb_collection]["users"]
+    if args.store_in_db:
+        jobs_collection.create_index(
+            [("slurm.job_id", 1), ("slurm.cluster_name", 1)],
+            name="job_id_and_cluster_name",
+        )
+
+    if args.reports is None:
+        # Retrieve the jobs from sacct
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            L_failed_slices = backfill_from_sacct(
+                args.cluster_name,
+                parse_cluster_date(args.start, args.cluster_name),
+                parse_cluster_date(args.end, args.cluster_name),
+                jobs_collection,
+                users_collection,
+                args.reports_dir or tmp_dir,
+                slice_duration=BACKFILL_SLICE_DURATIONS[args.slice],
+                nbr_concurrent_slices=args.nbr_concurrent_slices,
+                want_commit_to_db=args.store_in_db,
+            )
+        print(f"Backfill done in {time.time() - timestamp_start:.1f} seconds.")
+        if L_failed_slices:
+            sys.exit(1)
+        return
+
+    LT_reports = find_report_files(args.reports)
+    print(f"Found {len(LT_reports)} reports.")
+
+    # The clusters are loaded one after the other, so that only the jobs
+    # of one cluster are kept in memory
+    DL_report_paths = {}
+    for cluster_name, report_path in LT_reports:
+        DL_report_paths.setdefault(cluster_name, []).append(report_path)
+
+    nbr_processes = args.nbr_processes or os.cpu_count()
+    user_account_cache = UserAccountCache()
+    nbr_jobs = 0
+    with ProcessPoolExecutor(max_workers=nbr_processes) as executor:
+        for cluster_name, L_report_paths in DL_report_paths.items():
+            D_cluster_jobs = parse_and_deduplicate_reports(
+                cluster_name,
+                L_report_paths,
+                executor,
+                max_pending_reports=2 * nbr_processes,
+            )
+            nbr_jobs += len(D_cluster_jobs)
+
+            if args.store_in_db:
+                D_counts = store_jobs(
+                    D_cluster_jobs.values(),
+                    cluster_name,
+                    jobs_collection,
+                    users_collection,
+                    user_account_cache=user_account_cache,
+                )
+                print(
+                    f"{cluster_name}: {D_counts['inserted']} inserted, {D_counts['updated']} partially updated "
+                    f"and {D_counts['unchanged']} unchanged."
+                )
+            del D_cluster_jobs
+
+    duration = max(time.time() - timestamp_start, 1e-6)
+    print(
+        f"Backfilled {nbr_jobs} distinct jobs from {len(LT_reports)} reports "
+        f"in {duration:.1f} seconds ({nbr_jobs / duration:.0f} jobs/s)."
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+"""
+python3 -m slurm_state.backfill \
+    --reports cedar=${HOME}/slurm_report/cedar mila="${HOME}/slurm_report/mila/**/*.json" \
+    --mongodb_collection ${MONGODB_DATABASE_NAME}
+
+python3 -m slurm_state.backfill \
+    --cluster_name cedar --start 2023-01-01 --end 2023-04-01 --slice day \
+    --nbr_concurrent_slices 4 \
+    --mongodb_collection ${MONGODB_DATABASE_NAME}
+"""
@@ -0,0 +1,196 @@
+"""
+Write the operations on the jobs and nodes collections by batches,
+as soon as they are produced.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from slurm_state.config import get_config, integer
+from slurm_state.extra_filters import clusters_valid
+
+# Number of operations sent in each bulk_write
+clusters_valid.add_field("bulk_write_batch_size", integer, default=1000)
+# Number of threads sending the batches to the database. With 1 thread,
+# the batches are written synchronously.
+clusters_valid.add_field("bulk_write_nbr_threads", integer, default=1)
+
+# Counters of the bulk_api_result which are summed over the batches
+BULK_RESULT_COUNTERS = ["nInserted", "nUpserted", "nMatched", "nModified", "nRemoved"]
+
+# Maximum number of write errors kept in the summary
+MAX_WRITE_ERRORS_KEPT = 10
+
+
+class BulkWriter:
+    """
+    Collect database operations and send them with unordered bulk writes
+    of a fixed size, so that a bad document does not prevent the other
+    operations from being written, and the operations do not have to be
+    kept in memory until the end of the run.
+
+    It exposes an `append` method, so that it can be used in place of the
+    list of operations to do. The batches can be written by several threads,
+    which share the connection pool of the client of the collection.
+
+    If a spool is given (see slurm_state/spool.py), a batch which cannot be
+    written because of a connection failure is written to the spool instead,
+    as well as all the following batches. With one thread, the spooled batches
+    keep the order of the operations. With several threads, the batches are
+    written concurrently: a batch can be written before a previous one fails
+    and is spooled, so the order of the operations is not kept. This is fine
+    for the ingestion runs, whose operations concern distinct documents.
+
+    If before_batch is given, it is called before each batch is sent, and can
+    raise an exception to stop the writes (see IngestionLease.check).
+
+    Example:
+        writer = BulkWriter(collection, batch_size=1000, nbr_threads=2)
+        for op in operations:
+            writer.append(op)
+        summary = writer.close()
+    """
+
+    def __init__(
+        self, collection, batch_size=1000, nbr_threads=1, spool=None, before_batch=None
+    ):
+        assert batch_size > 0
+        assert nbr_threads > 0
+        self.collection = collection
+        self.batch_size = batch_size
+        self.nbr_operations = 0
+        self.summary = {counter: 0 for counter in BULK_RESULT_COUNTERS}
+        self.summary["nbr_batches"] = 0
+        self.summary["nbr_write_errors"] = 0
+        self.summary["nbr_spooled"] = 0
+        self.summary["writeErrors"] = []
+        self.summary["writeConcernErrors"] = []
+
+        self.spool = spool
+        self.before_batch = before_batch
+        # Whether the operations are written to the spool instead of the database
+        self.spooling = False
+
+        self._batch = []
+        self._lock = threading.Lock()
+        self._exceptions = []
+        if nbr_threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=nbr_threads)
+            # Limit the number of batches waiting to be written
+            self._pending_batches = threading.BoundedSemaphore(2 * nbr_threads)
+        else:
+            self._executor = None
+
+    @classmethod
+    def for_cluster(cls, collection, cluster_name, spool=None, before_batch=None):
+        """
+        Create a BulkWriter using the settings of the cluster.
+        """
+        cluster = get_config("clusters")[cluster_name]
+        return cls(
+            collection,
+            batch_size=cluster["bulk_write_batch_size"],
+            nbr_threads=cluster["bulk_write_nbr_threads"],
+            spool=spool,
+            before_batch=before_batch,
+        )
+
+    def __len__(self):
+        return self.nbr_operations
+
+    def append(self, operation):
+        """
+        Add an operation, and send the current batch if it is full.
+        """
+        self._batch.append(operation)
+        self.nbr_operations += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the operations which have not been written yet.
+        """
+        if not self._batch:
+            return
+        if self.before_batch is not None:
+            self.before_batch()
+        batch, self._batch = self._batch, []
+        if self._executor is None:
+            self._write(batch)
+        else:
+            self._pending_batches.acquire()
+            self._executor.submit(self._write_and_release, batch)
+
+    def close(self):
+        """
+        Write the remaining operations and wait for all the batches
+        to be written.
+
+        Returns:
+            A dictionary merging the bulk_api_result of all the batches.
+
+        Raises the first exception other than a BulkWriteError which occurred
+        while writing, such as a connection failure.
+        """
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._exceptions:
+            raise self._exceptions[0]
+        return self.summary
+
+    def _write_and_release(self, batch):
+        try:
+            self._write(batch)
+        finally:
+            self._pending_batches.release()
+
+    def _write(self, batch):
+        if self.spooling:
+            self._spool(batch)
+            return
+        try:
+            result = self.collection.bulk_write(batch, ordered=False)
+            self._merge(result.bulk_api_result)
+        except BulkWriteError as inst:
+            # The other operations of the batch have been written anyway
+            self._merge(inst.details)
+        except Exception as inst:
+            if self.spool is not None and isinstance(inst, ConnectionFailure):
+                print(
+                    f"Error. Failed to write to {self.collection.name}, spooling the operations: {inst}"
+                )
+                self.spooling = True
+                self._spool(batch)
+                return
+            with self._lock:
+                self._exceptions.append(inst)
+            if self._executor is None:
+                raise
+
+    def _spool(self, batch):
+        with self._lock:
+            for operation in batch:
+                self.spool.append(self.collection.name, operation)
+            self.summary["nbr_spooled"] += len(batch)
+
+    def _merge(self, bulk_api_result):
+        with self._lock:
+            self.summary["nbr_batches"] += 1
+            for counter in BULK_RESULT_COUNTERS:
+                self.summary[counter] += bulk_api_result.get(counter, 0)
+            write_errors = bulk_api_result.get("writeErrors", [])
+            self.summary["nbr_write_errors"] += len(write_errors)
+            for write_error in write_errors:
+                if len(self.summary["writeErrors"]) < MAX_WRITE_ERRORS_KEPT:
+                    # The operation itself is too long and not necessary
+                    self.summary["writeErrors"].append(
+                        {k: v for k, v in write_error.items() if k != "op"}
+                    )
+            self.summary["writeConcernErrors"].extend(
+                bulk_api_result.get("writeConcernErrors", [])
+            )
@@ -0,0 +1,165 @@
+"""
+Writers and reader of the dump files of the Clockwork jobs and nodes
+(the --cw_jobs_file and --cw_nodes_file options of read_report_commit_to_db.py).
+
+The format of a dump file depends on its name:
+    *.jsonl             One JSON document per line (JSON Lines). Each entity is
+                        written as soon as it is produced
+    *.jsonl.gz          The same, compressed with gzip
+    *.jsonl.zst         The same, compressed with zstd (requires the zstandard package)
+    anything else       An indented JSON list, written at once when the dump is closed
+
+In all cases, the dump is written in a temporary file, which replaces the
+dump file only once it is complete.
+"""
+
+import gzip
+import os
+
+from slurm_state.helpers.json_codec import get_json_codec
+
+# zstandard is optional: it is only required by the *.jsonl.zst dump files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# First bytes of the files compressed with gzip and zstd
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class JSONListDumpWriter:
+    """
+    Gather the entities, and write them as an indented JSON list when closed.
+    """
+
+    def __init__(self, dump_file):
+        self.dump_file = dump_file
+        self.L_entities = []
+
+    def __len__(self):
+        return len(self.L_entities)
+
+    def append(self, D_entity):
+        self.L_entities.append(D_entity)
+
+    def close(self):
+        tmp_file = f"{self.dump_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            get_json_codec().dump(self.L_entities, f, indent=True)
+        os.replace(tmp_file, self.dump_file)
+
+    def abort(self):
+        self.L_entities = []
+
+
+class JSONLinesDumpWriter:
+    """
+    Write each entity on its own line as soon as it is appended,
+    optionally compressed according to the extension of the dump file.
+    """
+
+    def __init__(self, dump_file):
+        self.dump_file = dump_file
+        self.nbr_entities = 0
+        self._codec = get_json_codec()
+        self._tmp_file = f"{dump_file}.tmp"
+        self._raw_file = open(self._tmp_file, "wb")
+        if dump_file.endswith(".gz"):
+            self._file = gzip.GzipFile(fileobj=self._raw_file, mode="wb")
+        elif dump_file.endswith(".zst"):
+            if zstandard is None:
+                self._raw_file.close()
+                os.remove(self._tmp_file)
+                raise ValueError(
+                    f"The zstandard package is required to write {dump_file}."
+                )
+            self._file = zstandard.ZstdCompressor().stream_writer(
+                self._raw_file, closefd=False
+            )
+        else:
+            self._file = None
+
+    def __len__(self):
+        return self.nbr_entities
+
+    def append(self, D_entity):
+        (self._file or self._raw_file).write(self._codec.dumps(D_entity) + b"\n")
+        self.nbr_entities += 1
+
+    def _close_files(self):
+        if self._file is not None:
+            self._file.close()
+        self._raw_file.close()
+
+    def close(self):
+        self._close_files()
+        os.replace(self._tmp_file, self.dump_file)
+
+    def abort(self):
+        """
+        Remove the temporary file, leaving the previous dump file untouched.
+        """
+        self._close_files()
+        os.remove(self._tmp_file)
+
+
+class CountingDumpWriter:
+    """
+    Only count the entities, when no dump file is requested.
+    """
+
+    def __init__(self):
+        self.nbr_entities = 0
+
+    def __len__(self):
+        return self.nbr_entities
+
+    def append(self, D_entity):
+        self.nbr_entities += 1
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+def is_json_lines_dump_file(dump_file):
+    return dump_file.endswith((".jsonl", ".jsonl.gz", ".jsonl.zst"))
+
+
+def open_dump_writer(dump_file):
+    """
+    Return a writer (with "append", "close" and "abort" methods) of the dump file,
+    in the format corresponding to its name. If dump_file is empty, the returned
+    writer only counts the entities.
+    """
+    if not dump_file:
+        return CountingDumpWriter()
+    if is_json_lines_dump_file(dump_file):
+        return JSONLinesDumpWriter(dump_file)
+    return JSONListDumpWriter(dump_file)
+
+
+def load_dump_file(dump_file):
+    """
+    Return the list of the entities of a dump file, whatever its format.
+    The format and the compression are detected from the content of the file.
+    """
+    with open(dump_file, "rb") as f:
+        data = f.read()
+
+    if data.startswith(GZIP_MAGIC):
+        data = gzip.decompress(data)
+    elif data.startswith(ZSTD_MAGIC):
+        assert (
+            zstandard is not None
+        ), f"The zstandard package is required to read {dump_file}."
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    codec = get_json_codec()
+    if data.lstrip().startswith(b"["):
+        return codec.loads(data)
+    return [codec.loads(line) for line in data.splitlines() if line.strip()]
@@ -4,6 +4,21 @@ to a format used by Clockwork).
 """
 
 import re
+from functools import lru_cache
+
+# Maximum number of (Gres, AvailableFeatures) pairs whose description is kept.
+# A cluster only has a handful of distinct pairs
+GRES_DESCRIPTION_CACHE_SIZE = 1024
+
+# The Gres field is a list of comma-separated resources, such as
+# "gpu:<gpu_name>:<gpu_number>" with, optionally, at the end: "(S:0)" if the
+# GPU are associated with socket 0, "(S:0-1)" for instance if associated to
+# sockets 0 and 1. The commas between parentheses do not separate resources
+GRES_SEPARATOR_PATTERN = re.compile(r",(?![^(]*\))")
+GPU_GRES_PATTERN = re.compile(r"gpu:(\w*?):(\d+)(?:\(S:(.*)\))?$")
+
+# The amount of RAM of the GPU is the last of the 'AvailableFeatures', such as "32gb"
+FEATURES_GPU_RAM_PATTERN = re.compile(r"^(\w*,)*(\d+)gb$")
 
 
 def get_cw_gres_description(unparsed_gres, unparsed_features):
@@ -22,7 +37,8 @@ def get_cw_gres_description(unparsed_gres, unparsed_features):
             "cw_name": <cw_name>,
             "name": <gpu_name>,
             "number": <number>,
-            "associated_sockets": "<associated_sockets>" (optional)
+            "associated_sockets": "<associated_sockets>" (optional),
+            "types": [...] (only when the node has several types of GPU)
         }
         with:
             - <cw_name> a string containing the GPU name according to the
@@ -34,13 +50,28 @@ def get_cw_gres_description(unparsed_gres, unparsed_features):
             - <associated_sockets> a string presenting the sockets associated to
               the GPU. For instance, "(S:0)" if the GPU are associated with
               socket 0, or "(S:0-1)" if associated with sockets 0 and 1.
+        When the node has several types of GPU, "types" contains a dictionary
+        in the format above for each type, while the names are the ones of the
+        first type and the number is the total number of GPU of the node.
+
+    The descriptions are cached, as the nodes of a cluster share a few distinct
+    'Gres' and 'AvailableFeatures' fields. A new dictionary is returned each time.
     """
+    gpu_specs = dict(_get_cached_cw_gres_description(unparsed_gres, unparsed_features))
+    if "types" in gpu_specs:
+        gpu_specs["types"] = [dict(gpu_type) for gpu_type in gpu_specs["types"]]
+    return gpu_specs
 
+
+@lru_cache(maxsize=GRES_DESCRIPTION_CACHE_SIZE)
+def _get_cached_cw_gres_description(unparsed_gres, unparsed_features):
     # Get gpu name, number and associated sockets
     gpu_specs = get_gres_dict(unparsed_gres)
 
     if "name" in gpu_specs.keys():
         gpu_specs["cw_name"] = get_cw_gpu_name(gpu_specs["name"], unparsed_features)
+    for gpu_type in gpu_specs.get("types", []):
+        gpu_type["cw_name"] = get_cw_gpu_name(gpu_type["name"], unparsed_features)
 
     return gpu_specs
 
@@ -53,13 +84,14 @@ def get_gres_dict(slurm_gres_field):
         - slurm_gres_field is the content of the 'Gres' field in the Slurm report
 
     Returns:
-        An empty dictionary if slurm_gres_field is None.
+        An empty dictionary if slurm_gres_field is None, or does not contain GPU.
         Otherwise, a dictionary presenting the following
         format:
             {
                 "name": "<gpu_name>",
                 "number": <number>,
-                "associated_sockets": "<sockets_numbers>" (optional)
+                "associated_sockets": "<sockets_numbers>" (optional),
+                "types": [...] (only when there are several types of GPU)
             }
             with:
                 - <gpu_name> a string containing the GPU name as displayed in the
@@ -69,39 +101,35 @@ def get_gres_dict(slurm_gres_field):
                 - <sockets_numbers>" a string presenting the sockets associated to
                   the GPU. For instance, "(S:0)" if the GPU are associated with
                   socket 0, or "(S:0-1)" if associated with sockets 0 and 1.
+        If the field lists several types of GPU, such as "gpu:a100:4,gpu:v100:2",
+        "types" contains a dictionary in the format above for each type, while
+        the name is the one of the first type and the number is the total
+        number of GPU.
     """
     # Return an empty dictionary if the 'Gres' field is None
     if slurm_gres_field == None:
         return {}
 
-    # Return a dictionary describing the "gres" data otherwise
-    else:
-        # Initialize
-        gres_dict = {}
-        gres_dict_parsed = {}
-
-        # The Gres field has the following format: "gpu:<gpu_name>:<gpu_number>"
-        # with, optionally, at the end: "(S:0)" if the GPU are associated with
-        # socket 0, "(S:0-1)" for instance if associated to sockets 0 and 1.
-        prog1 = re.compile(r"gpu:(\w*?):(\d+)$")
-        prog2 = re.compile(r"gpu:(\w*?):(\d+)\(S:(.*)\)")
-
-        if m := prog1.match(slurm_gres_field):
-            # Get the gpu name and number.
-            gres_dict_parsed = {"name": m.group(1), "number": int(m.group(2))}
-        elif m := prog2.match(slurm_gres_field):
-            # Get the gpu name and number, as well as associated sockets
-            # if there are any.
-            gres_dict_parsed = {
-                "name": m.group(1),
-                "number": int(m.group(2)),
-                "associated_sockets": m.group(3),
-            }
-        else:
-            # We encountered an unexpected expression.
-            gres_dict_parsed = {}
-
-        return gres_dict_parsed
+    # Parse each GPU resource of the field, ignoring the other resources
+    # and the unexpected expressions
+    L_gpu_types = []
+    for gres in GRES_SEPARATOR_PATTERN.split(slurm_gres_field):
+        if m := GPU_GRES_PATTERN.match(gres):
+            gpu_type = {"name": m.group(1), "number": int(m.group(2))}
+            # Add the associated sockets if there are any
+            if m.group(3) is not None:
+                gpu_type["associated_sockets"] = m.group(3)
+            L_gpu_types.append(gpu_type)
+
+    if not L_gpu_types:
+        return {}
+    if len(L_gpu_types) == 1:
+        return L_gpu_types[0]
+    return {
+        "name": L_gpu_types[0]["name"],
+        "number": sum(gpu_type["number"] for gpu_type in L_gpu_types),
+        "types": L_gpu_types,
+    }
 
 
 def get_cw_gpu_name(slurm_gpu_name, features):
@@ -122,10 +150,9 @@ def get_cw_gpu_name(slurm_gpu_name, features):
     Returns:
         A string containing the GPU name based on the convention presented above.
     """
-    # Parse the 'AvailableFeatures' field
-    prog = re.compile(r"^(\w*,)*(\d+)gb$")
-    # If the field matches this format, the amount of RAM can be retrieved
-    if m := prog.match(features):
+    # Parse the 'AvailableFeatures' field. If the field matches
+    # this format, the amount of RAM can be retrieved
+    if m := FEATURES_GPU_RAM_PATTERN.match(features):
         gpu_ram = m.group(2)
         # Change the name if needed
         if slurm_gpu_name == "v100" and gpu_ram == "32":
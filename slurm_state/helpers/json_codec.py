@@ -0,0 +1,101 @@
+"""
+Encode and decode the JSON documents handled by slurm_state (reports, dump
+files, users files) with the fastest backend available.
+
+orjson is used if it is installed, and the json module of the standard library
+otherwise. The backend can be forced with the "json.backend" configuration key.
+"""
+
+import json
+
+from slurm_state.config import get_config, register_config, string_choices
+
+# orjson is optional: without it, the json module of the standard library is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+register_config("json.backend", "auto", string_choices("auto", "orjson", "json"))
+
+
+class StdlibJSONCodec:
+    """
+    Codec based on the json module of the standard library.
+    """
+
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def load(self, f):
+        return json.load(f)
+
+    def dumps(self, obj, indent=False):
+        """
+        Return the JSON representation of obj, as bytes. If indent is True,
+        the document is indented, which makes it easier to read but longer to write.
+        """
+        return json.dumps(obj, indent=4 if indent else None).encode("utf-8")
+
+    def dump(self, obj, f, indent=False):
+        """
+        Write the JSON representation of obj to a file opened in binary mode.
+        """
+        f.write(self.dumps(obj, indent=indent))
+
+
+class OrjsonCodec(StdlibJSONCodec):
+    """
+    Codec based on orjson, which is several times faster than the standard library,
+    especially to write indented documents.
+
+    Note that orjson only indents with 2 spaces, and does not escape the
+    non-ASCII characters.
+    """
+
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def load(self, f):
+        return orjson.loads(f.read())
+
+    def dumps(self, obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+
+
+def get_available_json_backends():
+    """
+    Return the names of the backends which can be used.
+    """
+    if orjson is None:
+        return ["json"]
+    return ["orjson", "json"]
+
+
+def get_json_codec(backend=None):
+    """
+    Return the codec of a backend.
+
+    Parameters:
+        backend     "orjson", "json", or "auto" to use the fastest backend available.
+                    Default is None, which means the "json.backend" configuration is used
+
+    Returns:
+        An object with the loads, load, dumps and dump methods
+    """
+    if backend is None:
+        backend = get_config("json.backend")
+
+    if backend == "auto":
+        backend = get_available_json_backends()[0]
+
+    if backend == "orjson":
+        assert orjson is not None, "The orjson package is not installed."
+        return OrjsonCodec()
+    if backend == "json":
+        return StdlibJSONCodec()
+    raise ValueError(f"Unknown JSON backend: {backend}")
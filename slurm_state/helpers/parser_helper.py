@@ -2,6 +2,8 @@
 This file gathers the function shared by the job parser and the node parser
 """
 
+import codecs, json
+
 
 def copy(k, v, res):
     res[k] = v
@@ -18,4 +20,234 @@ def rename(name):
     def renamer(k, v, res):
         res[name] = v
 
+    # Used by compile_field_map to copy the value without calling the translator
+    renamer.renamed_to = name
     return renamer
+
+
+def translate_with_field_map(src, field_map):
+    """
+    Translate an entity (job or node) retrieved from a report, by applying
+    the translator associated to each of its fields in field_map. The fields
+    not associated to any translator are ignored.
+
+    compile_field_map returns a faster function giving the same result.
+    """
+    res = dict()  # Initialize the dictionary which will store the newly formatted data
+
+    for k, v in src.items():
+        # We will use a handler mapping to translate this
+        translator = field_map.get(k, None)
+
+        if translator is not None:
+            # Translate using the translator retrieved from the field map
+            translator(k, v, res)
+
+        # If no translator has been provided: ignore the field
+
+    return res
+
+
+def compile_field_map(field_map):
+    """
+    Build a function translating an entity retrieved from a report as
+    translate_with_field_map does, but faster.
+
+    Only the fields of the map are visited, instead of all the fields of
+    the entity (sacct returns dozens of fields which are ignored), and the
+    values of the fields which are simply copied or renamed are copied
+    directly, without calling their translator.
+
+    Parameters:
+        field_map   A dictionary associating a translator to each field to retrieve
+
+    Returns:
+        A function taking an entity and returning its translation
+    """
+    LT_copies = []  # (field, new name) for the fields simply copied or renamed
+    LT_translators = []  # (field, translator) for the other fields
+    for k, translator in field_map.items():
+        if translator is copy:
+            LT_copies.append((k, k))
+        elif getattr(translator, "renamed_to", None) is not None:
+            LT_copies.append((k, translator.renamed_to))
+        else:
+            LT_translators.append((k, translator))
+    LT_copies = tuple(LT_copies)
+    LT_translators = tuple(LT_translators)
+
+    def translate(src):
+        res = dict()
+        for k, name in LT_copies:
+            if k in src:
+                res[name] = src[k]
+        for k, translator in LT_translators:
+            if k in src:
+                translator(k, src[k], res)
+        return res
+
+    return translate
+
+
+# Size of the chunks read from the report while streaming it
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACES = " \t\n\r"
+
+
+class _JSONStreamReader:
+    """
+    Minimal incremental reader over a JSON document.
+
+    Only a window of the document is kept in memory: the values are decoded
+    one by one with the C scanner of the json module (through raw_decode),
+    and the consumed part of the buffer is dropped each time more data has
+    to be read.
+    """
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        # The report could be a text file or a binary stream (such as
+        # the stdout of a SSH channel)
+        self.bytes_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """
+        Read the next chunk of the document. Return False if the end
+        of the document has been reached.
+        """
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            # Raise an error if the document ends with an incomplete character
+            self.bytes_decoder.decode(b"", final=True)
+            self.eof = True
+            return False
+        if isinstance(chunk, bytes):
+            # The chunk could end in the middle of a character, which is
+            # then kept by the decoder until the next chunk
+            chunk = self.bytes_decoder.decode(chunk)
+        # Drop what has already been consumed
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, without consuming it.
+        """
+        while True:
+            while self.pos < len(self.buffer):
+                if self.buffer[self.pos] not in _WHITESPACES:
+                    return self.buffer[self.pos]
+                self.pos += 1
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON report.")
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                f"Unexpected character in JSON report: expected {char!r}, found {found!r}."
+            )
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode the next JSON value of the document and consume it.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending with the buffer (such as a number) could
+                # be truncated: make sure the next chunk does not extend it
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_array_items(f, key, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Iterate over the elements of the array associated to the given key
+    in the top-level object of a JSON report, such as the "jobs" list of
+    a sacct report or the "nodes" list of a sinfo report.
+
+    The elements are decoded and yielded one at a time. The other values of
+    the top-level object are decoded and dropped, so that the memory used
+    does not depend on the size of the report but on the size of its biggest
+    element.
+
+    Parameters:
+        f           File-like object (text or binary) containing the report
+        key         Key of the array to iterate over
+        chunk_size  Number of characters (or bytes) read at a time
+
+    Raises a KeyError if the key is not present in the report.
+    """
+    reader = _JSONStreamReader(f, chunk_size=chunk_size)
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        raise KeyError(key)
+
+    while True:
+        current_key = reader.decode_value()
+        reader.expect(":")
+
+        if current_key == key:
+            reader.expect("[")
+            if reader.peek() == "]":
+                return
+            while True:
+                yield reader.decode_value()
+                if reader.peek() == "]":
+                    return
+                reader.expect(",")
+        else:
+            # Ignore the values associated to the other keys
+            reader.decode_value()
+
+        if reader.peek() == "}":
+            raise KeyError(key)
+        reader.expect(",")
+
+
+def iter_text_lines(f, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Iterate over the lines of a report, without their line break, reading it
+    by chunks. The report could be a text file or a binary stream (such as
+    the stdout of a SSH channel).
+
+    Parameters:
+        f           The report to read
+        chunk_size  The number of characters (or bytes) read at once
+
+    Returns:
+        An iterator over the lines of the report
+    """
+    bytes_decoder = codecs.getincrementaldecoder("utf-8")()
+    remainder = ""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            bytes_decoder.decode(b"", final=True)
+            break
+        if isinstance(chunk, bytes):
+            chunk = bytes_decoder.decode(chunk)
+        L_lines = (remainder + chunk).split("\n")
+        remainder = L_lines.pop()
+        for line in L_lines:
+            yield line.rstrip("\r")
+    if remainder:
+        yield remainder.rstrip("\r")
@@ -1,7 +1,20 @@
-import os
+import os, threading, time, zlib
 
 from paramiko import SSHClient, AutoAddPolicy, ssh_exception, RSAKey
 
+# zstandard is optional: without it, the compressed reports are retrieved with gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# First bytes of the outputs of the compressors
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Number of compressed bytes read at once from the remote command
+COMPRESSED_CHUNK_SIZE = 64 * 1024
+
 
 def open_connection(hostname, username, ssh_key_path, port=22):
     """
@@ -43,3 +56,282 @@ def open_connection(hostname, username, ssh_key_path, port=22):
         ssh_client = None
 
     return ssh_client
+
+
+class SSHSessionPool:
+    """
+    Keep the SSH connections open between the calls to the remote clusters.
+
+    The connections are indexed by (hostname, username, port, ssh_key_path).
+    Each command is run on a new channel of the connection, and keepalive
+    packets are sent in order to detect the connections which have been
+    closed. A connection that is not active anymore, or fails to open a
+    channel, is transparently replaced by a new one.
+    """
+
+    def __init__(self, keepalive_interval=30):
+        self.keepalive_interval = keepalive_interval
+        self.nbr_connections = 0  # Number of connections opened by the pool
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, hostname, username, ssh_key_path, port=22):
+        """
+        Return a connected SSHClient, reusing the open connection if there
+        is one. Return None if the connection failed, as open_connection does.
+        """
+        key = (hostname, username, port, ssh_key_path)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # Only the calls to the same host wait for each other
+        with key_lock:
+            ssh_client = self._clients.get(key, None)
+            if ssh_client is not None:
+                transport = ssh_client.get_transport()
+                if transport is not None and transport.is_active():
+                    return ssh_client
+                print(f"SSH connection to {username}@{hostname} port {port} lost.")
+                self._discard(key)
+
+            ssh_client = open_connection(
+                hostname, username, ssh_key_path=ssh_key_path, port=port
+            )
+            if ssh_client is not None:
+                self.nbr_connections += 1
+                ssh_client.get_transport().set_keepalive(self.keepalive_interval)
+                self._clients[key] = ssh_client
+            return ssh_client
+
+    def exec_command(self, hostname, username, ssh_key_path, command, port=22):
+        """
+        Run a command on the remote host, on a new channel of the pooled connection.
+
+        Returns:
+            The (stdin, stdout, stderr) file-like objects of the command, as
+            SSHClient.exec_command does, or None if the connection failed.
+        """
+        for attempt in range(2):
+            ssh_client = self.get_client(
+                hostname, username, ssh_key_path=ssh_key_path, port=port
+            )
+            if ssh_client is None:
+                return None
+            try:
+                return ssh_client.exec_command(command)
+            except (ssh_exception.SSHException, EOFError, OSError):
+                # The connection has been closed since it has been checked:
+                # open a new one
+                if attempt:
+                    raise
+                print(
+                    f"Failed to open a channel to {username}@{hostname} port {port}. Reconnecting."
+                )
+                self.discard(hostname, username, ssh_key_path, port=port)
+
+    def discard(self, hostname, username, ssh_key_path, port=22):
+        """
+        Close the pooled connection to a host, if any.
+        """
+        key = (hostname, username, port, ssh_key_path)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        ssh_client = self._clients.pop(key, None)
+        if ssh_client is not None:
+            ssh_client.close()
+
+    def close(self):
+        """
+        Close all the pooled connections.
+        """
+        with self._lock:
+            L_keys = list(self._clients.keys())
+        for key in L_keys:
+            self.discard(key[0], key[1], key[3], port=key[2])
+
+
+# Lock preventing concurrent scrapes from creating several session pools
+_ssh_session_pool_lock = threading.Lock()
+
+
+def get_ssh_session_pool():
+    """
+    Get the SSH session pool shared by the report generators.
+    """
+    with _ssh_session_pool_lock:
+        if get_ssh_session_pool.value is None:
+            get_ssh_session_pool.value = SSHSessionPool()
+
+    return get_ssh_session_pool.value
+
+
+get_ssh_session_pool.value = None
+
+
+def compress_remote_command(command, compression):
+    """
+    Wrap a command so that its output is compressed on the remote side.
+
+    Parameters:
+        command         The command to launch on the remote host
+        compression     "none", "gzip", "zstd", or "auto" to use zstd if it is available on
+                        both sides, and gzip otherwise
+
+    Returns:
+        The command to launch instead
+    """
+    if compression == "none":
+        return command
+    if compression == "gzip":
+        return f"{command} | gzip -c"
+    if compression == "zstd":
+        assert zstandard is not None, "The zstandard package is required to use zstd."
+        return f"{command} | zstd -c -q"
+    if compression == "auto":
+        if zstandard is None:
+            return f"{command} | gzip -c"
+        return (
+            "if command -v zstd >/dev/null 2>&1; "
+            f"then {command} | zstd -c -q; "
+            f"else {command} | gzip -c; fi"
+        )
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+class RemoteCommandStream:
+    """
+    Binary file-like object reading the output of a remote command by chunks,
+    so that it can be parsed while it is received, without being fully
+    stored in memory.
+
+    If the output has been compressed on the remote side (see compress_remote_command),
+    it is decompressed while it is read. The compression format (gzip or zstd) is
+    detected from the first bytes of the output.
+
+    Optionally, the (decompressed) bytes read are also written to a file (for audit
+    or replay). This file is first written at a temporary path and only moved to its
+    final path when the whole output has been read.
+    """
+
+    def __init__(self, ssh_stdout, tee_file_path=None, compression="none"):
+        self.ssh_stdout = ssh_stdout
+        self.tee_file_path = tee_file_path
+        self.compression = compression
+        # Number of (decompressed) bytes read from the remote command
+        self.nbr_bytes = 0
+        # Number of bytes received from the remote host
+        self.nbr_transferred_bytes = 0
+        self.start_time = time.time()
+        # Number of seconds between the opening and the closing
+        self.duration = None
+        self.eof = False
+        self._decompressor = None
+        # Whether the whole compressed output has been received
+        self._compressed_eof = False
+        # First compressed bytes, until the compression format is identified
+        self._header = b""
+        # Decompressed bytes which have not been read yet
+        self._pending = b""
+        self._tee_file = None
+        if tee_file_path:
+            self._tee_file = open(f"{tee_file_path}.tmp", "wb")
+
+    def read(self, size=-1):
+        if size == 0:
+            return b""
+        if self.compression == "none":
+            data = self.ssh_stdout.read(size)
+            self.nbr_transferred_bytes += len(data)
+            if size < 0 or not data:
+                self.eof = True
+        else:
+            data = self._read_decompressed(size)
+
+        self.nbr_bytes += len(data)
+        if self._tee_file is not None:
+            self._tee_file.write(data)
+        return data
+
+    def _read_decompressed(self, size):
+        # Decompress chunks until enough bytes are available
+        while not self._compressed_eof and (size < 0 or len(self._pending) < size):
+            chunk = self.ssh_stdout.read(COMPRESSED_CHUNK_SIZE)
+            self.nbr_transferred_bytes += len(chunk)
+            if not chunk:
+                self._compressed_eof = True
+            if self._decompressor is None:
+                # Wait for the first bytes, which identify the compression format
+                self._header += chunk
+                if len(self._header) < len(ZSTD_MAGIC) and chunk:
+                    continue
+                self._decompressor = self._get_decompressor(self._header)
+                chunk, self._header = self._header, b""
+            if chunk:
+                self._pending += self._decompressor.decompress(chunk)
+            else:
+                self._pending += self._decompressor.flush()
+
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        if not data:
+            self.eof = True
+        return data
+
+    @staticmethod
+    def _get_decompressor(chunk):
+        if chunk.startswith(GZIP_MAGIC):
+            # 16 + MAX_WBITS to read the gzip header
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if chunk.startswith(ZSTD_MAGIC):
+            assert (
+                zstandard is not None
+            ), "The zstandard package is required to read zstd outputs."
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError("The output of the remote command is not compressed.")
+
+    def drain(self, chunk_size=64 * 1024):
+        """
+        Read the remaining output of the command.
+        """
+        while not self.eof:
+            self.read(chunk_size)
+
+    def transfer_summary(self):
+        """
+        Describe the amount of data received, and how long it took.
+        """
+        duration = self.duration
+        if duration is None:
+            duration = time.time() - self.start_time
+        summary = f"{self.nbr_bytes} bytes"
+        if self.compression != "none":
+            summary += f" ({self.nbr_transferred_bytes} bytes transferred with compression {self.compression})"
+        return summary + f" in {duration:.2f} seconds"
+
+    def close(self):
+        """
+        Close the channel of the command (but not the SSH connection), and
+        move the copy of the output to its final path if it is complete.
+        """
+        if self.duration is None:
+            self.duration = time.time() - self.start_time
+        self.ssh_stdout.channel.close()
+        if self._tee_file is not None:
+            self._tee_file.close()
+            self._tee_file = None
+            if self.eof:
+                os.replace(f"{self.tee_file_path}.tmp", self.tee_file_path)
+            else:
+                os.remove(f"{self.tee_file_path}.tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
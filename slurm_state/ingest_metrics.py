@@ -0,0 +1,337 @@
+"""
+Instrumentation of the ingestion runs (main_read_report_and_update_collection).
+
+Each run measures the time spent in each of its stages, the operations it
+made and the peak memory of the process. At the end of the run, these metrics
+are appended as one JSON line to the file configured by
+"ingest_metrics.run_report_file", and written in the Prometheus text format
+(for the textfile collector of the node exporter) in the directory configured
+by "ingest_metrics.prometheus_textfile_dir". Both are disabled when empty.
+
+The stages are:
+    replay          Replay of the operations spooled by the previous runs, when
+                    MongoDB was unavailable (see slurm_state/spool.py)
+    generate        Generation of the report through SSH (sacct or sinfo). When the
+                    report is streamed, only the launch of the command
+    digest          Computation of the digest of the report, compared with the one of
+                    the last committed report (see the "skip_identical_reports" setting)
+    parse           Decoding and translation of the report. When the report is streamed,
+                    this includes waiting for the output of the command
+    filter          Selection of the jobs related to Mila (is_allocation_related_to_mila)
+    user_lookup     Retrieval of the users associated to the jobs
+    diff            Comparison of the entities of the report with the stored ones,
+                    and production of the database operations
+    bulk_write      Writing of the operations on the jobs or nodes
+    user_updates    Writing of the updates of the users
+    dump            Writing of the dump file
+    other           Remaining time of the run
+
+The stages can be nested: the time is always counted in the innermost
+active stage, so that the durations of the stages add up to the duration
+of the run.
+"""
+
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+from slurm_state.config import get_config, register_config, string
+
+# Path of the file to which a JSON line is appended after each run
+register_config("ingest_metrics.run_report_file", "", validator=string)
+# Directory in which a Prometheus textfile is written for each cluster and entity
+register_config("ingest_metrics.prometheus_textfile_dir", "", validator=string)
+
+INGEST_STAGES = [
+    "replay",
+    "generate",
+    "digest",
+    "parse",
+    "filter",
+    "user_lookup",
+    "diff",
+    "bulk_write",
+    "user_updates",
+    "dump",
+]
+
+# Several runs (of the scrape daemon for instance) can end at the same time
+_run_report_lock = threading.Lock()
+
+
+class IngestMetrics:
+    """
+    Durations of the stages and operation counts of an ingestion run.
+
+    Example:
+        metrics = IngestMetrics("jobs", "mila")
+        with metrics.stage("generate"):
+            generate_report(...)
+        for D_job in metrics.timed_iterator("parse", parser(f), count="parsed"):
+            ...
+        write_ingest_metrics(metrics.finish(success=True))
+    """
+
+    def __init__(self, entity, cluster_name, sacct_window=None):
+        self.entity = entity
+        self.cluster_name = cluster_name
+        self.sacct_window = sacct_window
+        self.timestamp_start = time.time()
+        self.D_durations = {stage: 0.0 for stage in INGEST_STAGES}
+        self.D_counts = {}
+        # Whether the report was identical to the last committed one,
+        # and has therefore not been processed
+        self.short_circuited = False
+        # State of the spool at the end of the run (see get_spool_stats),
+        # if the spool is enabled
+        self.spool = None
+
+        self._start = time.perf_counter()
+        # Stack of the active stages, the time is counted in the last one
+        self._L_stages = []
+        self._switch_time = self._start
+
+    def _switch(self):
+        """
+        Count the time elapsed since the last switch in the innermost active stage.
+        """
+        now = time.perf_counter()
+        if self._L_stages:
+            self.D_durations[self._L_stages[-1]] += now - self._switch_time
+        self._switch_time = now
+
+    def enter(self, stage):
+        self._switch()
+        self._L_stages.append(stage)
+
+    def exit(self):
+        self._switch()
+        self._L_stages.pop()
+
+    def stage(self, stage):
+        """
+        Return a context manager counting the time spent in its block in the stage.
+        """
+        return _Stage(self, stage)
+
+    def timed(self, stage, function):
+        """
+        Return a function calling the given one, counting the time it takes in the stage.
+        """
+
+        def timed_function(*args, **kwargs):
+            self.enter(stage)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+
+        return timed_function
+
+    def timed_iterator(self, stage, iterable, count=None):
+        """
+        Iterate over the iterable, counting the time taken to produce its
+        elements in the stage, and their number in the counter named count.
+        """
+        iterator = iter(iterable)
+        nbr_items = 0
+        try:
+            while True:
+                self.enter(stage)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.exit()
+                nbr_items += 1
+                yield item
+        finally:
+            if count is not None:
+                self.add_count(count, nbr_items)
+
+    def add_count(self, name, value=1):
+        self.D_counts[name] = self.D_counts.get(name, 0) + value
+
+    def finish(self, success, error=None):
+        """
+        Return the metrics of the run, as a JSON-serializable dictionary.
+        """
+        duration = time.perf_counter() - self._start
+        D_stages = dict(self.D_durations)
+        D_stages["other"] = max(0.0, duration - sum(self.D_durations.values()))
+        return {
+            "timestamp": self.timestamp_start,
+            "cluster_name": self.cluster_name,
+            "entity": self.entity,
+            "sacct_window": (
+                None if self.sacct_window is None else list(self.sacct_window)
+            ),
+            "success": success,
+            "error": error,
+            "short_circuited": self.short_circuited,
+            "duration": duration,
+            "stages": D_stages,
+            "counts": dict(self.D_counts),
+            "spool": self.spool,
+            "peak_rss_bytes": get_peak_rss_bytes(),
+        }
+
+
+class _Stage:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.metrics.enter(self.stage)
+
+    def __exit__(self, *args):
+        self.metrics.exit()
+
+
+class TimedWriter:
+    """
+    Wrap an updates writer (such as a BulkWriter), counting the time
+    spent in its "append" and "close" methods in a stage.
+    """
+
+    def __init__(self, writer, metrics, stage="bulk_write"):
+        self.writer = writer
+        self.metrics = metrics
+        self.stage = stage
+
+    def __len__(self):
+        return len(self.writer)
+
+    def append(self, operation):
+        self.metrics.enter(self.stage)
+        try:
+            self.writer.append(operation)
+        finally:
+            self.metrics.exit()
+
+    def close(self):
+        with self.metrics.stage(self.stage):
+            return self.writer.close()
+
+
+def get_peak_rss_bytes():
+    """
+    Return the peak resident memory of the process, in bytes. As it concerns
+    the whole process, it can come from a previous run of the same process.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+    if sys.platform == "darwin":
+        return peak_rss
+    return peak_rss * 1024
+
+
+def format_prometheus_metrics(D_run):
+    """
+    Return the metrics of a run in the Prometheus text format.
+    """
+    labels = f'cluster="{D_run["cluster_name"]}",entity="{D_run["entity"]}"'
+    L_lines = []
+
+    def add_metric(name, help, L_values):
+        L_lines.append(f"# HELP {name} {help}")
+        L_lines.append(f"# TYPE {name} gauge")
+        for extra_labels, value in L_values:
+            L_lines.append(f"{name}{{{labels}{extra_labels}}} {value}")
+
+    add_metric(
+        "clockwork_ingest_last_run_timestamp_seconds",
+        "Beginning of the last ingestion run.",
+        [("", D_run["timestamp"])],
+    )
+    add_metric(
+        "clockwork_ingest_success",
+        "Whether the last ingestion run succeeded.",
+        [("", int(D_run["success"]))],
+    )
+    add_metric(
+        "clockwork_ingest_short_circuited",
+        "Whether the report of the last ingestion run was identical to the previous one.",
+        [("", int(D_run["short_circuited"]))],
+    )
+    add_metric(
+        "clockwork_ingest_duration_seconds",
+        "Duration of the last ingestion run.",
+        [("", D_run["duration"])],
+    )
+    add_metric(
+        "clockwork_ingest_stage_seconds",
+        "Time spent in each stage of the last ingestion run.",
+        [
+            (f',stage="{stage}"', duration)
+            for stage, duration in D_run["stages"].items()
+        ],
+    )
+    add_metric(
+        "clockwork_ingest_operations",
+        "Operation counts of the last ingestion run.",
+        [
+            (f',operation="{re.sub("[^a-zA-Z0-9_]", "_", name)}"', value)
+            for name, value in D_run["counts"].items()
+        ],
+    )
+    if D_run["spool"] is not None:
+        add_metric(
+            "clockwork_ingest_spool_segments",
+            "Number of spooled segments waiting to be replayed.",
+            [("", D_run["spool"]["nbr_segments"])],
+        )
+        add_metric(
+            "clockwork_ingest_spool_bytes",
+            "Size of the spooled segments waiting to be replayed.",
+            [("", D_run["spool"]["size_bytes"])],
+        )
+        add_metric(
+            "clockwork_ingest_spool_age_seconds",
+            "Age of the oldest spooled segment waiting to be replayed.",
+            [("", D_run["spool"]["oldest_age"] or 0)],
+        )
+    add_metric(
+        "clockwork_ingest_peak_rss_bytes",
+        "Peak resident memory of the ingestion process.",
+        [("", D_run["peak_rss_bytes"])],
+    )
+    return "\n".join(L_lines) + "\n"
+
+
+def write_ingest_metrics(D_run):
+    """
+    Append the metrics of a run to the run report file, and write them in
+    the Prometheus textfile of the cluster and entity, if configured.
+
+    The metrics are only informative: failing to write them is reported,
+    but does not make the run fail.
+    """
+    run_report_file = get_config("ingest_metrics.run_report_file")
+    prometheus_textfile_dir = get_config("ingest_metrics.prometheus_textfile_dir")
+
+    try:
+        if run_report_file:
+            line = json.dumps(D_run, separators=(",", ":")) + "\n"
+            with _run_report_lock:
+                with open(run_report_file, "a") as f:
+                    f.write(line)
+
+        if prometheus_textfile_dir:
+            textfile = os.path.join(
+                prometheus_textfile_dir,
+                f"clockwork_ingest_{D_run['cluster_name']}_{D_run['entity']}.prom",
+            )
+            # The textfile collector could read a partially written file
+            tmp_file = f"{textfile}.tmp.{threading.get_ident()}"
+            with open(tmp_file, "w") as f:
+                f.write(format_prometheus_metrics(D_run))
+            os.replace(tmp_file, textfile)
+    except OSError as e:
+        print(f"Error. Failed to write the ingestion metrics: {e}")
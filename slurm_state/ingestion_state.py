@@ -0,0 +1,399 @@
+"""
+State of the ingestion of the Slurm reports, stored in the database
+next to the jobs and nodes, so that it is shared by all the runs.
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo.errors import DuplicateKeyError
+
+# Name of the collection storing the ingestion state of the clusters
+INGESTION_STATE_COLLECTION = "ingestion_state"
+
+# Duration, in seconds, of the sacct window requested when no watermark
+# is stored for a cluster (this was the fixed window before the watermarks)
+SACCT_INITIAL_WINDOW = 600
+
+# Number of seconds between two attempts to acquire an ingestion lease
+# held by another run
+INGESTION_LEASE_POLL_INTERVAL = 5
+
+
+def get_ingestion_state_collection(collection):
+    """
+    Return the collection storing the ingestion state, in the same database
+    as the given collection (usually the jobs collection).
+    """
+    return collection.database[INGESTION_STATE_COLLECTION]
+
+
+def get_sacct_watermark(state_collection, cluster_name):
+    """
+    Return the end of the last sacct window whose jobs have been committed
+    to the database for the cluster, as a timestamp, or None if there is none.
+    """
+    D_state = state_collection.find_one(
+        {"_id": f"sacct_watermark:{cluster_name}"}, {"watermark": 1}
+    )
+    if D_state is None:
+        return None
+    return D_state["watermark"]
+
+
+def set_sacct_watermark(state_collection, cluster_name, watermark):
+    """
+    Store the end of the last sacct window committed for the cluster.
+
+    The watermark is never moved backwards, so that a slow run overlapping
+    a more recent one does not make the next runs request old data again.
+    """
+    state_collection.update_one(
+        {"_id": f"sacct_watermark:{cluster_name}"},
+        {
+            "$max": {"watermark": watermark},
+            "$set": {"cluster_name": cluster_name},
+        },
+        upsert=True,
+    )
+
+
+def get_sacct_windows(watermark, now, overlap, max_window):
+    """
+    Split the time range which has not been retrieved yet into sacct windows.
+
+    Parameters:
+        watermark   End of the last committed window, or None if there is none
+        now         Timestamp of the end of the last window
+        overlap     Number of seconds before the watermark included in the first
+                    window, in order to catch the jobs recorded late by Slurm
+        max_window  Maximum duration, in seconds, of a window. Long gaps (after
+                    an outage for instance) are retrieved through several windows
+
+    Returns:
+        A list of (start, end) timestamps, in chronological order
+    """
+    assert max_window > 0
+
+    if watermark is None:
+        return [(now - SACCT_INITIAL_WINDOW, now)]
+
+    start = min(watermark - overlap, now)
+    L_windows = []
+    while True:
+        end = min(start + max_window, now)
+        L_windows.append((start, end))
+        if end >= now:
+            return L_windows
+        start = end
+
+
+def get_time_slices(start, end, slice_duration):
+    """
+    Split a time range into consecutive slices.
+
+    Parameters:
+        start           Timestamp of the beginning of the range
+        end             Timestamp of the end of the range
+        slice_duration  Duration of the slices, in seconds. The last one could be shorter
+
+    Returns:
+        A list of (start, end) timestamps, in chronological order
+    """
+    assert slice_duration > 0
+    L_slices = []
+    while start < end:
+        L_slices.append((start, min(start + slice_duration, end)))
+        start += slice_duration
+    return L_slices
+
+
+def get_completed_backfill_slices(state_collection, cluster_name):
+    """
+    Return the set of the (start, end) sacct slices whose jobs have been
+    committed to the database by a backfill of the cluster.
+    """
+    return set(
+        (D_slice["start"], D_slice["end"])
+        for D_slice in state_collection.find(
+            {"kind": "backfill_slice", "cluster_name": cluster_name},
+            {"start": 1, "end": 1},
+        )
+    )
+
+
+def mark_backfill_slice_completed(state_collection, cluster_name, time_slice, now):
+    """
+    Record that the jobs of a sacct slice have been committed to the database,
+    so that an interrupted backfill does not retrieve them again.
+    """
+    start, end = time_slice
+    state_collection.update_one(
+        {"_id": f"backfill_slice:{cluster_name}:{start}:{end}"},
+        {
+            "$set": {
+                "kind": "backfill_slice",
+                "cluster_name": cluster_name,
+                "start": start,
+                "end": end,
+                "completed_at": now,
+            }
+        },
+        upsert=True,
+    )
+
+
+def get_last_report_state(state_collection, cluster_name, entity):
+    """
+    Return the state of the last report of jobs or nodes committed to the
+    database for the cluster, or None if there is none. Its fields are:
+        digest          Digest of the report
+        committed_at    Time at which the report has been committed
+        checked_at      Last time at which the report was found to be up to date
+        updated_since   Time from which the cw.last_slurm_update timestamps of the
+                        entities of the report have been last set
+    """
+    return state_collection.find_one({"_id": f"report_digest:{cluster_name}:{entity}"})
+
+
+def get_last_report_digest(state_collection, cluster_name, entity):
+    """
+    Return the digest of the last report of jobs or nodes committed to the
+    database for the cluster, or None if there is none.
+    """
+    D_state = get_last_report_state(state_collection, cluster_name, entity)
+    if D_state is None:
+        return None
+    return D_state["digest"]
+
+
+def set_last_report_digest(
+    state_collection, cluster_name, entity, digest, now, updated_since=None
+):
+    """
+    Store the digest of the last report of jobs or nodes committed for the cluster,
+    along with the time from which its entities have been written (updated_since,
+    which is now by default).
+    """
+    state_collection.update_one(
+        {"_id": f"report_digest:{cluster_name}:{entity}"},
+        {
+            "$set": {
+                "cluster_name": cluster_name,
+                "entity": entity,
+                "digest": digest,
+                "committed_at": now,
+                "checked_at": now,
+                "updated_since": now if updated_since is None else updated_since,
+            }
+        },
+        upsert=True,
+    )
+
+
+def touch_last_report_digest(state_collection, cluster_name, entity, now):
+    """
+    Record that the last committed report of jobs or nodes of the cluster
+    was still up to date at the given time, at which the timestamps of its
+    entities have been updated.
+    """
+    state_collection.update_one(
+        {"_id": f"report_digest:{cluster_name}:{entity}"},
+        {"$set": {"checked_at": now, "updated_since": now}},
+    )
+
+
+def get_ingestion_lease(state_collection, cluster_name, entity):
+    """
+    Return the lease of the ingestion of the jobs or nodes of the cluster
+    (with its owner and its expiry), or None if it has never been acquired.
+    """
+    return state_collection.find_one(
+        {"_id": f"ingestion_lease:{cluster_name}:{entity}"}
+    )
+
+
+def acquire_ingestion_lease(
+    state_collection, cluster_name, entity, owner, duration, now
+):
+    """
+    Acquire the lease of the ingestion of the jobs or nodes of the cluster
+    for the given owner, if it is free, expired, or already held by this owner.
+
+    The lease document is only updated if the lease can be acquired. Otherwise,
+    the upsert tries to insert a second document with the same _id, which fails:
+    the acquisition is atomic.
+
+    Returns:
+        True if the lease has been acquired, False if it is held by another owner
+    """
+    try:
+        state_collection.update_one(
+            {
+                "_id": f"ingestion_lease:{cluster_name}:{entity}",
+                "$or": [{"expires_at": {"$lte": now}}, {"owner": owner}],
+            },
+            {
+                "$set": {
+                    "kind": "ingestion_lease",
+                    "cluster_name": cluster_name,
+                    "entity": entity,
+                    "owner": owner,
+                    "acquired_at": now,
+                    "expires_at": now + duration,
+                }
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def renew_ingestion_lease(state_collection, cluster_name, entity, owner, duration, now):
+    """
+    Extend the lease of the ingestion of the jobs or nodes of the cluster.
+
+    Returns:
+        True if the lease is still held by the owner, False if it has been lost
+        (because it expired and has been acquired by another run)
+    """
+    result = state_collection.update_one(
+        {"_id": f"ingestion_lease:{cluster_name}:{entity}", "owner": owner},
+        {"$set": {"expires_at": now + duration}},
+    )
+    return result.matched_count == 1
+
+
+def release_ingestion_lease(state_collection, cluster_name, entity, owner):
+    """
+    Release the lease of the ingestion of the jobs or nodes of the cluster,
+    if it is still held by the owner.
+    """
+    state_collection.delete_one(
+        {"_id": f"ingestion_lease:{cluster_name}:{entity}", "owner": owner}
+    )
+
+
+class IngestionLeaseHeld(Exception):
+    """
+    Raised when a run does not start because the ingestion lease of the
+    cluster and entity is held by another run.
+    """
+
+
+class IngestionLeaseLost(Exception):
+    """
+    Raised when a run stops writing because its ingestion lease has been
+    acquired by another run.
+    """
+
+
+class IngestionLease:
+    """
+    Lease preventing two runs from ingesting the jobs or the nodes of the same
+    cluster at the same time. Once acquired, it is renewed by a background thread
+    every third of its duration, until it is released. If the process dies,
+    the lease expires after its duration.
+
+    Example:
+        lease = IngestionLease(state_collection, "mila", "jobs", duration=300)
+        if lease.acquire(wait=60):
+            try:
+                ...
+            finally:
+                lease.release()
+    """
+
+    def __init__(self, state_collection, cluster_name, entity, duration):
+        assert duration > 0
+        self.state_collection = state_collection
+        self.cluster_name = cluster_name
+        self.entity = entity
+        self.duration = duration
+        # Identifier of this run, stored in the lease document
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        # Whether the lease has been acquired by another run before being released
+        self.lost = False
+
+        self._stop_renewal = threading.Event()
+        self._renewal_thread = None
+
+    def acquire(self, wait=0):
+        """
+        Try to acquire the lease during at most wait seconds.
+
+        Returns:
+            True if the lease has been acquired, False otherwise
+        """
+        deadline = time.time() + wait
+        while not acquire_ingestion_lease(
+            self.state_collection,
+            self.cluster_name,
+            self.entity,
+            self.owner,
+            self.duration,
+            time.time(),
+        ):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(INGESTION_LEASE_POLL_INTERVAL, remaining))
+
+        self._renewal_thread = threading.Thread(
+            target=self._renew_periodically, daemon=True
+        )
+        self._renewal_thread.start()
+        return True
+
+    def check(self):
+        """
+        Raise an IngestionLeaseLost if the lease has been lost, so that the
+        writes stop before they overwrite the ones of the other run.
+        """
+        if self.lost:
+            raise IngestionLeaseLost(
+                f"The {self.entity} ingestion lease of the {self.cluster_name} cluster has been lost."
+            )
+
+    def _renew_periodically(self):
+        while not self._stop_renewal.wait(self.duration / 3):
+            try:
+                renewed = renew_ingestion_lease(
+                    self.state_collection,
+                    self.cluster_name,
+                    self.entity,
+                    self.owner,
+                    self.duration,
+                    time.time(),
+                )
+            except Exception as inst:
+                # The next renewal could succeed before the lease expires
+                print(
+                    f"Error. Failed to renew the {self.entity} ingestion lease of the {self.cluster_name} cluster: {inst}"
+                )
+                continue
+            if not renewed:
+                self.lost = True
+                print(
+                    f"Error. The {self.entity} ingestion lease of the {self.cluster_name} cluster has been lost."
+                )
+                return
+
+    def release(self):
+        self._stop_renewal.set()
+        if self._renewal_thread is not None:
+            self._renewal_thread.join()
+            self._renewal_thread = None
+        try:
+            release_ingestion_lease(
+                self.state_collection, self.cluster_name, self.entity, self.owner
+            )
+        except Exception as inst:
+            # The lease expires anyway
+            print(
+                f"Error. Failed to release the {self.entity} ingestion lease of the {self.cluster_name} cluster: {inst}"
+            )
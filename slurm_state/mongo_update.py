@@ -2,8 +2,10 @@
 Insert elements extracted from the Slurm reports into the database.
 """
 
-import copy, json, os, time
-from pymongo import InsertOne, ReplaceOne, UpdateOne
+import copy, hashlib, json, os, threading, time
+from functools import partial
+from pymongo import InsertOne, UpdateOne, UpdateMany
+from pymongo.errors import ConnectionFailure
 
 from slurm_state.config import get_config, boolean, integer, string, optional_string
 from slurm_state.extra_filters import (
@@ -11,9 +13,36 @@ from slurm_state.extra_filters import (
     clusters_valid,
 )
 from slurm_state.helpers.gpu_helper import get_cw_gres_description
+from slurm_state.helpers.json_codec import get_json_codec
+from slurm_state.helpers.dump_file import open_dump_writer
+from slurm_state.bulk_writer import BulkWriter
+from slurm_state.ingest_metrics import IngestMetrics, TimedWriter, write_ingest_metrics
+from slurm_state.ingestion_state import (
+    get_ingestion_state_collection,
+    get_sacct_watermark,
+    set_sacct_watermark,
+    get_sacct_windows,
+    get_last_report_state,
+    set_last_report_digest,
+    touch_last_report_digest,
+    get_ingestion_lease,
+    IngestionLease,
+    IngestionLeaseHeld,
+)
 
-from slurm_state.sinfo_parser import node_parser, generate_node_report
-from slurm_state.sacct_parser import job_parser, generate_job_report
+from slurm_state.spool import (
+    SpoolSegment,
+    get_spool_dir,
+    get_spool_stats,
+    replay_spool,
+    spool_report,
+)
+from slurm_state.sinfo_parser import node_parser, generate_node_report, open_node_report
+from slurm_state.sacct_parser import (
+    get_job_parser,
+    generate_job_report,
+    open_job_report,
+)
 
 
 # Used to retrieve clusters data from configuration file
@@ -23,6 +52,52 @@ clusters_valid.add_field("remote_user", optional_string)
 clusters_valid.add_field("remote_hostname", optional_string)
 clusters_valid.add_field("ssh_port", integer)
 clusters_valid.add_field("sacct_enabled", boolean)
+# Whether the timestamps of the jobs which did not change since the previous report
+# are updated (True) or the jobs are not written at all (False)
+clusters_valid.add_field("touch_unchanged_jobs", boolean, default=True)
+# Same for the nodes, whose timestamps are then updated with one UpdateMany
+clusters_valid.add_field("touch_unchanged_nodes", boolean, default=True)
+# Whether the output of sacct and sinfo is parsed while it is received (True)
+# or first written to the report file and then parsed (False)
+clusters_valid.add_field("stream_reports", boolean, default=False)
+# Whether the jobs are retrieved from the end of the last committed sacct window
+# (the watermark stored in the database) instead of the last 600 seconds
+clusters_valid.add_field("sacct_incremental", boolean, default=False)
+# Number of seconds before the watermark which are requested again, in order
+# to retrieve the jobs recorded late by Slurm
+clusters_valid.add_field("sacct_window_overlap", integer, default=60)
+# Maximum duration, in seconds, of a sacct window. Longer gaps are split
+clusters_valid.add_field("sacct_max_window", integer, default=3600)
+# Number of consecutive sinfo reports from which a node must be missing
+# to be marked as missing (with cw.missing_since)
+clusters_valid.add_field("nbr_reports_before_node_missing", integer, default=3)
+# Whether a report file identical to the last committed one (of the same cluster
+# and entity) is skipped instead of being processed again
+clusters_valid.add_field("skip_identical_reports", boolean, default=False)
+# Duration, in seconds, of the lease preventing two runs from ingesting the jobs
+# (or the nodes) of the cluster at the same time. It is renewed while the run
+# goes on, and expires if the run dies. 0 disables the lease
+clusters_valid.add_field("ingestion_lease_duration", integer, default=300)
+# Maximum number of seconds a run waits for the lease held by another run,
+# before giving up
+clusters_valid.add_field("ingestion_lease_wait", integer, default=0)
+
+
+# Number of job IDs in each query retrieving the jobs of a report from the database
+JOB_IDS_QUERY_CHUNK_SIZE = 1000
+
+# Number of seconds during which a username associated to no user is not
+# queried again, so that the users added in the meantime are eventually found
+USER_ACCOUNT_MISS_TTL = 600
+
+# Fields of the stored jobs which are needed to merge them with the jobs of a report
+JOB_MERGE_PROJECTION = {"_id": 1, "slurm": 1, "cw": 1, "user": 1}
+
+# Fields of the stored nodes which are needed to compare them with the nodes of a report
+NODE_MERGE_PROJECTION = {"_id": 1, "slurm": 1, "cw": 1}
+
+# Size of the chunks read to compute the digest of a report file
+REPORT_DIGEST_CHUNK_SIZE = 1024 * 1024
 
 
 def pprint_bulk_result(result):
@@ -40,13 +115,22 @@ def fetch_slurm_report(parser, cluster_name, report_path):
 
     assert os.path.exists(report_path), f"The report path {report_path} is missing."
 
+    with open(report_path, "r") as f:
+        yield from fetch_slurm_report_stream(parser, cluster_name, f)
+
+
+def fetch_slurm_report_stream(parser, cluster_name, report_stream):
+    """
+    Similar to fetch_slurm_report, but reads the report from a file-like
+    object, such as the output of a remote sacct or sinfo command.
+    """
+
     ctx = get_config("clusters").get(cluster_name, None)
     assert ctx is not None, f"{cluster_name} not configured"
 
-    with open(report_path, "r") as f:
-        for e in parser(f):
-            e["cluster_name"] = cluster_name
-            yield e
+    for e in parser(report_stream):
+        e["cluster_name"] = cluster_name
+        yield e
 
 
 def slurm_job_to_clockwork_job(slurm_job: dict):
@@ -98,25 +182,130 @@ def slurm_node_to_clockwork_node(slurm_node: dict):
     return clockwork_node
 
 
-def lookup_user_account(users_collection):
+class UserAccountCache:
+    """
+    Associations between the usernames on the clusters and the
+    "mila_email_username" of the users, retrieved from the users collection.
+
+    The associations are indexed by account field (for instance
+    "mila_cluster_username" or "cc_account_username"), so that they are
+    shared between the clusters using the same account field. An instance
+    is meant to be reused during a whole run, in order to query the users
+    collection only once for each username. The usernames associated to no
+    user are queried again once they are older than miss_ttl seconds.
+
+    An instance can be shared between threads.
     """
-    Mutates the argument in order to fill in the
-    field for "cw" pertaining to the user account.
-    Returns the mutated value to facilitate a `map` call.
+
+    def __init__(self, miss_ttl=USER_ACCOUNT_MISS_TTL):
+        # format: {account_field: {cluster_username: mila_email_username}}
+        self.DD_mila_email_usernames = {}
+        # format: {account_field: {cluster_username: timestamp of the query}}
+        # for the usernames associated to no user
+        self.DD_miss_timestamps = {}
+        self.miss_ttl = miss_ttl
+        # Statistics displayed in the ingest output
+        self.nbr_queries = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def resolve(self, users_collection, account_field, cluster_usernames):
+        """
+        Retrieve the "mila_email_username" associated to each cluster username,
+        querying the users collection only for the usernames which are not
+        already known.
+
+        Parameters:
+            users_collection    Collection of the users in the database
+            account_field       Field of the users containing their username on the cluster
+            cluster_usernames   Iterable of usernames on the cluster
+
+        Returns:
+            A dictionary {cluster_username: mila_email_username} containing
+            the requested usernames. The value is None when no user has been found.
+        """
+        S_cluster_usernames = set(cluster_usernames)
+        # The lock also prevents the threads from querying the same usernames
+        with self._lock:
+            D_mila_email_usernames = self.DD_mila_email_usernames.setdefault(
+                account_field, {}
+            )
+            D_miss_timestamps = self.DD_miss_timestamps.setdefault(account_field, {})
+            timestamp_start = time.time()
+            L_missing_usernames = [
+                cluster_username
+                for cluster_username in S_cluster_usernames
+                if cluster_username not in D_mila_email_usernames
+                and timestamp_start - D_miss_timestamps.get(cluster_username, -1e100)
+                > self.miss_ttl
+            ]
+
+            if L_missing_usernames:
+                # Resolve all the missing usernames with only one query
+                for D_user in users_collection.find(
+                    {account_field: {"$in": L_missing_usernames}},
+                    {"_id": 0, account_field: 1, "mila_email_username": 1},
+                ):
+                    # If several users share the same account, keep the first one
+                    if D_user[account_field] not in D_mila_email_usernames:
+                        D_mila_email_usernames[D_user[account_field]] = D_user[
+                            "mila_email_username"
+                        ]
+                        D_miss_timestamps.pop(D_user[account_field], None)
+                # Remember when the usernames which have not been found were queried
+                for cluster_username in L_missing_usernames:
+                    if cluster_username not in D_mila_email_usernames:
+                        D_miss_timestamps[cluster_username] = timestamp_start
+
+                self.nbr_queries += 1
+                self.duration += time.time() - timestamp_start
+
+            return {
+                cluster_username: D_mila_email_usernames.get(cluster_username)
+                for cluster_username in S_cluster_usernames
+            }
+
+
+def lookup_user_accounts(LD_clockwork_jobs, users_collection, user_account_cache):
     """
+    Mutates the jobs in order to fill in the field for "cw"
+    pertaining to the user account.
 
-    def _lookup_user_account(clockwork_job: dict[dict]):
-        cluster_name = clockwork_job["slurm"]["cluster_name"]
-        cluster_username = clockwork_job["slurm"]["username"]
+    The usernames are resolved in batch: the users collection is queried
+    once for each account field, with the distinct usernames of the jobs
+    that are not already known by the cache.
+
+    Parameters:
+        LD_clockwork_jobs   List of Clockwork jobs
+        users_collection    Collection of the users in the database
+        user_account_cache  UserAccountCache storing the already resolved usernames
 
-        account_field = get_config("clusters")[cluster_name]["account_field"]
-        result = users_collection.find_one({account_field: cluster_username})
-        if result is not None:
-            clockwork_job["cw"]["mila_email_username"] = result["mila_email_username"]
+    Returns the list of mutated jobs.
+    """
+    clusters = get_config("clusters")
 
-        return clockwork_job
+    # Group the jobs by the account field of their cluster
+    DL_jobs_by_account_field = {}
+    for clockwork_job in LD_clockwork_jobs:
+        account_field = clusters[clockwork_job["slurm"]["cluster_name"]][
+            "account_field"
+        ]
+        DL_jobs_by_account_field.setdefault(account_field, []).append(clockwork_job)
+
+    for account_field, L_jobs in DL_jobs_by_account_field.items():
+        D_mila_email_usernames = user_account_cache.resolve(
+            users_collection,
+            account_field,
+            (clockwork_job["slurm"]["username"] for clockwork_job in L_jobs),
+        )
+        for clockwork_job in L_jobs:
+            mila_email_username = D_mila_email_usernames[
+                clockwork_job["slurm"]["username"]
+            ]
+            if mila_email_username is not None:
+                clockwork_job["cw"]["mila_email_username"] = mila_email_username
 
-    return _lookup_user_account
+    return LD_clockwork_jobs
 
 
 def main_read_report_and_update_collection(
@@ -128,11 +317,20 @@ def main_read_report_and_update_collection(
     from_file=False,
     want_commit_to_db=True,
     dump_file="",
+    user_account_cache=None,
+    sacct_window=None,
+    use_lease=True,
+    lease=None,
+    use_spool=True,
 ):
     """
     Create a Clockwork jobs or nodes list from a sacct report file and store it into
     the database and/or a dump file, according to what is requested by the parameters.
 
+    If the "sacct_incremental" setting of the cluster is true and a new jobs report is
+    requested, the jobs are retrieved through the sacct windows following the watermark
+    of the cluster (see main_read_jobs_by_sacct_windows).
+
     Parameters:
         entity              String which could be "jobs" or "nodes": define which entity we are handling
         collection          Collection of the jobs or nodes in the database
@@ -141,23 +339,230 @@ def main_read_report_and_update_collection(
         report_file_path    Path to the report from which the jobs or nodes information is extracted. This report is generated through
                             the command sacct for the jobs, or sinfo for the nodes. If None, a new report is generated.
         from_file           Boolean indicating whether or not the jobs or nodes are extracted from a Slurm file. If True, the input file
-                            is report_file_path. If False, the file is generated at the report_file_path path.
+                            is report_file_path. If False, the file is generated at the report_file_path path. If the
+                            "stream_reports" setting of the cluster is true, the output of the command is parsed while it is
+                            received, and copied at the report_file_path path if it is not None.
         want_commit_to_db   Boolean indicating whether or not the jobs or nodes are stored in the database. Default is True
         dump_file           String containing the path to the file in which we want to dump the data. Default is "", which means nothing is stored in an output file
+        user_account_cache  UserAccountCache used to retrieve the users associated to the jobs. It can be shared
+                            between several calls during a run. Default is None, which means a new cache is used
+        sacct_window        Tuple (start, end) of timestamps delimiting the jobs to retrieve through sacct. Default is
+                            None, which means the sacct window is determined by the settings of the cluster
+        use_lease           Boolean indicating whether or not the ingestion lease of the cluster and entity is acquired
+                            before committing to the database. Default is True. It is False when the caller already
+                            holds the lease, or ingests distinct sacct windows concurrently on purpose (backfill)
+        lease               IngestionLease held by the caller, if any. Default is None
+        use_spool           Boolean indicating whether or not the spool of the cluster and entity is replayed, and
+                            filled if the database is unavailable. Default is True. It is False for the runs which
+                            do not hold the ingestion lease on purpose (backfill), since the spool must be replayed
+                            by one run at a time, after the previous ones
+
+    The duration of each stage of the run and its operation counts are recorded
+    and written according to the "ingest_metrics" settings (see slurm_state.ingest_metrics).
+
+    If the "spool.directory" setting is set, the operations which cannot be written
+    because the database is unavailable are kept in a local spool, which is replayed
+    at the beginning of the next run (see slurm_state.spool). If the database cannot
+    be read, the report itself is spooled, and processed by the next run.
+
+    Unless use_lease is False, a run committing to the database first acquires the ingestion
+    lease of the cluster and entity (see the "ingestion_lease_duration" and "ingestion_lease_wait"
+    settings), so that two runs never diff and write the same entities at the same time. If the
+    lease is held by another run, an IngestionLeaseHeld is raised. If the lease is lost during
+    the run, the writes stop before the next batch with an IngestionLeaseLost.
+
+    Returns:
+        True if the report has been retrieved and processed, False if it could not be retrieved
+        from the cluster while a sacct window was requested, or if some of its operations could not
+        be written to the database (write errors)
+    """
+    # Check the input parameters
+    assert entity in ["jobs", "nodes"]
+
+    # Retrieve clusters data from the configuration file
+    clusters = get_config("clusters")
+    assert cluster_name in clusters
+
+    if (
+        use_lease
+        and lease is None
+        and want_commit_to_db
+        and clusters[cluster_name]["ingestion_lease_duration"] > 0
+    ):
+        state_collection = get_ingestion_state_collection(collection)
+        lease = IngestionLease(
+            state_collection,
+            cluster_name,
+            entity,
+            clusters[cluster_name]["ingestion_lease_duration"],
+        )
+        timestamp_lease_request = time.time()
+        try:
+            lease_acquired = lease.acquire(
+                wait=clusters[cluster_name]["ingestion_lease_wait"]
+            )
+        except ConnectionFailure as inst:
+            if not use_spool or get_spool_dir(cluster_name, entity) is None:
+                raise
+            # The database is unavailable: the report is retrieved and
+            # spooled without the lease (see slurm_state.spool)
+            print(
+                f"Error. Failed to acquire the {entity} ingestion lease of the {cluster_name} cluster, "
+                f"proceed without it: {inst}"
+            )
+            lease, lease_acquired = None, True
+        if not lease_acquired:
+            D_lease = get_ingestion_lease(state_collection, cluster_name, entity) or {}
+            message = (
+                f"The {entity} of the {cluster_name} cluster are being ingested by another run "
+                f"({D_lease.get('owner')}, lease expiring at {D_lease.get('expires_at')})."
+            )
+            # The skipped run appears in the run reports
+            write_ingest_metrics(
+                IngestMetrics(entity, cluster_name, sacct_window=sacct_window).finish(
+                    False, error=f"IngestionLeaseHeld: {message}"
+                )
+            )
+            raise IngestionLeaseHeld(message)
+        if lease is not None:
+            lease_wait_duration = time.time() - timestamp_lease_request
+            if lease_wait_duration >= 1:
+                print(
+                    f"Waited {lease_wait_duration} seconds for the {entity} ingestion lease of the {cluster_name} cluster."
+                )
+            try:
+                return main_read_report_and_update_collection(
+                    entity,
+                    collection,
+                    users_collection,
+                    cluster_name,
+                    report_file_path,
+                    from_file=from_file,
+                    want_commit_to_db=want_commit_to_db,
+                    dump_file=dump_file,
+                    user_account_cache=user_account_cache,
+                    sacct_window=sacct_window,
+                    lease=lease,
+                    use_spool=use_spool,
+                )
+            finally:
+                lease.release()
+                if lease.lost:
+                    print(
+                        f"Error. Another run may have ingested the {entity} of the {cluster_name} cluster at the same time."
+                    )
+
+    if (
+        entity == "jobs"
+        and not from_file
+        and sacct_window is None
+        and clusters[cluster_name]["sacct_incremental"]
+    ):
+        return main_read_jobs_by_sacct_windows(
+            collection,
+            users_collection,
+            cluster_name,
+            report_file_path,
+            want_commit_to_db=want_commit_to_db,
+            dump_file=dump_file,
+            user_account_cache=user_account_cache,
+            lease=lease,
+            use_spool=use_spool,
+        )
+
+    metrics = IngestMetrics(entity, cluster_name, sacct_window=sacct_window)
+    spool = None
+    success = False
+    error = None
+    try:
+        if (
+            want_commit_to_db
+            and use_spool
+            and get_spool_dir(cluster_name, entity) is not None
+        ):
+            spool = SpoolSegment(cluster_name, entity)
+        try:
+            success = read_report_and_update_collection(
+                entity,
+                collection,
+                users_collection,
+                cluster_name,
+                report_file_path,
+                metrics,
+                from_file=from_file,
+                want_commit_to_db=want_commit_to_db,
+                dump_file=dump_file,
+                user_account_cache=user_account_cache,
+                sacct_window=sacct_window,
+                spool=spool,
+                lease=lease,
+            )
+        except ConnectionFailure as inst:
+            if (
+                spool is None
+                or not report_file_path
+                or not os.path.exists(report_file_path)
+            ):
+                raise
+            # The report has been retrieved, but not fully processed. It is
+            # spooled after the operations of this run, and processed again
+            # from the beginning when the spool is replayed
+            print(f"Error. The database is unavailable: {inst}")
+            spool_retrieved_report(cluster_name, entity, report_file_path, metrics)
+            success = True
+        return success
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if spool is not None:
+            # Make the spooled operations of this run available to the next one
+            spool.close()
+            metrics.spool = get_spool_stats(cluster_name, entity)
+        write_ingest_metrics(metrics.finish(success, error=error))
+
+
+def read_report_and_update_collection(
+    entity,
+    collection,
+    users_collection,
+    cluster_name,
+    report_file_path,
+    metrics,
+    from_file=False,
+    want_commit_to_db=True,
+    dump_file="",
+    user_account_cache=None,
+    sacct_window=None,
+    spool=None,
+    lease=None,
+):
+    """
+    Retrieve a jobs or nodes report and store its entities, as described in
+    main_read_report_and_update_collection, recording the duration of the stages
+    and the operation counts in metrics (an IngestMetrics). If spool (a SpoolSegment)
+    is given, the operations which cannot be written to the database are spooled.
+    If lease (an IngestionLease) is given, it is checked before each batch of writes.
     """
     # Initialize the time of this operation's beginning
     timestamp_start = time.time()
 
-    # Check the input parameters
-    assert entity in ["jobs", "nodes"]
+    clusters = get_config("clusters")
 
     if entity == "jobs":
         id_key = (
             "job_id"  # The id_key is used to determine how to retrieve the ID of a job
         )
-        parser = job_parser  # This parser is used to retrieve and format useful information from a sacct job
+        parser = get_job_parser(
+            cluster_name
+        )  # This parser is used to retrieve and format useful information from a sacct job
         from_slurm_to_clockwork = slurm_job_to_clockwork_job  # This function is used to translate a Slurm job (created through the parser) to a Clockwork job
-        generate_report = generate_job_report  # This function is used to generate the file gathering the job information which will be explained later
+        generate_report = partial(
+            generate_job_report, window=sacct_window
+        )  # This function is used to generate the file gathering the job information which will be explained later
+        open_report = partial(
+            open_job_report, window=sacct_window
+        )  # This function is used to stream the job information while it is retrieved
     elif entity == "nodes":
         id_key = (
             "name"  # The id_key is used to determine how to retrieve the ID of a node
@@ -165,57 +570,266 @@ def main_read_report_and_update_collection(
         parser = node_parser  # This parser is used to retrieve and format useful information from a sacct node
         from_slurm_to_clockwork = slurm_node_to_clockwork_node  # This function is used to translate a Slurm node (created through the parser) to a Clockwork node
         generate_report = generate_node_report  # This function is used to generate the file gathering the node information which will be explained later
+        open_report = open_node_report  # This function is used to stream the node information while it is retrieved
     else:
         # Raise an error because it should not happen
         raise ValueError(
             f'Incorrect value for entity in main_read_sacct_and_update_collection: "{entity}" when it should be "jobs" or "nodes".'
         )
 
-    # Retrieve clusters data from the configuration file
-    clusters = get_config("clusters")
-    assert cluster_name in clusters
+    # Write the operations and process the reports spooled by the previous runs
+    # before the new report. If some of them are still not written, the new report
+    # (or the new operations, if it cannot be spooled) is spooled as well
+    spool_drained = True
+    if spool is not None:
+        with metrics.stage("replay"):
+            nbr_replayed_operations, spool_drained = replay_spool(
+                collection.database,
+                cluster_name,
+                entity,
+                replay_report=partial(
+                    replay_spooled_report,
+                    entity,
+                    collection,
+                    users_collection,
+                    cluster_name,
+                    user_account_cache=user_account_cache,
+                    lease=lease,
+                ),
+            )
+        metrics.add_count("replayed", nbr_replayed_operations)
 
     ## Retrieve entities ##
 
-    # Generate a report file if required
-    if not from_file or not os.path.exists(report_file_path):
+    report_stream = None
+    if not from_file and clusters[cluster_name]["stream_reports"]:
+        # Parse the output of the command while it is received. If a report
+        # file path is provided, the report is written there at the same time
+        print(
+            f"Stream report for the {cluster_name} cluster (copied at location {report_file_path})."
+        )
+        with metrics.stage("generate"):
+            report_stream = open_report(cluster_name, tee_file_path=report_file_path)
+        report_retrieved = report_stream is not None
+    elif not from_file or not os.path.exists(report_file_path):
+        # Generate a report file if required
         print(
             f"Generate report file for the {cluster_name} cluster at location {report_file_path}."
         )
-        generate_report(cluster_name, report_file_path)
+        with metrics.stage("generate"):
+            report_retrieved = generate_report(cluster_name, report_file_path)
+    else:
+        report_retrieved = True
 
-    # Construct an iterator over the list of entities in the report file,
+    if sacct_window is not None and not report_retrieved:
+        # Do not process a previous report in place of the requested window
+        print(
+            f"Error. Failed to retrieve the jobs of the {cluster_name} cluster between {sacct_window[0]} and {sacct_window[1]}."
+        )
+        return False
+
+    if not spool_drained and report_file_path and not dump_file:
+        # The database is still unavailable: the report is not compared with it
+        if report_stream is not None:
+            with report_stream:
+                report_stream.drain()
+        if os.path.exists(report_file_path):
+            spool_retrieved_report(cluster_name, entity, report_file_path, metrics)
+            return True
+
+    # Skip the report if it is identical to the last committed one. The reports
+    # which are streamed or dumped are always processed
+    report_digest = None
+    if (
+        report_stream is None
+        and want_commit_to_db
+        and not dump_file
+        and clusters[cluster_name]["skip_identical_reports"]
+    ):
+        state_collection = get_ingestion_state_collection(collection)
+        with metrics.stage("digest"):
+            report_digest = get_file_digest(report_file_path)
+            D_last_report_state = get_last_report_state(
+                state_collection, cluster_name, entity
+            )
+        if (
+            D_last_report_state is not None
+            and report_digest == D_last_report_state["digest"]
+        ):
+            if entity == "nodes":
+                # The nodes missing from the report are still counted
+                nbr_newly_missing_nodes = mark_nodes_still_missing(
+                    collection, cluster_name
+                )
+                metrics.add_count("missing", nbr_newly_missing_nodes)
+            # The entities of the report are still up to date
+            now = time.time()
+            nbr_touched_entities = touch_report_entities(
+                collection,
+                cluster_name,
+                entity,
+                D_last_report_state.get("updated_since"),
+                now,
+            )
+            metrics.add_count("touched", nbr_touched_entities)
+            touch_last_report_digest(state_collection, cluster_name, entity, now)
+            metrics.short_circuited = True
+            print(
+                f"The {entity} report of the {cluster_name} cluster is identical to the last committed one. Skip it."
+            )
+            return True
+
+    # The entities of the report are written from now on
+    timestamp_diff = time.time()
+
+    # Construct an iterator over the list of entities in the report,
     # each one of them is turned into a clockwork job or node, according to applicability
-    I_clockwork_entities_from_report = map(
-        from_slurm_to_clockwork,
-        fetch_slurm_report(parser, cluster_name, report_file_path),
+    if report_stream is not None:
+        I_slurm_entities_from_report = fetch_slurm_report_stream(
+            parser, cluster_name, report_stream
+        )
+    else:
+        I_slurm_entities_from_report = fetch_slurm_report(
+            parser, cluster_name, report_file_path
+        )
+    I_clockwork_entities_from_report = metrics.timed_iterator(
+        "parse",
+        map(from_slurm_to_clockwork, I_slurm_entities_from_report),
+        count="parsed",
     )
 
     L_updates_to_do = []  # Entity updates to store in the database if requested
     L_users_updates = []  # Users updates to store in the database if requested
-    L_data_for_dump_file = []  # Data to store in the dump file if requested
 
-    if entity == "jobs":
-        (
-            L_updates_to_do,
-            L_users_updates,
-            L_data_for_dump_file,
-        ) = get_jobs_updates_and_insertions(
-            I_clockwork_entities_from_report, cluster_name, collection, users_collection
-        )
-    elif entity == "nodes":
-        (L_updates_to_do, L_data_for_dump_file) = get_nodes_updates(
-            I_clockwork_entities_from_report
+    # If requested, the entity updates are written by batches while they are produced
+    if want_commit_to_db:
+        assert collection is not None
+        before_batch = None if lease is None else lease.check
+        bulk_writer = BulkWriter.for_cluster(
+            collection, cluster_name, spool=spool, before_batch=before_batch
         )
+        bulk_writer.spooling = not spool_drained
+        updates_writer = TimedWriter(bulk_writer, metrics)
+    else:
+        updates_writer = None
+
+    # The entities are written to the dump file (if requested) while they are produced
+    # (see slurm_state.helpers.dump_file for the formats). The dump writer counts them otherwise
+    dump_writer = open_dump_writer(dump_file)
+    L_data_for_dump_file = TimedWriter(dump_writer, metrics, stage="dump")
+
+    try:
+        if entity == "jobs":
+            if user_account_cache is None:
+                user_account_cache = UserAccountCache()
+            nbr_user_queries_before = user_account_cache.nbr_queries
+            user_lookup_duration_before = user_account_cache.duration
+
+            with metrics.stage("diff"):
+                (
+                    L_updates_to_do,
+                    L_users_updates,
+                    L_data_for_dump_file,
+                    D_jobs_counts,
+                ) = get_jobs_updates_and_insertions(
+                    I_clockwork_entities_from_report,
+                    cluster_name,
+                    collection,
+                    users_collection,
+                    user_account_cache=user_account_cache,
+                    updates_writer=updates_writer,
+                    dump_writer=L_data_for_dump_file,
+                    metrics=metrics,
+                )
+            for name, value in D_jobs_counts.items():
+                metrics.add_count(name, value)
+            metrics.add_count(
+                "user_queries", user_account_cache.nbr_queries - nbr_user_queries_before
+            )
+
+            print(
+                f"User accounts lookup made {user_account_cache.nbr_queries - nbr_user_queries_before} queries "
+                f"in {user_account_cache.duration - user_lookup_duration_before} seconds."
+            )
+            print(
+                f"{entity}: {D_jobs_counts['inserted']} inserted, {D_jobs_counts['updated']} partially updated "
+                f"and {D_jobs_counts['unchanged']} unchanged."
+            )
+        elif entity == "nodes":
+            with metrics.stage("diff"):
+                (
+                    L_updates_to_do,
+                    L_data_for_dump_file,
+                    D_nodes_counts,
+                ) = get_nodes_updates(
+                    I_clockwork_entities_from_report,
+                    cluster_name,
+                    collection,
+                    updates_writer=updates_writer,
+                    dump_writer=L_data_for_dump_file,
+                )
+            for name, value in D_nodes_counts.items():
+                metrics.add_count(name, value)
+
+            print(
+                f"{entity}: {D_nodes_counts['inserted']} inserted, {D_nodes_counts['updated']} partially updated, "
+                f"{D_nodes_counts['unchanged']} unchanged and {D_nodes_counts['missing']} newly missing."
+            )
+
+        if report_stream is not None:
+            # Read the end of the output, so that the copy of the report is complete
+            report_stream.drain()
+
+        # Complete the dump file, if requested
+        L_data_for_dump_file.close()
+        if dump_file:
+            print(f"Wrote {entity} to dump_file {dump_file}.")
+            metrics.add_count("dumped", len(L_data_for_dump_file))
+    except BaseException as inst:
+        # Keep the previous dump file
+        dump_writer.abort()
+        if (
+            isinstance(inst, ConnectionFailure)
+            and spool is not None
+            and report_stream is not None
+        ):
+            # Complete the copy of the report, so that it can be spooled
+            report_stream.drain()
+        raise
+    finally:
+        if report_stream is not None:
+            report_stream.close()
+            print(
+                f"Received {report_stream.transfer_summary()} from the {cluster_name} cluster."
+            )
+            metrics.add_count("received_bytes", report_stream.nbr_bytes)
+            metrics.add_count("transferred_bytes", report_stream.nbr_transferred_bytes)
 
     # Commit new elements and changes to the database, if requested
     if want_commit_to_db:
-        # Store the jobs or nodes
+        # Store the remaining jobs or nodes
+        D_bulk_summary = updates_writer.close()
+        for counter in [
+            "nInserted",
+            "nUpserted",
+            "nModified",
+            "nbr_write_errors",
+            "nbr_spooled",
+        ]:
+            metrics.add_count(counter, D_bulk_summary[counter])
+        # The write errors (invalid documents, for instance) do not prevent the
+        # other operations from being written, but the report is not fully committed
+        nbr_write_errors = D_bulk_summary["nbr_write_errors"] + len(
+            D_bulk_summary["writeConcernErrors"]
+        )
         if L_updates_to_do:
-            assert collection is not None
-            print(f"{entity}: collection.bulk_write(L_updates_to_do)")
-            result = collection.bulk_write(L_updates_to_do)
-            pprint_bulk_result(result)
+            print(
+                f"{entity}: collection.bulk_write(L_updates_to_do, ordered=False) "
+                f"in {D_bulk_summary['nbr_batches']} batches"
+            )
+            print(D_bulk_summary)
+        elif L_data_for_dump_file:
+            print(f"No updates to do on the {entity} collection.")
         else:
             print(
                 f"Empty list found for updates to {entity} collection."
@@ -223,13 +837,34 @@ def main_read_report_and_update_collection(
             )
 
         # Update the users associating their account
+        # (these updates never create new users). They are spooled after the
+        # entity updates if the latter have been spooled
         if L_users_updates:
-            print("users_collection.bulk_write(L_user_updates, upsert=False)")
-            result = users_collection.bulk_write(
-                L_users_updates,
-                upsert=False,  # this should never create new users.
+            print("users_collection.bulk_write(L_user_updates, ordered=False)")
+            with metrics.stage("user_updates"):
+                users_writer = BulkWriter(
+                    users_collection, spool=spool, before_batch=before_batch
+                )
+                users_writer.spooling = bulk_writer.spooling
+                for user_update in L_users_updates:
+                    users_writer.append(user_update)
+                D_users_bulk_summary = users_writer.close()
+            print(D_users_bulk_summary)
+            metrics.add_count("user_updates", len(L_users_updates))
+            metrics.add_count("nbr_spooled", D_users_bulk_summary["nbr_spooled"])
+            metrics.add_count(
+                "nbr_write_errors", D_users_bulk_summary["nbr_write_errors"]
+            )
+            nbr_write_errors += D_users_bulk_summary["nbr_write_errors"] + len(
+                D_users_bulk_summary["writeConcernErrors"]
+            )
+
+        nbr_spooled_operations = 0 if spool is None else len(spool)
+        if nbr_spooled_operations:
+            print(
+                f"The database is unavailable: {nbr_spooled_operations} operations on the {entity} "
+                f"of the {cluster_name} cluster have been spooled in {spool.segment_path}."
             )
-            pprint_bulk_result(result)
 
         # Display the time taken for this import
         mongo_update_duration = time.time() - timestamp_start
@@ -237,18 +872,210 @@ def main_read_report_and_update_collection(
             f"Bulk write for {len(L_updates_to_do)} {entity} entries in mongodb took {mongo_update_duration} seconds."
         )
 
-    # Dump the JSON data in a given output file, if requested
-    if dump_file:
-        with open(dump_file, "w") as f:
-            json.dump(L_data_for_dump_file, f, indent=4)
-        print(f"Wrote {entity} to dump_file {dump_file}.")
+        # The report has been fully committed: the next identical report can be skipped
+        if (
+            report_digest is not None
+            and not nbr_spooled_operations
+            and not nbr_write_errors
+        ):
+            set_last_report_digest(
+                state_collection,
+                cluster_name,
+                entity,
+                report_digest,
+                time.time(),
+                updated_since=timestamp_diff,
+            )
+
+        if nbr_write_errors:
+            print(
+                f"Error. {nbr_write_errors} operations on the {entity} of the {cluster_name} cluster "
+                "could not be written to the database."
+            )
+            return False
+
+    return True
+
+
+def spool_retrieved_report(cluster_name, entity, report_file_path, metrics):
+    """
+    Spool a report which could not be processed because the database is
+    unavailable, so that it is processed by the next run.
+    """
+    segment_path = spool_report(cluster_name, entity, report_file_path)
+    print(
+        f"The {entity} report of the {cluster_name} cluster has been spooled in {segment_path}."
+    )
+    metrics.add_count("spooled_reports")
+
+
+def replay_spooled_report(
+    entity,
+    collection,
+    users_collection,
+    cluster_name,
+    report_file_path,
+    user_account_cache=None,
+    lease=None,
+):
+    """
+    Process a report spooled by a previous run (see slurm_state.spool), as if it
+    was a new report read from a file. Its processing is recorded in its own metrics.
+
+    Returns:
+        True if the entities of the report have been written to the database,
+        False if some of them could not be written (write errors)
+
+    Raises the connection errors, such as a ConnectionFailure, so that the
+    report stays in the spool.
+    """
+    metrics = IngestMetrics(entity, cluster_name)
+    success = False
+    error = None
+    try:
+        success = read_report_and_update_collection(
+            entity,
+            collection,
+            users_collection,
+            cluster_name,
+            report_file_path,
+            metrics,
+            from_file=True,
+            user_account_cache=user_account_cache,
+            lease=lease,
+        )
+        return success
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        write_ingest_metrics(metrics.finish(success, error=error))
+
+
+def main_read_jobs_by_sacct_windows(
+    jobs_collection,
+    users_collection,
+    cluster_name,
+    report_file_path,
+    want_commit_to_db=True,
+    dump_file="",
+    user_account_cache=None,
+    lease=None,
+    use_spool=True,
+):
+    """
+    Retrieve the jobs of a cluster through sacct from its watermark, which is the end
+    of the last window whose jobs have been committed to the database, until now.
+
+    Each run requests the jobs from the watermark minus the "sacct_window_overlap"
+    setting of the cluster. Long gaps, after an outage for instance, are split into
+    windows of at most "sacct_max_window" seconds. The watermark is advanced after
+    each window whose jobs have been written to the database, so that an interrupted
+    run is resumed by the next one. If there is no watermark yet, the jobs of the
+    last 600 seconds are retrieved.
+
+    If the database is unavailable while the spool is enabled, the watermark is
+    neither read nor advanced: the jobs of the last 600 seconds are retrieved and
+    spooled, and the next run retrieves the jobs from the stored watermark again.
+
+    Parameters:
+        jobs_collection     Collection of the jobs in the database. The watermarks are stored in the same database
+        users_collection    Collection of the users in the database
+        cluster_name        Name of the cluster we are working on
+        report_file_path    Path where the sacct report of each window is written
+        want_commit_to_db   Boolean indicating whether or not the jobs are stored in the database. If False,
+                            the watermark is not advanced. Default is True
+        dump_file           String containing the path to the file in which we want to dump the jobs of each window
+                            (each window overwrites the previous one). Default is "", which means nothing is dumped
+        user_account_cache  UserAccountCache shared by the windows. Default is None, which means a new cache is used
+        lease               IngestionLease held for all the windows, checked before each batch of writes. Default is None
+        use_spool           Boolean indicating whether or not the spool is used by the windows. Default is True
+
+    Returns:
+        True if the jobs of all the windows have been retrieved and written, False otherwise
+    """
+    cluster = get_config("clusters")[cluster_name]
+    if user_account_cache is None:
+        user_account_cache = UserAccountCache()
+
+    state_collection = None
+    watermark = None
+    if jobs_collection is not None:
+        state_collection = get_ingestion_state_collection(jobs_collection)
+        try:
+            watermark = get_sacct_watermark(state_collection, cluster_name)
+        except ConnectionFailure as inst:
+            if (
+                not want_commit_to_db
+                or not use_spool
+                or get_spool_dir(cluster_name, "jobs") is None
+            ):
+                raise
+            print(
+                f"Error. Failed to read the watermark of the {cluster_name} cluster: {inst}"
+            )
+            state_collection = None
+
+    L_windows = get_sacct_windows(
+        watermark,
+        time.time(),
+        cluster["sacct_window_overlap"],
+        cluster["sacct_max_window"],
+    )
+    print(
+        f"Retrieve the jobs of the {cluster_name} cluster through {len(L_windows)} sacct windows "
+        f"(watermark: {watermark})."
+    )
+
+    for sacct_window in L_windows:
+        if not main_read_report_and_update_collection(
+            "jobs",
+            jobs_collection,
+            users_collection,
+            cluster_name,
+            report_file_path,
+            from_file=False,
+            want_commit_to_db=want_commit_to_db,
+            dump_file=dump_file,
+            user_account_cache=user_account_cache,
+            sacct_window=sacct_window,
+            # The lease is held for all the windows
+            use_lease=False,
+            lease=lease,
+            use_spool=use_spool,
+        ):
+            print(f"The watermark of the {cluster_name} cluster is not advanced.")
+            return False
+
+        # The jobs of the window have been written without errors (False
+        # would have been returned, or an exception raised, otherwise)
+        if want_commit_to_db and state_collection is not None:
+            try:
+                set_sacct_watermark(state_collection, cluster_name, sacct_window[1])
+            except ConnectionFailure as inst:
+                if not use_spool or get_spool_dir(cluster_name, "jobs") is None:
+                    raise
+                # The jobs of the window have been spooled
+                print(
+                    f"Error. Failed to advance the watermark of the {cluster_name} cluster: {inst}"
+                )
+                state_collection = None
+
+    return True
 
 
 def get_jobs_updates_and_insertions(
-    I_clockwork_jobs, cluster_name, jobs_collection, users_collection
+    I_clockwork_jobs,
+    cluster_name,
+    jobs_collection,
+    users_collection,
+    user_account_cache=None,
+    updates_writer=None,
+    dump_writer=None,
+    metrics=None,
 ):
     """
-    Retrieve lists of database operations (InsertOne, ReplaceOne and UpdateOne, from pymongo) summarizing the updates
+    Retrieve lists of database operations (InsertOne and UpdateOne, from pymongo) summarizing the updates
     to be done on jobs and users in the database, and data to store in the dump file.
 
     Parameters:
@@ -256,49 +1083,79 @@ def get_jobs_updates_and_insertions(
         cluster_name        Name of the cluster on which we are working
         jobs_collection     Collection of the jobs in the database
         users_collection    Collection of the users in the database
+        user_account_cache  UserAccountCache used to retrieve the users associated to the jobs.
+                            Default is None, which means a new cache is used
+        updates_writer      Object with an "append" method, such as a BulkWriter, receiving the operations
+                            on the jobs as soon as they are produced. Default is None, which means the
+                            operations are gathered in a list
+        dump_writer         Object with an "append" method, such as a writer from slurm_state.helpers.dump_file,
+                            receiving the elements to store in the dump file as soon as they are produced.
+                            Default is None, which means the elements are gathered in a list
+        metrics             IngestMetrics in which the durations of the "filter" and "user_lookup" stages,
+                            and the number of jobs related to Mila, are recorded. Default is None
+
+    The jobs which are already stored in the database are only updated on the fields
+    which have been modified. A fingerprint of their "slurm" part is stored in
+    cw.slurm_fingerprint to detect the unchanged jobs, which only get their
+    timestamps updated (or nothing at all, according to the "touch_unchanged_jobs"
+    setting of the cluster).
 
     Returns:
-        A 3-tuple containing (in this order) the following elements:
-            - A list of the database operations (InsertOne and ReplaceOne, from pymongo) summarizing the
-              updates to be done into the database for the jobs
+        A 4-tuple containing (in this order) the following elements:
+            - A list of the database operations (InsertOne and UpdateOne, from pymongo) summarizing the
+              updates to be done into the database for the jobs (or updates_writer, if provided)
             - A list of the database operations (UpdateOne, from pymongo) summarizing the updates to be
               done into the database for the users
-            - A list of the elements to store in the dump file
+            - A list of the elements to store in the dump file (or dump_writer, if provided)
+            - A dictionary containing the numbers of "inserted", (partially) "updated" and "unchanged" jobs
     """
 
-    L_updates_to_do = []  # Initialize the list of elements to update
+    L_updates_to_do = (
+        [] if updates_writer is None else updates_writer
+    )  # Initialize the list of elements to update
     L_data_for_dump_file = (
-        []
+        [] if dump_writer is None else dump_writer
     )  # Initialize the list of elements to store into the dump file
+    D_counts = {
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+    }  # Initialize the counts of jobs inserted, partially updated and unchanged
 
-    ## Retrieve MongoDB entities ##
+    ## Retrieve sacct entities ##
 
-    # Retrieve the entities already stored in MongoDB for this cluster
-    LD_currently_in_mongodb = list(
-        jobs_collection.find({"slurm.cluster_name": cluster_name})
+    # Filter the previous iterator to keep only the jobs having accounts related to Mila,
+    # gather them in a list and retrieve their users in batch
+    if user_account_cache is None:
+        user_account_cache = UserAccountCache()
+    if metrics is None:
+        metrics = IngestMetrics("jobs", cluster_name)
+    LD_sacct = list(
+        filter(metrics.timed("filter", is_allocation_related_to_mila), I_clockwork_jobs)
     )
+    metrics.add_count("related_to_mila", len(LD_sacct))
+    with metrics.stage("user_lookup"):
+        LD_sacct = lookup_user_accounts(LD_sacct, users_collection, user_account_cache)
 
-    # Index these entities by id in order to have a O(1) lookup
-    # when matching entities stored in MongoDB and in the sacct file
-    DD_currently_in_mongodb = dict(
-        (D_entity["slurm"]["job_id"], D_entity) for D_entity in LD_currently_in_mongodb
-    )
+    # Index the jobs by ID, and compute the fingerprint of their "slurm" part,
+    # used to detect the jobs which have not changed since their last update
+    DD_sacct = {}
+    for D_job in LD_sacct:
+        D_job["cw"]["slurm_fingerprint"] = get_fingerprint(D_job["slurm"])
+        DD_sacct[D_job["slurm"]["job_id"]] = D_job
 
-    ## Retrieve sacct entities ##
+    ## Retrieve MongoDB entities ##
 
-    # Filter the previous iterator to keep only the jobs having accounts related to Mila
-    # and apply the function lookup_user_account to each element,
-    # which are then gathered in a list
-    LD_sacct = list(
-        map(
-            lookup_user_account(users_collection),
-            filter(is_allocation_related_to_mila, I_clockwork_jobs),
+    # Retrieve only the entities already stored in MongoDB which are present in
+    # the report, and index them by id in order to have a O(1) lookup
+    # when matching entities stored in MongoDB and in the sacct file
+    DD_currently_in_mongodb = dict(
+        (D_entity["slurm"]["job_id"], D_entity)
+        for D_entity in find_jobs_by_ids(
+            jobs_collection, cluster_name, list(DD_sacct.keys())
         )
     )
 
-    # Index the jobs by ID
-    DD_sacct = dict((D_job["slurm"]["job_id"], D_job) for D_job in LD_sacct)
-
     ## Identify the elements to insert and the ones to updates ##
 
     # Identify the element to insert (ie the new element, which have not been stored
@@ -333,12 +1190,14 @@ def get_jobs_updates_and_insertions(
 
         # Save the operation to do in the database
         L_updates_to_do.append(InsertOne(D_job_new))
+        D_counts["inserted"] += 1
         # Save the data to store in the dump file (just omit the "_id" part of the job)
         L_data_for_dump_file.append(
             {k: D_job_new[k] for k in D_job_new.keys() if k != "_id"}
         )
 
     # -- Update --
+    touch_unchanged_jobs = get_config("clusters")[cluster_name]["touch_unchanged_jobs"]
     for job_id in S_ids_to_update:
         # Retrieve the two versions of the job
         D_job_db = DD_currently_in_mongodb[
@@ -364,9 +1223,30 @@ def get_jobs_updates_and_insertions(
         D_job_new["cw"]["last_slurm_update"] = now
         D_job_new["cw"]["last_slurm_update_by_sacct"] = now
 
-        L_updates_to_do.append(
-            ReplaceOne({"_id": D_job_db["_id"]}, D_job_new, upsert=False)
-        )
+        # Only write the fields which have been modified
+        D_modified_fields = get_modified_fields(D_job_db, D_job_sacct)
+        if D_modified_fields:
+            D_modified_fields["cw.last_slurm_update"] = now
+            D_modified_fields["cw.last_slurm_update_by_sacct"] = now
+            L_updates_to_do.append(
+                UpdateOne({"_id": D_job_db["_id"]}, {"$set": D_modified_fields})
+            )
+            D_counts["updated"] += 1
+        else:
+            if touch_unchanged_jobs:
+                # Only mark the job as seen in the report
+                L_updates_to_do.append(
+                    UpdateOne(
+                        {"_id": D_job_db["_id"]},
+                        {
+                            "$set": {
+                                "cw.last_slurm_update": now,
+                                "cw.last_slurm_update_by_sacct": now,
+                            }
+                        },
+                    )
+                )
+            D_counts["unchanged"] += 1
 
         # Save the data to store in the dump file (just omit the "_id" part of the job)
         L_data_for_dump_file.append(
@@ -376,30 +1256,170 @@ def get_jobs_updates_and_insertions(
     # -- Account association -- #
     L_users_updates = associate_account(LD_sacct)
 
-    return (L_updates_to_do, L_users_updates, L_data_for_dump_file)
+    return (L_updates_to_do, L_users_updates, L_data_for_dump_file, D_counts)
+
+
+def get_fingerprint(D_slurm):
+    """
+    Return a digest of the content of a "slurm" subdocument, which does not
+    depend on the order of its keys.
+    """
+    # The json module is always used here, so that the fingerprints of the stored
+    # jobs do not depend on the JSON backend (see slurm_state.helpers.json_codec)
+    return hashlib.sha1(
+        json.dumps(D_slurm, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def get_file_digest(file_path):
+    """
+    Return a digest of the content of a file, such as a report.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(REPORT_DIGEST_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def get_nodes_updates(I_clockwork_nodes):
+def get_modified_fields(D_entity_db, D_entity_report):
     """
-    Retrieve a list of database operations (UpdateOne, from pymongo) summarizing
+    Compare an entity stored in the database with the same entity retrieved
+    from a report, and list the fields of its "slurm" and "cw" parts which
+    have to be written.
+
+    The comparison of the "slurm" parts is skipped when the fingerprint
+    stored in the database matches the fingerprint of the report.
+
+    Parameters:
+        D_entity_db         The entity as it is currently stored in the database
+        D_entity_report     The entity as it is retrieved from the report. Its
+                            fingerprint is expected in cw.slurm_fingerprint
+
+    Returns:
+        A dictionary {"<part>.<field>": value} of the modified fields, to be used
+        with a "$set" operation. It is empty if nothing has changed.
+    """
+    D_modified_fields = {}
+    D_cw_db = D_entity_db.get("cw", {})
+
+    if D_cw_db.get("slurm_fingerprint") != D_entity_report["cw"]["slurm_fingerprint"]:
+        D_slurm_db = D_entity_db.get("slurm", {})
+        for k, v in D_entity_report["slurm"].items():
+            if k not in D_slurm_db or D_slurm_db[k] != v:
+                D_modified_fields[f"slurm.{k}"] = v
+
+    for k, v in D_entity_report["cw"].items():
+        if k not in D_cw_db or D_cw_db[k] != v:
+            D_modified_fields[f"cw.{k}"] = v
+
+    return D_modified_fields
+
+
+def find_jobs_by_ids(jobs_collection, cluster_name, L_job_ids):
+    """
+    Iterate over the jobs stored in the database for a cluster whose IDs
+    are in the given list.
+
+    The IDs are queried by chunks of JOB_IDS_QUERY_CHUNK_SIZE, in order
+    to use the "job_id_and_cluster_name" index while keeping the queries
+    reasonably small. Only the fields used to merge the jobs with the ones
+    from the report are retrieved.
+
+    Parameters:
+        jobs_collection     Collection of the jobs in the database
+        cluster_name        Name of the cluster on which we are working
+        L_job_ids           List of the IDs of the jobs to retrieve
+    """
+    for i in range(0, len(L_job_ids), JOB_IDS_QUERY_CHUNK_SIZE):
+        yield from jobs_collection.find(
+            {
+                "slurm.job_id": {"$in": L_job_ids[i : i + JOB_IDS_QUERY_CHUNK_SIZE]},
+                "slurm.cluster_name": cluster_name,
+            },
+            JOB_MERGE_PROJECTION,
+        )
+
+
+def get_nodes_updates(
+    I_clockwork_nodes,
+    cluster_name,
+    nodes_collection,
+    updates_writer=None,
+    dump_writer=None,
+):
+    """
+    Retrieve a list of database operations (UpdateOne and UpdateMany, from pymongo) summarizing
     the updates to be done on nodes in the database, and data to store in the dump file.
 
     Parameters:
         I_clockwork_nodes   Iterator on Clockwork nodes we want to insert or update in the database
+        cluster_name        Name of the cluster on which we are working
+        nodes_collection    Collection of the nodes in the database
+        updates_writer      Object with an "append" method, such as a BulkWriter, receiving the operations
+                            on the nodes as soon as they are produced. Default is None, which means the
+                            operations are gathered in a list
+        dump_writer         Object with an "append" method, receiving the elements to store in the dump
+                            file as soon as they are produced. Default is None, which means the elements
+                            are gathered in a list
+
+    As for the jobs, a fingerprint of the "slurm" part of the nodes is stored in
+    cw.slurm_fingerprint. Only the modified fields of the nodes are written. The nodes
+    which did not change since the previous report only get their timestamps updated,
+    with one UpdateMany (or nothing at all, according to the "touch_unchanged_nodes"
+    setting of the cluster).
+
+    The stored nodes which are missing from the report get their cw.nbr_missing_reports
+    incremented. When a node has been missing from "nbr_reports_before_node_missing"
+    consecutive reports (a setting of the cluster), cw.missing_since is set. Both are
+    done with one UpdateMany for all the nodes concerned, and removed when the node
+    appears again in a report. An empty report is not considered.
 
     Returns:
-        A 2-tuple containing (in this order) the following elements:
-            - A list of the database operations (UpdateOne, from pymongo) summarizing the
-              updates to be done into the database for the nodes
-            - A list of elements to store in the dump file
+        A 3-tuple containing (in this order) the following elements:
+            - A list of the database operations (UpdateOne and UpdateMany, from pymongo) summarizing
+              the updates to be done into the database for the nodes (or updates_writer, if provided)
+            - A list of elements to store in the dump file (or dump_writer, if provided)
+            - A dictionary containing the numbers of "inserted", (partially) "updated", "unchanged"
+              and newly "missing" nodes
     """
 
-    L_updates_to_do = []  # Initialize the list of elements to update
+    L_updates_to_do = (
+        [] if updates_writer is None else updates_writer
+    )  # Initialize the list of elements to update
     L_data_for_dump_file = (
-        []
+        [] if dump_writer is None else dump_writer
     )  # Initialize the list of elements to store into the dump file
+    D_counts = {
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "missing": 0,
+    }  # Initialize the counts of nodes inserted, partially updated, unchanged and newly missing
+
+    # Retrieve the nodes of the cluster stored in the database, indexed by name
+    DD_nodes_in_mongodb = dict(
+        (D_node["slurm"]["name"], D_node)
+        for D_node in nodes_collection.find(
+            {"slurm.cluster_name": cluster_name}, NODE_MERGE_PROJECTION
+        )
+    )
+    S_names_in_report = set()
+    L_ids_unchanged = []  # Nodes which only get their timestamps updated
 
     for D_node in I_clockwork_nodes:
+        S_names_in_report.add(D_node["slurm"]["name"])
+        D_node["cw"]["slurm_fingerprint"] = get_fingerprint(D_node["slurm"])
+        D_node_db = DD_nodes_in_mongodb.get(D_node["slurm"]["name"])
+
+        # Compare the node with the stored one before adding the timestamps
+        if D_node_db is not None:
+            D_modified_fields = get_modified_fields(D_node_db, D_node)
+            L_fields_to_unset = [
+                f"cw.{k}"
+                for k in ["nbr_missing_reports", "missing_since"]
+                if k in D_node_db.get("cw", {})
+            ]
 
         # Add these field each time an entry is updated
         now = time.time()
@@ -408,24 +1428,175 @@ def get_nodes_updates(I_clockwork_nodes):
 
         L_data_for_dump_file.append(D_node)
 
+        if D_node_db is None:
+            L_updates_to_do.append(
+                UpdateOne(
+                    # rule to match if already present in collection
+                    {
+                        "slurm.name": D_node["slurm"]["name"],
+                        "slurm.cluster_name": D_node["slurm"]["cluster_name"],
+                    },
+                    # the data that we write in the collection
+                    {
+                        "$set": {"slurm": D_node["slurm"]},
+                        "$setOnInsert": {"cw": D_node["cw"]},
+                    },
+                    # create if missing, update if present
+                    upsert=True,
+                )
+            )
+            D_counts["inserted"] += 1
+        elif D_modified_fields or L_fields_to_unset:
+            # Only write the fields which have been modified
+            D_modified_fields["cw.last_slurm_update"] = now
+            D_modified_fields["cw.last_slurm_update_by_sacct"] = now
+            D_update = {"$set": D_modified_fields}
+            if L_fields_to_unset:
+                # The node is not missing anymore
+                D_update["$unset"] = {field: "" for field in L_fields_to_unset}
+            L_updates_to_do.append(UpdateOne({"_id": D_node_db["_id"]}, D_update))
+            D_counts["updated"] += 1
+        else:
+            L_ids_unchanged.append(D_node_db["_id"])
+            D_counts["unchanged"] += 1
+
+    # Mark the unchanged nodes as seen in the report, so that they
+    # are not considered as stale (see scripts/archive_stale_data.py)
+    if (
+        L_ids_unchanged
+        and get_config("clusters")[cluster_name]["touch_unchanged_nodes"]
+    ):
+        now = time.time()
         L_updates_to_do.append(
-            UpdateOne(
-                # rule to match if already present in collection
+            UpdateMany(
+                {"_id": {"$in": L_ids_unchanged}},
                 {
-                    "slurm.name": D_node["slurm"]["name"],
-                    "slurm.cluster_name": D_node["slurm"]["cluster_name"],
+                    "$set": {
+                        "cw.last_slurm_update": now,
+                        "cw.last_slurm_update_by_sacct": now,
+                    }
                 },
-                # the data that we write in the collection
-                {
-                    "$set": {"slurm": D_node["slurm"]},
-                    "$setOnInsert": {"cw": D_node["cw"]},
-                },
-                # create if missing, update if present
-                upsert=True,
             )
         )
 
-    return (L_updates_to_do, L_data_for_dump_file)
+    # Count the reports from which the stored nodes are missing. An empty report
+    # is more likely to come from a failure than from the removal of all the nodes
+    if S_names_in_report:
+        nbr_reports_before_node_missing = get_config("clusters")[cluster_name][
+            "nbr_reports_before_node_missing"
+        ]
+        L_ids_still_missing = []  # Nodes missing, but not for long enough
+        L_ids_newly_missing = []  # Nodes to mark as missing
+        for name, D_node_db in DD_nodes_in_mongodb.items():
+            D_cw_db = D_node_db.get("cw", {})
+            if name in S_names_in_report or "missing_since" in D_cw_db:
+                continue
+            nbr_missing_reports = D_cw_db.get("nbr_missing_reports", 0) + 1
+            if nbr_missing_reports >= nbr_reports_before_node_missing:
+                L_ids_newly_missing.append(D_node_db["_id"])
+            else:
+                L_ids_still_missing.append(D_node_db["_id"])
+
+        if L_ids_still_missing:
+            L_updates_to_do.append(
+                UpdateMany(
+                    {"_id": {"$in": L_ids_still_missing}},
+                    {"$inc": {"cw.nbr_missing_reports": 1}},
+                )
+            )
+        if L_ids_newly_missing:
+            L_updates_to_do.append(
+                UpdateMany(
+                    {"_id": {"$in": L_ids_newly_missing}},
+                    {
+                        "$inc": {"cw.nbr_missing_reports": 1},
+                        "$set": {"cw.missing_since": time.time()},
+                    },
+                )
+            )
+            D_counts["missing"] = len(L_ids_newly_missing)
+
+    return (L_updates_to_do, L_data_for_dump_file, D_counts)
+
+
+def touch_report_entities(collection, cluster_name, entity, updated_since, now):
+    """
+    Update the cw.last_slurm_update timestamps of the jobs or nodes of the last
+    committed report, when the new report is identical to it (see the
+    "skip_identical_reports" setting), as the processing of the report would have.
+
+    The nodes of the report are the stored nodes of the cluster which are not missing.
+    The jobs of the report are the ones of the cluster whose timestamps have been set
+    since updated_since, the time from which the last report has been processed (the
+    unchanged jobs are not touched if the "touch_unchanged_jobs" setting is false).
+
+    Returns:
+        The number of touched jobs or nodes
+    """
+    D_filter = {"slurm.cluster_name": cluster_name}
+    if entity == "nodes":
+        D_filter["cw.missing_since"] = {"$exists": False}
+        D_filter["cw.nbr_missing_reports"] = {"$exists": False}
+    elif updated_since is not None:
+        D_filter["cw.last_slurm_update"] = {"$gte": updated_since}
+    else:
+        # The report has been committed before updated_since was recorded
+        return 0
+    result = collection.update_many(
+        D_filter,
+        {
+            "$set": {
+                "cw.last_slurm_update": now,
+                "cw.last_slurm_update_by_sacct": now,
+            }
+        },
+    )
+    return result.modified_count
+
+
+def mark_nodes_still_missing(nodes_collection, cluster_name):
+    """
+    Count one more report from which the nodes of a cluster are missing, when the
+    report is identical to the last committed one (see the "skip_identical_reports"
+    setting), as get_nodes_updates would have done. The nodes missing from this
+    report are the ones which were missing from the last one, and which are not
+    marked as missing yet.
+
+    Returns:
+        The number of nodes newly marked as missing
+    """
+    nbr_reports_before_node_missing = get_config("clusters")[cluster_name][
+        "nbr_reports_before_node_missing"
+    ]
+    D_filter = {
+        "slurm.cluster_name": cluster_name,
+        "cw.missing_since": {"$exists": False},
+    }
+    # The nodes which reach the threshold are updated first, so that
+    # the second update does not make other nodes reach it
+    result = nodes_collection.update_many(
+        {
+            **D_filter,
+            "cw.nbr_missing_reports": {
+                "$gte": max(nbr_reports_before_node_missing - 1, 1)
+            },
+        },
+        {
+            "$inc": {"cw.nbr_missing_reports": 1},
+            "$set": {"cw.missing_since": time.time()},
+        },
+    )
+    nodes_collection.update_many(
+        {
+            **D_filter,
+            "cw.nbr_missing_reports": {
+                "$gte": 1,
+                "$lt": nbr_reports_before_node_missing - 1,
+            },
+        },
+        {"$inc": {"cw.nbr_missing_reports": 1}},
+    )
+    return result.modified_count
 
 
 def associate_account(LD_sacct_jobs):
@@ -509,8 +1680,8 @@ def main_read_users_and_update_collection(
     timestamp_start = time.time()
     L_updates_to_do = []
 
-    with open(users_json_file, "r") as f:
-        users_to_store = json.load(f)
+    with open(users_json_file, "rb") as f:
+        users_to_store = get_json_codec().load(f)
 
     for user_to_store in users_to_store:
 
@@ -11,10 +11,20 @@ It is not going to run inside a Docker container.
 
 It expects that a MongoDB database is online, accessible, and that it can
 connect to it through a simple connection string given as command-line argument.
+
+The jobs and the nodes are retrieved and committed concurrently, each in its own
+thread: they only share the MongoDB client. Each entity has its own ingestion
+metrics, and a failure of one of them does not interrupt the other.
 """
 
 import os
 import argparse
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from slurm_state.ingestion_state import IngestionLeaseHeld
 from slurm_state.mongo_client import get_mongo_client
 from slurm_state.mongo_update import main_read_report_and_update_collection
 
@@ -33,7 +43,7 @@ def main(argv):
     parser.add_argument(
         "--cw_jobs_file",
         required=False,
-        help="Path to dump the Clockwork jobs. If None, no Clockwork jobs file is written.",
+        help="Path to dump the Clockwork jobs. If None, no Clockwork jobs file is written. With a .jsonl, .jsonl.gz or .jsonl.zst extension, the jobs are written as JSON Lines while they are processed.",
     )
 
     parser.add_argument(
@@ -50,7 +60,7 @@ def main(argv):
 
     parser.add_argument(
         "--cw_nodes_file",
-        help="Path to dump the Clockwork nodes. If None, no Clockwork nodes file is written.",
+        help="Path to dump the Clockwork nodes. If None, no Clockwork nodes file is written. With a .jsonl, .jsonl.gz or .jsonl.zst extension, the nodes are written as JSON Lines while they are processed.",
     )
 
     parser.add_argument(
@@ -76,6 +86,13 @@ def main(argv):
         "--mongodb_collection", default="clockwork", help="Collection to populate."
     )
 
+    parser.add_argument(
+        "--concurrent",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether or not the jobs and the nodes are processed at the same time. Default is True.",
+    )
+
     # Retrieve the args
     args = parser.parse_args(argv[1:])
     collection_name = args.mongodb_collection
@@ -84,7 +101,7 @@ def main(argv):
     client = get_mongo_client()
 
     #
-    #   Parse the jobs
+    #   Prepare the jobs collection
     #
     jobs_collection = client[collection_name]["jobs"]
 
@@ -96,19 +113,8 @@ def main(argv):
             name="job_id_and_cluster_name",
         )
 
-    main_read_report_and_update_collection(
-        "jobs",
-        jobs_collection,
-        client[collection_name]["users"],
-        args.cluster_name,
-        args.slurm_jobs_file,
-        from_file=args.from_existing_jobs_file,
-        want_commit_to_db=args.store_in_db,
-        dump_file=args.cw_jobs_file,
-    )
-
     #
-    #   Parse the nodes
+    #   Prepare the nodes collection
     #
     nodes_collection = client[collection_name]["nodes"]
 
@@ -118,21 +124,65 @@ def main(argv):
             name="name_and_cluster_name",
         )
 
-    main_read_report_and_update_collection(
-        "nodes",
-        nodes_collection,
-        None,
-        args.cluster_name,
-        args.slurm_nodes_file,
-        from_file=args.from_existing_nodes_file,
-        want_commit_to_db=args.store_in_db,
-        dump_file=args.cw_nodes_file,
-    )
+    #
+    #   Parse the jobs and the nodes
+    #
+    DD_entity_args = {
+        "jobs": {
+            "collection": jobs_collection,
+            "users_collection": client[collection_name]["users"],
+            "report_file_path": args.slurm_jobs_file,
+            "from_file": args.from_existing_jobs_file,
+            "dump_file": args.cw_jobs_file,
+        },
+        "nodes": {
+            "collection": nodes_collection,
+            "users_collection": None,
+            "report_file_path": args.slurm_nodes_file,
+            "from_file": args.from_existing_nodes_file,
+            "dump_file": args.cw_nodes_file,
+        },
+    }
+
+    def ingest(entity):
+        timestamp_start = time.time()
+        try:
+            main_read_report_and_update_collection(
+                entity,
+                cluster_name=args.cluster_name,
+                want_commit_to_db=args.store_in_db,
+                **DD_entity_args[entity],
+            )
+        except IngestionLeaseHeld as inst:
+            # Another run is ingesting these entities: this is not a failure
+            print(f"Skip the {entity} of the {args.cluster_name} cluster: {inst}")
+            return
+        print(
+            f"The {entity} of the {args.cluster_name} cluster took {time.time() - timestamp_start} seconds."
+        )
 
+    # With one worker, the nodes are processed after the jobs
+    with ThreadPoolExecutor(
+        max_workers=len(DD_entity_args) if args.concurrent else 1
+    ) as executor:
+        D_futures = {
+            entity: executor.submit(ingest, entity) for entity in DD_entity_args
+        }
+    D_exceptions = {
+        entity: future.exception()
+        for entity, future in D_futures.items()
+        if future.exception() is not None
+    }
+
+    # Report the failures once both entities have been processed
+    for entity, inst in D_exceptions.items():
+        print(f"Error while processing the {entity} of {args.cluster_name}:")
+        traceback.print_exception(type(inst), inst, inst.__traceback__)
+    if D_exceptions:
+        sys.exit(1)
 
-if __name__ == "__main__":
-    import sys
 
+if __name__ == "__main__":
     main(sys.argv)
 
 """
@@ -2,25 +2,55 @@
 The sacct parser is used to convert jobs retrieved through a sacct command on a cluster
 to jobs in the format used by Clockwork.
 """
-import json, os
+import os
+import signal
+from datetime import datetime
 
 # Imports related to sacct call
 # https://docs.paramiko.org/en/stable/api/client.html
-from slurm_state.helpers.ssh_helper import open_connection
+from slurm_state.helpers.ssh_helper import (
+    get_ssh_session_pool,
+    compress_remote_command,
+    RemoteCommandStream,
+)
 
 from slurm_state.extra_filters import clusters_valid
-from slurm_state.config import get_config, string, optional_string, timezone
+from slurm_state.config import (
+    get_config,
+    string,
+    optional_string,
+    timezone,
+    string_choices,
+)
 
 clusters_valid.add_field("sacct_path", optional_string)
 clusters_valid.add_field("ssh_key_filename", string)
 clusters_valid.add_field("timezone", timezone)
 clusters_valid.add_field("remote_user", optional_string)
 clusters_valid.add_field("remote_hostname", optional_string)
+# Compression of the output of the remote commands: "none", "gzip", "zstd",
+# or "auto" to use zstd if it is available, and gzip otherwise
+clusters_valid.add_field(
+    "remote_compression",
+    string_choices("none", "gzip", "zstd", "auto"),
+    default="none",
+)
+# Output format requested to sacct: "json" retrieves all the fields of the jobs,
+# "parsable2" only the fields used by Clockwork (see PARSABLE2_JOB_FIELD_MAP)
+clusters_valid.add_field(
+    "sacct_output_format", string_choices("json", "parsable2"), default="json"
+)
 
 # These functions are translators used in order to handle the values
 # we could encounter while parsing a job dictionary retrieved from a
 # sacct command.
-from slurm_state.helpers.parser_helper import copy, rename
+from slurm_state.helpers.parser_helper import (
+    copy,
+    rename,
+    compile_field_map,
+    iter_json_array_items,
+    iter_text_lines,
+)
 
 # The following functions are only used by the job parser. Translator
 # functions shared with the node parser are retrieved from
@@ -32,60 +62,36 @@ def copy_and_stringify(k, v, res):
 
 
 def rename_subitems(subitem_dict):
+    LT_subitems = tuple(subitem_dict.items())
+
     def renamer(k, v, res):
-        for subitem, name in subitem_dict.items():
+        for subitem, name in LT_subitems:
             res[name] = v[subitem]
 
     return renamer
 
 
-def translate_with_value_modification(v_modification, translator, **args):
+def rename_subitems_with_zero_as_null(subitem_dict):
     """
-    This function returns a translator that includes a modification
-    on the value which will be transmitted to it
-
-    Parameters:
-        v_modification  The function modifying the value before it
-                        is transmitted to the translator
-        translator      The translator called
-
-    Returns:
-        A translator function including the expected value modification
+    Same as rename_subitems, but the values equal to 0 are converted to None
+    (sacct uses 0 for the times which are not defined, such as the end
+    time of a running job)
     """
-    # Some translator can depend on specific arguments. Thus, we call
-    # them before to apply it and get the translator which has to be
-    # used
-    final_translator = translator(**args)
-
-    # This helper is used to update the value v before applying the
-    # translator on the triplet (k, v, res)
-    def combiner(k, v, res):
-        final_translator(k, v_modification(v), res)
-
-    return combiner
+    LT_subitems = tuple(subitem_dict.items())
 
+    def renamer(k, v, res):
+        for subitem, name in LT_subitems:
+            subitem_value = v[subitem]
+            res[name] = None if subitem_value == 0 else subitem_value
 
-def zero_to_null(v):
-    """
-    Convert the value from 0 to null
-
-    Parameter:
-        v   The values to be converted if appliable
-
-    Return:
-        The converted values
-    """
-    # If a value of v equals 0, transform it to None
-    for (v_k, v_v) in v.items():
-        if v_v == 0:
-            v[v_k] = None
-    # Return v
-    return v
+    return renamer
 
 
 def rename_and_stringify_subitems(subitem_dict):
+    LT_subitems = tuple(subitem_dict.items())
+
     def renamer(k, v, res):
-        for subitem, name in subitem_dict.items():
+        for subitem, name in LT_subitems:
             res[name] = str(v[subitem])
 
     return renamer
@@ -101,6 +107,25 @@ def join_subitems(separator, name):
     return joiner
 
 
+# Names of the TRES subdicts in the sacct reports, and in the Clockwork jobs
+TRES_SUBDICT_NAMES = (
+    ("allocated", "tres_allocated"),
+    ("requested", "tres_requested"),
+)
+
+# Key used to store the count of a TRES, according to its type. As we are for
+# now only interested by the "count" of the entities, the other types are ignored
+TRES_KEYS = {
+    "mem": "mem",
+    "billing": "billing",
+    "cpu": "num_cpus",
+    "gres": "gres",
+    "node": "num_nodes",
+}
+# Key used to store the count of a "gres" TRES, according to its name
+GRES_KEYS = {"gpu": "num_gpus"}
+
+
 def extract_tres_data(k, v, res):
     """
     Extract count of the elements present in the value associated to the key "tres"
@@ -140,42 +165,17 @@ def extract_tres_data(k, v, res):
         }
     """
 
-    def get_tres_key(tres_type, tres_name):
-        """
-        Basically, this function is used to rename the element
-        we want to retrieve regarding the TRES type (as we are
-        for now only interested by the "count" of the entity)
-        """
-        if tres_type == "mem" or tres_type == "billing":
-            return tres_type
-        elif tres_type == "cpu":
-            return "num_cpus"
-        elif tres_type == "gres":
-            if tres_name == "gpu":
-                return "num_gpus"
-            else:
-                return "gres"
-        elif tres_type == "node":
-            return "num_nodes"
-        else:
-            return None
-
-    tres_subdict_names = [
-        {"sacct_name": "allocated", "cw_name": "tres_allocated"},
-        {"sacct_name": "requested", "cw_name": "tres_requested"},
-    ]
-    for tres_subdict_name in tres_subdict_names:
-        res[
-            tres_subdict_name["cw_name"]
-        ] = {}  # Initialize the "tres_allocated" and the "tres_requested" subdicts
-        for tres_subdict in v[tres_subdict_name["sacct_name"]]:
-            tres_key = get_tres_key(
-                tres_subdict["type"], tres_subdict["name"]
-            )  # Define the key associated to the TRES
+    for sacct_name, cw_name in TRES_SUBDICT_NAMES:
+        # Initialize the "tres_allocated" and the "tres_requested" subdicts
+        D_tres = res[cw_name] = {}
+        for tres_subdict in v[sacct_name]:
+            # Define the key associated to the TRES
+            tres_key = TRES_KEYS.get(tres_subdict["type"], None)
+            if tres_key == "gres":
+                tres_key = GRES_KEYS.get(tres_subdict["name"], "gres")
             if tres_key:
-                res[tres_subdict_name["cw_name"]][tres_key] = tres_subdict[
-                    "count"
-                ]  # Associate the count of the element, as value associated to the key defined previously
+                # Associate the count of the element, as value associated to the key defined previously
+                D_tres[tres_key] = tres_subdict["count"]
 
 
 # This map should contain all the fields that come from parsing a job entry
@@ -195,21 +195,22 @@ JOB_FIELD_MAP = {
     "nodes": copy,
     "partition": copy,
     "state": rename_subitems({"current": "job_state"}),
-    "time": translate_with_value_modification(
-        zero_to_null,
-        rename_subitems,
-        subitem_dict={
+    "time": rename_subitems_with_zero_as_null(
+        {
             "limit": "time_limit",
             "submission": "submit_time",
             "start": "start_time",
             "end": "end_time",
-        },
+        }
     ),
     "tres": extract_tres_data,
     "user": rename("username"),
     "working_directory": copy,
 }
 
+# Function translating a job as described by JOB_FIELD_MAP
+translate_job = compile_field_map(JOB_FIELD_MAP)
+
 
 # The job parser itself
 def job_parser(f):
@@ -306,49 +307,237 @@ def job_parser(f):
         working_directory = "/scratch/nobody2"
 
 
+    The report is read incrementally: the jobs are decoded and translated one
+    at a time, so that the memory used does not depend on the size of the report.
+
     Parameters:
         f       JSON report retrieved from a sacct command
 
     """
-    # Load the JSON file generated by the sacct command
-    sacct_data = json.load(f)
-    # at this point, sacct_data is a hierarchical structure of dictionaries and lists
-
-    src_jobs = sacct_data["jobs"]  # jobs is a list
+    # Iterate over the elements of the "jobs" list of the JSON file generated
+    # by the sacct command, without loading the whole report
+    src_jobs = iter_json_array_items(f, "jobs")
 
     for src_job in src_jobs:
-        res_job = (
-            dict()
-        )  # Initialize the dictionary which will store the newly formatted job data
+        yield translate_job(src_job)
+
+
+# The following functions are translators used by the parser of the
+# reports retrieved with "sacct --parsable2". All the values are strings,
+# which are converted to the values found in the JSON reports (of the
+# data parser v0.0.37 of Slurm, used by the clusters).
+
+# Time limits which are not a number of minutes: the JSON reports contain
+# the raw values of Slurm (INFINITE and NO_VAL), which sacct prints as names
+PARSABLE2_SPECIAL_TIME_LIMITS = {"UNLIMITED": 4294967295, "Partition_Limit": 4294967294}
+
+
+def parsable2_to_int_or_null(name):
+    """
+    Convert a number of seconds since the epoch, or a number of minutes, to an
+    integer. "Unknown" or 0 are converted to None, as in the JSON reports (see
+    rename_subitems_with_zero_as_null). The special time limits, such as
+    "UNLIMITED", are converted to the raw values found in the JSON reports.
+    """
+
+    def converter(k, v, res):
+        if v.isdigit() and int(v) != 0:
+            res[name] = int(v)
+        elif v in PARSABLE2_SPECIAL_TIME_LIMITS:
+            res[name] = PARSABLE2_SPECIAL_TIME_LIMITS[v]
+        else:
+            res[name] = None
+
+    return converter
+
+
+def parsable2_array_ids(k, v, res):
+    """
+    Retrieve the array job ID and task ID from the JobID field, which is
+    "<array_job_id>_<array_task_id>" for the tasks of an array. The jobs
+    which are not part of an array get "0" and "None", as in the JSON reports.
+    """
+    array_job_id, separator, array_task_id = v.partition("_")
+    if not separator:
+        res["array_job_id"] = "0"
+        res["array_task_id"] = "None"
+    elif array_task_id.isdigit():
+        res["array_job_id"] = array_job_id
+        res["array_task_id"] = array_task_id
+    else:
+        # Pending tasks of an array, such as "1234_[1-10%2]"
+        res["array_job_id"] = array_job_id
+        res["array_task_id"] = "None"
+
+
+def parsable2_exit_code(k, v, res):
+    """
+    Convert the "<return_code>:<signal>" ExitCode field to the format
+    obtained from the JSON reports: "<status>:<return_code>".
+
+    For the jobs killed by a signal, the JSON reports contain the return
+    code -127 and the details of the signal, such as
+    {"status": "SIGNALED", "return_code": -127, "signal": {"signal_id": 9, "name": "Killed"}},
+    where the name is the description of the signal given by strsignal.
+    """
+    return_code, _, signal_id = v.partition(":")
+    if signal_id and signal_id != "0":
+        D_signal = {
+            "signal_id": int(signal_id),
+            "name": signal.strsignal(int(signal_id)) or f"Unknown signal {signal_id}",
+        }
+        res["exit_code"] = f"SIGNALED:-127:{D_signal}"
+    elif return_code != "0":
+        res["exit_code"] = f"ERROR:{return_code}"
+    else:
+        res["exit_code"] = f"SUCCESS:{return_code}"
+
+
+def parsable2_state(k, v, res):
+    # The state could be followed by details, such as "CANCELLED by 1234"
+    res["job_state"] = v.split(" ")[0]
+
 
-        for k, v in src_job.items():
-            # We will use a handler mapping to translate this
-            translator = JOB_FIELD_MAP.get(k, None)
+# Factors converting the memory TRES to megabytes, as in the JSON reports
+MEMORY_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2, "P": 1024**3}
 
+
+def parsable2_tres(name):
+    """
+    Convert a TRES field, such as "billing=1,cpu=4,gres/gpu=1,mem=40G,node=1",
+    to the dictionary built by extract_tres_data from the JSON reports.
+    """
+
+    def converter(k, v, res):
+        L_tres = []
+        for tres in v.split(","):
+            if not tres:
+                continue
+            tres_type_and_name, _, count = tres.partition("=")
+            tres_type, _, tres_name = tres_type_and_name.partition("/")
+            # The memory TRES ("mem", but also "gres/gpumem" for instance) have units
+            if count[-1:] in MEMORY_UNITS:
+                count = round(float(count[:-1]) * MEMORY_UNITS[count[-1]])
+            else:
+                count = int(count)
+            L_tres.append(
+                {"type": tres_type, "name": tres_name or None, "count": count}
+            )
+
+        # Reuse the translator of the JSON reports
+        D_tres = {}
+        extract_tres_data(None, {"allocated": L_tres, "requested": []}, D_tres)
+        res[name] = D_tres["tres_allocated"]
+
+    return converter
+
+
+# This map contains the fields requested to sacct in the parsable2 mode, in
+# the order of the requested columns, and the handlers producing the same
+# values as JOB_FIELD_MAP. JobName is the last column, so that a job name
+# containing the separator "|" can be recovered.
+PARSABLE2_JOB_FIELD_MAP = {
+    "Account": rename("account"),
+    "JobID": parsable2_array_ids,
+    "Cluster": rename("cluster_name"),
+    "ExitCode": parsable2_exit_code,
+    "JobIDRaw": rename("job_id"),
+    "NodeList": rename("nodes"),
+    "Partition": rename("partition"),
+    "State": parsable2_state,
+    "TimelimitRaw": parsable2_to_int_or_null("time_limit"),
+    "Submit": parsable2_to_int_or_null("submit_time"),
+    "Start": parsable2_to_int_or_null("start_time"),
+    "End": parsable2_to_int_or_null("end_time"),
+    "AllocTRES": parsable2_tres("tres_allocated"),
+    "ReqTRES": parsable2_tres("tres_requested"),
+    "User": rename("username"),
+    "WorkDir": rename("working_directory"),
+    "JobName": rename("name"),
+}
+
+# Value of the --format option of sacct in the parsable2 mode
+SACCT_PARSABLE2_FORMAT = ",".join(PARSABLE2_JOB_FIELD_MAP.keys())
+
+
+def job_parser_parsable2(f):
+    """
+    This function parses a report retrieved from a sacct command with the
+    --parsable2 option, and only the fields used by Clockwork. It acts as an
+    iterator over all the parsed jobs, which are the same as the ones returned
+    by job_parser on the JSON report of the same jobs.
+
+    This is an example of such a command (the times have to be retrieved as
+    timestamps):
+        SLURM_TIME_FORMAT=%s /opt/software/slurm/bin/sacct -X -S 2023-03-30T00:00 -E 2023-03-31T00:00 --parsable2 --format=Account,JobID,...,JobName
+
+    The report begins with a header line containing the names of the fields,
+    followed by a line per job, such as:
+        Account|JobID|Cluster|ExitCode|JobIDRaw|NodeList|Partition|State|TimelimitRaw|Submit|Start|End|AllocTRES|ReqTRES|User|WorkDir|JobName
+        rrg-cerise-ad_gpu|1234_0|cedar|0:0|1235|cdr2529|part21|REQUEUED|1440|1680127990|1680127992|1680215981|billing=1,cpu=4,gres/gpu=1,mem=40G,node=1|billing=1,cpu=4,gres/gpu=1,mem=40G,node=1|nobody2|/scratch/nobody2|some_name
+
+    Parameters:
+        f       Report retrieved from a sacct command with the --parsable2 option
+
+    """
+    I_lines = iter_text_lines(f)
+    L_field_names = next(I_lines, "").split("|")
+    nbr_fields = len(L_field_names)
+
+    for line in I_lines:
+        if not line:
+            continue
+        L_values = line.split("|")
+        if len(L_values) > nbr_fields:
+            # The last field (the job name) contains the separator
+            L_values[nbr_fields - 1 :] = ["|".join(L_values[nbr_fields - 1 :])]
+
+        res_job = dict()
+        for k, v in zip(L_field_names, L_values):
+            translator = PARSABLE2_JOB_FIELD_MAP.get(k, None)
             if translator is not None:
-                # Translate using the translator retrieved from JOB_FIELD_MAP
                 translator(k, v, res_job)
 
-            # If no translator has been provided: ignore the field
-
         yield res_job
 
 
+def get_job_parser(cluster_name):
+    """
+    Return the parser of the sacct reports of a cluster, according
+    to its "sacct_output_format" setting.
+    """
+    if get_config("clusters")[cluster_name]["sacct_output_format"] == "parsable2":
+        # The report only contains the fields used by Clockwork
+        return job_parser_parsable2
+    return job_parser
+
+
 # The functions used to create the report file, gathering the information to parse
 
 
-def generate_job_report(
-    cluster_name,
-    file_name,
-):
+def format_sacct_time(timestamp, tz):
+    """
+    Format a timestamp as expected by the -S and -E options of sacct,
+    which are interpreted in the timezone of the cluster.
+    """
+    return datetime.fromtimestamp(timestamp, tz).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def open_job_report(cluster_name, tee_file_path=None, window=None):
     """
     Launch a sacct command in order to retrieve a JSON report containing
-    jobs information
+    jobs information, and return its output as a stream which can be
+    parsed while it is received
 
     Parameters:
-        cluster_name    The name of the cluster on which the sinfo command will be launched
-        file_name       Path to store the generated sacct report
+        cluster_name    The name of the cluster on which the sacct command will be launched
+        tee_file_path   Path to store a copy of the sacct report while it is read. Default
+                        is None, which means no copy is stored
+        window          Tuple (start, end) of timestamps delimiting the jobs to retrieve.
+                        Default is None, which means the jobs of the last 600 seconds are retrieved
 
+    Returns:
+        A RemoteCommandStream, or None if the command could not be launched
     """
     # Retrieve from the configuration file the elements used to establish a SSH connection
     # to a remote cluster and launch the sacct command on it
@@ -394,22 +583,39 @@ def generate_job_report(
     # Set the sacct command
     # -S is a condition on the start time, 600 being in seconds
     # -E is a condition on the end time
-    remote_cmd = f"{sacct_path} -S now-600 -E now -X --json"
+    if window is None:
+        sacct_start, sacct_end = "now-600", "now"
+    else:
+        cluster_timezone = get_config("clusters")[cluster_name]["timezone"]
+        sacct_start = format_sacct_time(window[0], cluster_timezone)
+        sacct_end = format_sacct_time(window[1], cluster_timezone)
+    if get_config("clusters")[cluster_name]["sacct_output_format"] == "parsable2":
+        # Only request the fields used by Clockwork, with the times as timestamps
+        remote_cmd = (
+            f"SLURM_TIME_FORMAT=%s {sacct_path} -S {sacct_start} -E {sacct_end} -X "
+            f"--parsable2 --format={SACCT_PARSABLE2_FORMAT}"
+        )
+    else:
+        remote_cmd = f"{sacct_path} -S {sacct_start} -E {sacct_end} -X --json"
     print(f"remote_cmd is\n{remote_cmd}")
 
-    # Connect through SSH
+    # Compress the output on the cluster side if requested, in order to reduce the transfer
+    compression = get_config("clusters")[cluster_name]["remote_compression"]
+    remote_cmd = compress_remote_command(remote_cmd, compression)
+
+    # Run the command through SSH, reusing the connection of the previous calls if possible
     try:
-        ssh_client = open_connection(
-            hostname, username, ssh_key_path=ssh_key_path, port=port
+        ssh_streams = get_ssh_session_pool().exec_command(
+            hostname, username, ssh_key_path=ssh_key_path, command=remote_cmd, port=port
         )
     except Exception as inst:
         print(f"Error. Failed to connect to {hostname} to make a call to sacct.")
         print(inst)
-        return []
+        return None
 
-    if ssh_client:
+    if ssh_streams:
         # those three variables are file-like, not strings
-        ssh_stdin, ssh_stdout, ssh_stderr = ssh_client.exec_command(remote_cmd)
+        ssh_stdin, ssh_stdout, ssh_stderr = ssh_streams
 
         # We should find a better option to retrieve stderr
         """
@@ -420,14 +626,40 @@ def generate_job_report(
             )
         """
 
-        # Write the command output to a file
-        with open(file_name, "w") as outfile:
-            for line in ssh_stdout.readlines():
-                outfile.write(line)
-
-        ssh_client.close()
-
+        return RemoteCommandStream(
+            ssh_stdout, tee_file_path=tee_file_path, compression=compression
+        )
     else:
         print(
             f"Error. Failed to connect to {hostname} to make call to sacct. Returned `None` but no exception was thrown."
         )
+        return None
+
+
+def generate_job_report(cluster_name, file_name, window=None):
+    """
+    Launch a sacct command in order to retrieve a JSON report containing
+    jobs information
+
+    Parameters:
+        cluster_name    The name of the cluster on which the sinfo command will be launched
+        file_name       Path to store the generated sacct report
+        window          Tuple (start, end) of timestamps delimiting the jobs to retrieve.
+                        Default is None, which means the jobs of the last 600 seconds are retrieved
+
+    Returns:
+        True if the report has been generated, False otherwise
+    """
+    # Launch the command and write its output to the file while it is received
+    report_stream = open_job_report(
+        cluster_name, tee_file_path=file_name, window=window
+    )
+    if report_stream is None:
+        return False
+
+    with report_stream:
+        report_stream.drain()
+    print(
+        f"Received {report_stream.transfer_summary()} from {cluster_name} through sacct."
+    )
+    return True
@@ -0,0 +1,371 @@
+"""
+Long-running process scraping the jobs and nodes of all the configured clusters.
+
+It replaces the per-cluster cron invocations of "read_report_commit_to_db.py":
+the interpreter, the configuration and the MongoDB client are set up once,
+and each (cluster, entity) pair is scraped by its own thread, following the
+interval and the jitter configured for the cluster. This way, a slow cluster
+never delays the others.
+
+The state of each scrape (last success, duration, lag, last error, scrapes
+skipped because another run holds the ingestion lease) is written to a JSON
+status file after each scrape.
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+
+from slurm_state.config import get_config, integer
+from slurm_state.extra_filters import clusters_valid
+from slurm_state.ingestion_state import IngestionLeaseHeld
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.mongo_update import main_read_report_and_update_collection
+
+# Number of seconds between the beginnings of two sacct (or sinfo) scrapes
+clusters_valid.add_field("sacct_interval", integer, default=600)
+clusters_valid.add_field("sinfo_interval", integer, default=600)
+# Maximum random delay, in seconds, added to these intervals in order to
+# avoid scraping all the clusters at the same time
+clusters_valid.add_field("scrape_jitter", integer, default=30)
+
+
+class ScrapeStatus:
+    """
+    Thread-safe record of the state of the scrapes, written to a JSON file.
+
+    The file has the following format:
+        {
+            "<cluster_name>": {
+                "<entity>": {
+                    "last_start": <timestamp>,
+                    "last_success": <timestamp or null>,
+                    "last_duration": <seconds>,
+                    "lag": <seconds since the last success, or null>,
+                    "last_error": <string or null>,
+                    "last_skipped": <string or null>,
+                    "nbr_successes": <int>,
+                    "nbr_failures": <int>,
+                    "nbr_skipped": <int>
+                },
+                ...
+            },
+            ...
+        }
+
+    A scrape is skipped, rather than failed, when the ingestion lease of the
+    cluster and entity is held by another run. "last_skipped" then holds the
+    reason, until the next scrape which is not skipped.
+    """
+
+    def __init__(self, status_file=None):
+        self.status_file = status_file
+        self.DD_status = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cluster_name, entity):
+        return self.DD_status.setdefault(cluster_name, {}).setdefault(
+            entity,
+            {
+                "last_start": None,
+                "last_success": None,
+                "last_duration": None,
+                "lag": None,
+                "last_error": None,
+                "last_skipped": None,
+                "nbr_successes": 0,
+                "nbr_failures": 0,
+                "nbr_skipped": 0,
+            },
+        )
+
+    def record(self, cluster_name, entity, start, duration, error=None, skipped=None):
+        """
+        Record the result of a scrape, and update the status file.
+        A scrape is a success unless error (failure) or skipped (the reason
+        why it has been skipped) is given.
+        """
+        with self._lock:
+            D_status = self._get(cluster_name, entity)
+            D_status["last_start"] = start
+            D_status["last_duration"] = duration
+            D_status["last_skipped"] = skipped
+            if skipped is not None:
+                D_status["nbr_skipped"] += 1
+            elif error is None:
+                D_status["last_success"] = start + duration
+                D_status["last_error"] = None
+                D_status["nbr_successes"] += 1
+            else:
+                D_status["last_error"] = error
+                D_status["nbr_failures"] += 1
+        self.write()
+
+    def snapshot(self):
+        """
+        Return a copy of the status, with the lags computed at the current time.
+        """
+        now = time.time()
+        with self._lock:
+            DD_snapshot = json.loads(json.dumps(self.DD_status))
+        for D_entities in DD_snapshot.values():
+            for D_status in D_entities.values():
+                if D_status["last_success"] is not None:
+                    D_status["lag"] = now - D_status["last_success"]
+        return DD_snapshot
+
+    def write(self):
+        """
+        Write the status file atomically, if a path has been provided.
+        """
+        if not self.status_file:
+            return
+        DD_snapshot = self.snapshot()
+        tmp_file = f"{self.status_file}.tmp.{threading.get_ident()}"
+        with open(tmp_file, "w") as f:
+            json.dump(DD_snapshot, f, indent=4)
+        os.replace(tmp_file, self.status_file)
+
+
+class ScrapeTask:
+    """
+    Periodic scrape of the jobs or nodes of a cluster.
+    """
+
+    def __init__(
+        self,
+        entity,
+        cluster_name,
+        collection,
+        users_collection,
+        report_file_path,
+        interval,
+        jitter,
+        status,
+        want_commit_to_db=True,
+    ):
+        assert entity in ["jobs", "nodes"]
+        self.entity = entity
+        self.cluster_name = cluster_name
+        self.collection = collection
+        self.users_collection = users_collection
+        self.report_file_path = report_file_path
+        self.interval = interval
+        self.jitter = jitter
+        self.status = status
+        self.want_commit_to_db = want_commit_to_db
+
+    def run_once(self):
+        """
+        Generate a new report and commit its content to the database.
+        Record the result in the status.
+        """
+        start = time.time()
+        error = None
+        skipped = None
+        try:
+            # Remove the previous report, so that a failed generation is
+            # not hidden by the ingestion of stale data
+            if os.path.exists(self.report_file_path):
+                os.remove(self.report_file_path)
+            if not main_read_report_and_update_collection(
+                self.entity,
+                self.collection,
+                self.users_collection,
+                self.cluster_name,
+                self.report_file_path,
+                from_file=False,
+                want_commit_to_db=self.want_commit_to_db,
+            ):
+                error = "The report could not be retrieved from the cluster or fully written to the database."
+        except IngestionLeaseHeld as inst:
+            print(
+                f"Skip the scrape of the {self.entity} of {self.cluster_name}: {inst}"
+            )
+            skipped = f"{type(inst).__name__}: {inst}"
+        except Exception as inst:
+            print(f"Error while scraping the {self.entity} of {self.cluster_name}.")
+            traceback.print_exc()
+            error = f"{type(inst).__name__}: {inst}"
+        self.status.record(
+            self.cluster_name,
+            self.entity,
+            start,
+            time.time() - start,
+            error=error,
+            skipped=skipped,
+        )
+
+    def loop(self, stop_event):
+        """
+        Run the scrape periodically until stop_event is set.
+        """
+        # Spread the first scrapes of the clusters
+        stop_event.wait(random.uniform(0, self.jitter))
+        while not stop_event.is_set():
+            start = time.time()
+            self.run_once()
+            next_start = start + self.interval + random.uniform(0, self.jitter)
+            stop_event.wait(max(0, next_start - time.time()))
+
+
+def get_scrape_tasks(
+    cluster_names, client, database_name, reports_dir, status, want_commit_to_db=True
+):
+    """
+    Create the scrape tasks of the requested clusters.
+
+    The jobs are scraped on the clusters for which sacct is enabled,
+    and the nodes on the clusters for which a sinfo path is configured.
+    """
+    clusters = get_config("clusters")
+    L_tasks = []
+    for cluster_name in cluster_names:
+        cluster = clusters[cluster_name]
+        cluster_reports_dir = os.path.join(reports_dir, cluster_name)
+        os.makedirs(cluster_reports_dir, exist_ok=True)
+
+        if cluster["sacct_enabled"] and cluster["sacct_path"]:
+            L_tasks.append(
+                ScrapeTask(
+                    "jobs",
+                    cluster_name,
+                    client[database_name]["jobs"],
+                    client[database_name]["users"],
+                    os.path.join(cluster_reports_dir, "sacct_report.json"),
+                    cluster["sacct_interval"],
+                    cluster["scrape_jitter"],
+                    status,
+                    want_commit_to_db=want_commit_to_db,
+                )
+            )
+        if cluster["sinfo_path"]:
+            L_tasks.append(
+                ScrapeTask(
+                    "nodes",
+                    cluster_name,
+                    client[database_name]["nodes"],
+                    None,
+                    os.path.join(cluster_reports_dir, "sinfo_report.json"),
+                    cluster["sinfo_interval"],
+                    cluster["scrape_jitter"],
+                    status,
+                    want_commit_to_db=want_commit_to_db,
+                )
+            )
+    return L_tasks
+
+
+def run_scrape_tasks(L_tasks, stop_event, status=None, status_refresh_interval=60):
+    """
+    Run each task in its own thread until stop_event is set.
+    The status file is refreshed periodically, in order to keep the lags up to date.
+    """
+    L_threads = [
+        threading.Thread(
+            target=task.loop,
+            args=(stop_event,),
+            name=f"scrape-{task.cluster_name}-{task.entity}",
+            daemon=True,
+        )
+        for task in L_tasks
+    ]
+    for thread in L_threads:
+        thread.start()
+
+    while not stop_event.wait(status_refresh_interval):
+        if status is not None:
+            status.write()
+
+    for thread in L_threads:
+        thread.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Periodically scrape the Slurm reports of the clusters and load them to a database.",
+    )
+
+    parser.add_argument(
+        "--clusters",
+        nargs="*",
+        default=None,
+        help="Names of the clusters to scrape. Default is all the configured clusters.",
+    )
+    parser.add_argument(
+        "--reports_dir",
+        required=True,
+        help="Directory in which the sacct and sinfo reports are written, in a subdirectory per cluster.",
+    )
+    parser.add_argument(
+        "--status_file",
+        default=None,
+        help="Path of the JSON file reporting the state of the scrapes. If None, no status file is written.",
+    )
+    parser.add_argument(
+        "--store_in_db",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether or not the jobs and nodes are stored in db.",
+    )
+    parser.add_argument(
+        "--mongodb_collection", default="clockwork", help="Collection to populate."
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    cluster_names = args.clusters
+    if cluster_names is None:
+        cluster_names = list(get_config("clusters").keys())
+
+    # The same client (and its connection pool) is used by all the scrapes
+    client = get_mongo_client()
+    if args.store_in_db:
+        client[args.mongodb_collection]["jobs"].create_index(
+            [("slurm.job_id", 1), ("slurm.cluster_name", 1)],
+            name="job_id_and_cluster_name",
+        )
+        client[args.mongodb_collection]["nodes"].create_index(
+            [("slurm.name", 1), ("slurm.cluster_name", 1)],
+            name="name_and_cluster_name",
+        )
+
+    status = ScrapeStatus(args.status_file)
+    L_tasks = get_scrape_tasks(
+        cluster_names,
+        client,
+        args.mongodb_collection,
+        args.reports_dir,
+        status,
+        want_commit_to_db=args.store_in_db,
+    )
+    print(
+        "Scraping "
+        + ", ".join(f"{task.entity} of {task.cluster_name}" for task in L_tasks)
+    )
+
+    # Stop cleanly on SIGTERM or SIGINT
+    stop_event = threading.Event()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda signum, frame: stop_event.set())
+
+    run_scrape_tasks(L_tasks, stop_event, status=status)
+
+
+if __name__ == "__main__":
+    import sys
+
+    main(sys.argv)
+
+"""
+python3 -m slurm_state.scrape_daemon \
+    --reports_dir ${HOME}/slurm_report \
+    --status_file ${HOME}/slurm_report/scrape_status.json \
+    --mongodb_collection ${MONGODB_DATABASE_NAME}
+"""
@@ -3,19 +3,36 @@ The sinfo parser is used to convert nodes retrieved through a sinfo command on a
 to nodes in the format used by Clockwork.
 """
 
-import json, os
+import os
 
 # Imports to retrieve the values related to sinfo call
-from slurm_state.helpers.ssh_helper import open_connection
+from slurm_state.helpers.ssh_helper import (
+    get_ssh_session_pool,
+    compress_remote_command,
+    RemoteCommandStream,
+)
 
 from slurm_state.extra_filters import clusters_valid
-from slurm_state.config import get_config, string, optional_string, timezone
+from slurm_state.config import (
+    get_config,
+    string,
+    optional_string,
+    timezone,
+    string_choices,
+)
 
 clusters_valid.add_field("sinfo_path", optional_string)
 clusters_valid.add_field("ssh_key_filename", string)
 clusters_valid.add_field("timezone", timezone)
 clusters_valid.add_field("remote_user", optional_string)
 clusters_valid.add_field("remote_hostname", optional_string)
+# Compression of the output of the remote commands: "none", "gzip", "zstd",
+# or "auto" to use zstd if it is available, and gzip otherwise
+clusters_valid.add_field(
+    "remote_compression",
+    string_choices("none", "gzip", "zstd", "auto"),
+    default="none",
+)
 
 # These functions are translators used in order to handle the values
 # we could encounter while parsing a node dictionary retrieved from a
@@ -24,6 +41,8 @@ from slurm_state.helpers.parser_helper import (
     copy,
     copy_with_none_as_empty_string,
     rename,
+    compile_field_map,
+    iter_json_array_items,
 )
 
 # This map should contain all the fields that come from parsing a node entry
@@ -51,6 +70,9 @@ NODE_FIELD_MAP = {
     "tres_used": copy,
 }
 
+# Function translating a node as described by NODE_FIELD_MAP
+translate_node = compile_field_map(NODE_FIELD_MAP)
+
 
 # The node parser itself
 def node_parser(f):
@@ -136,48 +158,36 @@ def node_parser(f):
             "tres_used": "cpu=26,mem=249G,gres\/gpu=8"
         }
 
+    The report is read incrementally: the nodes are decoded and translated one
+    at a time, so that the memory used does not depend on the size of the report.
+
     Parameters:
         f       JSON report retrieved from a sinfo command
     """
-    # Load the JSON file generated by the sinfo command
-    sinfo_data = json.load(f)
-    # at this point, sinfo_data is a hierarchical structure of dictionaries and lists
-
-    src_nodes = sinfo_data["nodes"]  # nodes is a list
+    # Iterate over the elements of the "nodes" list of the JSON file generated
+    # by the sinfo command, without loading the whole report
+    src_nodes = iter_json_array_items(f, "nodes")
 
     for src_node in src_nodes:
-        res_node = (
-            dict()
-        )  # Initialize the dictionary which will store the newly formatted node data
-
-        for k, v in src_node.items():
-            # We will use a handler mapping to translate this
-            translator = NODE_FIELD_MAP.get(k, None)
-
-            if translator is not None:
-                # Translate using the translator retrieved from JOB_FIELD_MAP
-                translator(k, v, res_node)
-
-            # If no translator has been provided: ignore the field
-
-        yield res_node
+        yield translate_node(src_node)
 
 
 # The functions used to create the report file, gathering the information to parse
 
 
-def generate_node_report(
-    cluster_name,
-    file_name,
-):
+def open_node_report(cluster_name, tee_file_path=None):
     """
-    Launch a sinfo command in order to retrieve JSON report containing
-    nodes information
+    Launch a sinfo command in order to retrieve a JSON report containing
+    nodes information, and return its output as a stream which can be
+    parsed while it is received
 
     Parameters:
-        cluster_name        The name of the cluster on which the sinfo command will be launched
-        file_name           The path of the report file to write
+        cluster_name    The name of the cluster on which the sinfo command will be launched
+        tee_file_path   Path to store a copy of the sinfo report while it is read. Default
+                        is None, which means no copy is stored
 
+    Returns:
+        A RemoteCommandStream, or None if the command could not be launched
     """
     # Retrieve from the configuration file the elements used to establish a SSH connection
     # to a remote cluster and launch the sinfo command on it
@@ -215,19 +225,23 @@ def generate_node_report(
     remote_cmd = f"{sinfo_path} --json"
     print(f"remote_cmd is\n{remote_cmd}")
 
-    # Connect through SSH
+    # Compress the output on the cluster side if requested, in order to reduce the transfer
+    compression = get_config("clusters")[cluster_name]["remote_compression"]
+    remote_cmd = compress_remote_command(remote_cmd, compression)
+
+    # Run the command through SSH, reusing the connection of the previous calls if possible
     try:
-        ssh_client = open_connection(
-            hostname, username, ssh_key_path=ssh_key_path, port=port
+        ssh_streams = get_ssh_session_pool().exec_command(
+            hostname, username, ssh_key_path=ssh_key_path, command=remote_cmd, port=port
         )
     except Exception as inst:
         print(f"Error. Failed to connect to {hostname} to make a call to sinfo.")
         print(inst)
-        return []
+        return None
 
-    if ssh_client:
+    if ssh_streams:
         # those three variables are file-like, not strings
-        ssh_stdin, ssh_stdout, ssh_stderr = ssh_client.exec_command(remote_cmd)
+        ssh_stdin, ssh_stdout, ssh_stderr = ssh_streams
 
         # We should find a better option to retrieve stderr
         """
@@ -238,13 +252,39 @@ def generate_node_report(
             )
         """
 
-        # Write the command output to a file
-        with open(file_name, "w") as outfile:
-            for line in ssh_stdout.readlines():
-                outfile.write(line)
-
-        ssh_client.close()
+        return RemoteCommandStream(
+            ssh_stdout, tee_file_path=tee_file_path, compression=compression
+        )
     else:
         print(
             f"Error. Failed to connect to {hostname} to make call to sinfo. Returned `None` but no exception was thrown."
         )
+        return None
+
+
+def generate_node_report(
+    cluster_name,
+    file_name,
+):
+    """
+    Launch a sinfo command in order to retrieve JSON report containing
+    nodes information
+
+    Parameters:
+        cluster_name        The name of the cluster on which the sinfo command will be launched
+        file_name           The path of the report file to write
+
+    Returns:
+        True if the report has been generated, False otherwise
+    """
+    # Launch the command and write its output to the file while it is received
+    report_stream = open_node_report(cluster_name, tee_file_path=file_name)
+    if report_stream is None:
+        return False
+
+    with report_stream:
+        report_stream.drain()
+    print(
+        f"Received {report_stream.transfer_summary()} from {cluster_name} through sinfo."
+    )
+    return True
@@ -0,0 +1,279 @@
+"""
+Local spool of the database operations and the reports which could not be processed
+because MongoDB was unavailable, so that the data retrieved from the clusters is not lost.
+
+When the directory "spool.directory" is configured, the BulkWriter of an ingestion
+run (see main_read_report_and_update_collection) writes the operations to a spool
+segment instead of the database as soon as a batch fails with a connection error.
+Each run has its own segment: a gzip-compressed sequence of BSON records, appended
+while the run goes on, and stored in the directory
+
+    <spool.directory>/<cluster_name>/<entity>/
+
+once the run is over. If the database cannot even be read (to compare the report
+with the stored entities, for instance), the retrieved report itself is stored in
+the same directory as a report segment: a gzip-compressed copy of the report.
+
+At the beginning of the next run of the same cluster and entity, the segments are
+replayed in order, before the new report is processed: the operations with bulk
+writes, and the reports through the same processing as a new report. If they cannot
+all be replayed, the new report is spooled as well, so that it is not processed
+before the older ones.
+
+Note that a batch which failed in the middle could have been partially written:
+its replay can then produce duplicate key errors, which are reported but ignored.
+"""
+
+import gzip
+import os
+import shutil
+import threading
+import time
+
+import bson
+from pymongo import InsertOne, UpdateOne, UpdateMany
+from pymongo.errors import ConnectionFailure
+
+from slurm_state.bulk_writer import BulkWriter
+from slurm_state.config import get_config, register_config, string
+
+# Directory of the spool. The spool is disabled when it is empty
+register_config("spool.directory", "", validator=string)
+
+# Extension of the complete spool segments
+SPOOL_SEGMENT_EXTENSION = ".bson.gz"
+# Extension of the complete report segments
+SPOOL_REPORT_EXTENSION = ".report.gz"
+
+
+def get_spool_dir(cluster_name, entity):
+    """
+    Return the directory of the spool segments of a cluster and an entity,
+    or None if the spool is disabled.
+    """
+    spool_directory = get_config("spool.directory")
+    if not spool_directory:
+        return None
+    return os.path.join(spool_directory, cluster_name, entity)
+
+
+def get_new_segment_path(spool_dir, extension):
+    """
+    Return the path of a new segment in the spool directory. The segments
+    are replayed in the order of their names, which is their creation order.
+    """
+    return os.path.join(
+        spool_dir,
+        f"{time.time_ns():020d}_{os.getpid()}_{threading.get_ident()}{extension}",
+    )
+
+
+def operation_to_spool_record(collection_name, operation):
+    """
+    Convert a database operation (InsertOne, UpdateOne or UpdateMany, from pymongo)
+    on a collection to a record which can be stored in the spool.
+    """
+    if isinstance(operation, InsertOne):
+        return {
+            "collection": collection_name,
+            "op": "insert_one",
+            "document": operation._doc,
+        }
+    for operation_class, op in [(UpdateOne, "update_one"), (UpdateMany, "update_many")]:
+        if isinstance(operation, operation_class):
+            return {
+                "collection": collection_name,
+                "op": op,
+                "filter": operation._filter,
+                "update": operation._doc,
+                "upsert": bool(operation._upsert),
+            }
+    raise ValueError(f"Operation not supported by the spool: {operation}")
+
+
+def spool_record_to_operation(D_record):
+    """
+    Convert a record of the spool back to a database operation.
+    """
+    if D_record["op"] == "insert_one":
+        return InsertOne(D_record["document"])
+    operation_class = UpdateOne if D_record["op"] == "update_one" else UpdateMany
+    return operation_class(
+        D_record["filter"], D_record["update"], upsert=D_record["upsert"]
+    )
+
+
+class SpoolSegment:
+    """
+    Spool segment of an ingestion run. The segment file is only created when
+    the first operation is appended, and becomes visible to the replays once
+    it is closed.
+    """
+
+    def __init__(self, cluster_name, entity):
+        self.spool_dir = get_spool_dir(cluster_name, entity)
+        assert self.spool_dir is not None, "The spool is disabled."
+        self.segment_path = get_new_segment_path(
+            self.spool_dir, SPOOL_SEGMENT_EXTENSION
+        )
+        self.nbr_operations = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.nbr_operations
+
+    def append(self, collection_name, operation):
+        D_record = operation_to_spool_record(collection_name, operation)
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                self._file = gzip.open(f"{self.segment_path}.tmp", "wb")
+            self._file.write(bson.encode(D_record))
+            self.nbr_operations += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                os.replace(f"{self.segment_path}.tmp", self.segment_path)
+
+
+def spool_report(cluster_name, entity, report_file_path):
+    """
+    Store a copy of a report in the spool of a cluster and an entity, so that
+    it is processed by the next run.
+
+    Returns:
+        The path of the report segment
+    """
+    spool_dir = get_spool_dir(cluster_name, entity)
+    assert spool_dir is not None, "The spool is disabled."
+    os.makedirs(spool_dir, exist_ok=True)
+    segment_path = get_new_segment_path(spool_dir, SPOOL_REPORT_EXTENSION)
+    with open(report_file_path, "rb") as f_report:
+        with gzip.open(f"{segment_path}.tmp", "wb") as f_segment:
+            shutil.copyfileobj(f_report, f_segment)
+    os.replace(f"{segment_path}.tmp", segment_path)
+    return segment_path
+
+
+def list_spool_segments(cluster_name, entity):
+    """
+    Return the paths of the complete spool segments (operations and reports)
+    of a cluster and an entity, in the order in which they have to be replayed.
+    """
+    spool_dir = get_spool_dir(cluster_name, entity)
+    if spool_dir is None or not os.path.isdir(spool_dir):
+        return []
+    return [
+        os.path.join(spool_dir, file_name)
+        for file_name in sorted(os.listdir(spool_dir))
+        if file_name.endswith((SPOOL_SEGMENT_EXTENSION, SPOOL_REPORT_EXTENSION))
+    ]
+
+
+def get_spool_stats(cluster_name, entity, now=None):
+    """
+    Return a dictionary describing the spool of a cluster and an entity:
+    its number of segments, its size in bytes, and the age in seconds of
+    its oldest segment (None if the spool is empty).
+    """
+    L_segment_paths = list_spool_segments(cluster_name, entity)
+    if now is None:
+        now = time.time()
+    return {
+        "nbr_segments": len(L_segment_paths),
+        "size_bytes": sum(os.path.getsize(path) for path in L_segment_paths),
+        "oldest_age": (
+            now - min(os.path.getmtime(path) for path in L_segment_paths)
+            if L_segment_paths
+            else None
+        ),
+    }
+
+
+def replay_spool_segment(database, segment_path):
+    """
+    Write the operations of a spool segment to the database.
+
+    Returns:
+        The number of replayed operations
+
+    Raises the connection errors, such as a ConnectionFailure.
+    """
+    D_writers = {}
+    nbr_operations = 0
+    with gzip.open(segment_path, "rb") as f:
+        for D_record in bson.decode_file_iter(f):
+            collection_name = D_record["collection"]
+            if collection_name not in D_writers:
+                D_writers[collection_name] = BulkWriter(database[collection_name])
+            D_writers[collection_name].append(spool_record_to_operation(D_record))
+            nbr_operations += 1
+    for collection_name, writer in D_writers.items():
+        D_summary = writer.close()
+        if D_summary["nbr_write_errors"]:
+            print(
+                f"Replay of {segment_path} on {collection_name}: {D_summary['nbr_write_errors']} write errors."
+            )
+    return nbr_operations
+
+
+def replay_spool_report(segment_path, replay_report):
+    """
+    Process a report segment, by calling replay_report with the path of
+    a decompressed copy of the report.
+
+    Returns:
+        The value returned by replay_report
+
+    Raises the connection errors, such as a ConnectionFailure.
+    """
+    report_file_path = f"{segment_path}.replay"
+    try:
+        with gzip.open(segment_path, "rb") as f_segment:
+            with open(report_file_path, "wb") as f_report:
+                shutil.copyfileobj(f_segment, f_report)
+        return replay_report(report_file_path)
+    finally:
+        if os.path.exists(report_file_path):
+            os.remove(report_file_path)
+
+
+def replay_spool(database, cluster_name, entity, replay_report=None):
+    """
+    Replay the spool segments of a cluster and an entity in order, removing
+    each of them once it has been written to the database.
+
+    Parameters:
+        database        Database in which the operations are written
+        cluster_name    Name of the cluster
+        entity          "jobs" or "nodes"
+        replay_report   Function processing a spooled report, given its path. It returns
+                        False if some of its operations could not be written. Default is
+                        None, which means the replay stops at the first report segment
+
+    Returns:
+        A tuple (number of replayed operations, whether the spool is now empty)
+    """
+    nbr_replayed_operations = 0
+    for segment_path in list_spool_segments(cluster_name, entity):
+        try:
+            if not segment_path.endswith(SPOOL_REPORT_EXTENSION):
+                nbr_replayed_operations += replay_spool_segment(database, segment_path)
+            elif replay_report is None:
+                print(f"Error. The spooled report {segment_path} cannot be replayed.")
+                return nbr_replayed_operations, False
+            elif not replay_spool_report(segment_path, replay_report):
+                # As for the operations, the write errors are reported but ignored
+                print(
+                    f"Replay of {segment_path}: some operations could not be written."
+                )
+        except ConnectionFailure as inst:
+            print(f"Error. Failed to replay the spool segment {segment_path}: {inst}")
+            return nbr_replayed_operations, False
+        os.remove(segment_path)
+        print(f"Replayed the spool segment {segment_path}.")
+    return nbr_replayed_operations, True
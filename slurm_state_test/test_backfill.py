@@ -0,0 +1,212 @@
+import os
+import shutil
+
+from pymongo import InsertOne
+
+from slurm_state.backfill import *
+from slurm_state.ingestion_state import INGESTION_STATE_COLLECTION
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.spool import SpoolSegment, list_spool_segments
+from slurm_state.config import get_config
+
+
+def copy_report(report_name, report_path):
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    shutil.copy(f"slurm_state_test/files/{report_name}", report_path)
+
+
+def test_find_report_files(tmp_path):
+    copy_report("sacct_2", str(tmp_path / "cedar" / "b.json"))
+    copy_report("sacct_1", str(tmp_path / "cedar" / "a.json"))
+    copy_report("sacct_1", str(tmp_path / "mila" / "day1" / "sacct.json"))
+    copy_report("sacct_1", str(tmp_path / "mila" / "day1" / "other.txt"))
+
+    # In the order of the report specs, then of the paths
+    assert find_report_files(
+        [f"mila={tmp_path / 'mila' / '**' / '*.json'}", f"cedar={tmp_path / 'cedar'}"]
+    ) == [
+        ("mila", str(tmp_path / "mila" / "day1" / "sacct.json")),
+        ("cedar", str(tmp_path / "cedar" / "a.json")),
+        ("cedar", str(tmp_path / "cedar" / "b.json")),
+    ]
+
+
+def test_backfill(tmp_path, monkeypatch):
+    # The newest state of job 10 (which has ended) is in sacct_2, even if
+    # this report comes first, and the format of the reports can differ
+    copy_report("sacct_2_parsable2", str(tmp_path / "0.txt"))
+    copy_report("sacct_1", str(tmp_path / "1.json"))
+    copy_report("sacct_1_parsable2", str(tmp_path / "2.txt"))
+
+    LT_reports = find_report_files([f"cedar={tmp_path}"])
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        D_jobs = parse_and_deduplicate_reports(
+            "cedar",
+            [report_path for (_, report_path) in LT_reports],
+            executor,
+            max_pending_reports=1,
+        )
+
+    assert sorted(D_jobs.keys()) == ["10", "20", "30"]
+    assert D_jobs["10"]["name"] == "new_name"
+    assert D_jobs["20"]["name"] == "test-job-2"
+
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+
+    # The jobs are consumed by chunks
+    monkeypatch.setattr("slurm_state.backfill.BACKFILL_CHUNK_SIZE", 2)
+    D_counts = store_jobs(iter(D_jobs.values()), "cedar", db.test_jobs, db.users)
+    assert D_counts == {"inserted": 3, "updated": 0, "unchanged": 0}
+    assert db.test_jobs.count_documents({"slurm.cluster_name": "cedar"}) == 3
+    assert db.test_jobs.find_one({"slurm.job_id": "10"})["slurm"]["name"] == "new_name"
+
+    # Loading the same reports again does not modify the jobs
+    D_counts = store_jobs(D_jobs.values(), "cedar", db.test_jobs, db.users)
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 3}
+
+    db.drop_collection("test_jobs")
+
+
+def test_backfill_from_sacct(tmp_path, monkeypatch):
+    L_requested_windows = []
+    L_failed_windows = []
+
+    def fake_generate_job_report(cluster_name, file_name, window=None):
+        L_requested_windows.append(window)
+        # The retrieval of the second slice fails once, and the one
+        # of the third slice raises an exception once
+        if window in [(2000, 3000), (3000, 3500)] and window not in L_failed_windows:
+            L_failed_windows.append(window)
+            if window == (3000, 3500):
+                raise RuntimeError("Connection lost")
+            return False
+        shutil.copy("slurm_state_test/files/sacct_1", file_name)
+        return True
+
+    monkeypatch.setattr(
+        "slurm_state.mongo_update.generate_job_report", fake_generate_job_report
+    )
+
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+    L_failed_slices = backfill_from_sacct(
+        "mila",
+        1000,
+        3500,
+        db.test_jobs,
+        db.users,
+        str(tmp_path / "reports"),
+        slice_duration=1000,
+        nbr_concurrent_slices=2,
+    )
+    assert L_failed_slices == [(2000, 3000), (3000, 3500)]
+    assert sorted(L_requested_windows) == [(1000, 2000), (2000, 3000), (3000, 3500)]
+    assert db.test_jobs.count_documents({"slurm.cluster_name": "mila"}) > 0
+
+    # The backfill resumes with the slices which could not be retrieved
+    L_requested_windows.clear()
+    L_failed_slices = backfill_from_sacct(
+        "mila",
+        1000,
+        3500,
+        db.test_jobs,
+        db.users,
+        str(tmp_path / "reports"),
+        slice_duration=1000,
+    )
+    assert L_failed_slices == []
+    assert sorted(L_requested_windows) == [(2000, 3000), (3000, 3500)]
+
+    # Nothing is left to retrieve
+    L_requested_windows.clear()
+    assert (
+        backfill_from_sacct(
+            "mila",
+            1000,
+            3500,
+            db.test_jobs,
+            db.users,
+            str(tmp_path / "reports"),
+            slice_duration=1000,
+        )
+        == []
+    )
+    assert L_requested_windows == []
+
+    # A slice whose jobs could not all be written is not recorded as completed
+    original_close = BulkWriter.close
+
+    def close_with_write_error(self):
+        D_summary = original_close(self)
+        D_summary["nbr_write_errors"] += 1
+        return D_summary
+
+    monkeypatch.setattr(BulkWriter, "close", close_with_write_error)
+    for _ in range(2):
+        assert backfill_from_sacct(
+            "mila",
+            3500,
+            4000,
+            db.test_jobs,
+            db.users,
+            str(tmp_path / "reports"),
+            slice_duration=1000,
+        ) == [(3500, 4000)]
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_parse_cluster_date():
+    # The naive dates are in the timezone of the cluster
+    timezone = get_config("clusters")["mila"]["timezone"]
+    assert parse_cluster_date("2023-03-01", "mila") == int(
+        datetime(2023, 3, 1, tzinfo=timezone).timestamp()
+    )
+    assert parse_cluster_date("2023-03-01T00:00:00+00:00", "mila") == 1677628800
+
+
+def test_backfill_does_not_use_the_spool(tmp_path, monkeypatch):
+    def fake_generate_job_report(cluster_name, file_name, window=None):
+        shutil.copy("slurm_state_test/files/sacct_1", file_name)
+        return True
+
+    monkeypatch.setattr(
+        "slurm_state.mongo_update.generate_job_report", fake_generate_job_report
+    )
+    monkeypatch.setitem(get_config("spool"), "directory", str(tmp_path / "spool"))
+
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+    # A segment spooled by a regular run
+    spool = SpoolSegment("mila", "jobs")
+    spool.append("test_jobs", InsertOne({"slurm": {"job_id": "1"}}))
+    spool.close()
+
+    assert (
+        backfill_from_sacct(
+            "mila",
+            1000,
+            3000,
+            db.test_jobs,
+            db.users,
+            str(tmp_path / "reports"),
+            slice_duration=1000,
+            nbr_concurrent_slices=2,
+        )
+        == []
+    )
+    # The segment is left to the next regular run, which holds the lease
+    assert len(list_spool_segments("mila", "jobs")) == 1
+    assert db.test_jobs.count_documents({"slurm.job_id": "1"}) == 0
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
@@ -0,0 +1,117 @@
+"""
+Tests for slurm_state.bulk_writer
+"""
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import AutoReconnect
+
+from slurm_state.bulk_writer import BulkWriter
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.config import get_config
+
+
+@pytest.fixture
+def test_collection():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_bulk_writer")
+    yield db.test_bulk_writer
+    db.drop_collection("test_bulk_writer")
+
+
+@pytest.mark.parametrize("nbr_threads", [1, 3])
+def test_bulk_writer(test_collection, nbr_threads):
+    writer = BulkWriter(test_collection, batch_size=10, nbr_threads=nbr_threads)
+    for i in range(95):
+        writer.append(InsertOne({"i": i}))
+    assert len(writer) == 95
+
+    summary = writer.close()
+    assert test_collection.count_documents({}) == 95
+    assert summary["nbr_batches"] == 10
+    assert summary["nInserted"] == 95
+    assert summary["nbr_write_errors"] == 0
+
+    # The counters of the updates are merged as well
+    writer = BulkWriter(test_collection, batch_size=10, nbr_threads=nbr_threads)
+    for i in range(50):
+        writer.append(UpdateOne({"i": i}, {"$set": {"updated": True}}))
+    writer.append(UpdateOne({"i": 1000}, {"$set": {"i": 1000}}, upsert=True))
+    summary = writer.close()
+    assert summary["nMatched"] == 50
+    assert summary["nModified"] == 50
+    assert summary["nUpserted"] == 1
+
+
+def test_bulk_writer_write_errors(test_collection):
+    test_collection.create_index("i", unique=True)
+    test_collection.insert_one({"i": 3})
+
+    writer = BulkWriter(test_collection, batch_size=5)
+    for i in range(10):
+        writer.append(InsertOne({"i": i}))
+    summary = writer.close()
+
+    # The writes are unordered: the duplicate does not prevent the
+    # following operations from being written
+    assert test_collection.count_documents({}) == 10
+    assert summary["nInserted"] == 9
+    assert summary["nbr_write_errors"] == 1
+    assert len(summary["writeErrors"]) == 1
+
+
+def test_bulk_writer_before_batch(test_collection):
+    L_nbr_documents = []
+
+    def before_batch():
+        L_nbr_documents.append(test_collection.count_documents({}))
+        if len(L_nbr_documents) == 3:
+            raise RuntimeError("stop")
+
+    writer = BulkWriter(test_collection, batch_size=10, before_batch=before_batch)
+    with pytest.raises(RuntimeError):
+        for i in range(95):
+            writer.append(InsertOne({"i": i}))
+
+    # The third batch has not been written
+    assert L_nbr_documents == [0, 10, 20]
+    assert test_collection.count_documents({}) == 20
+
+
+def test_bulk_writer_for_cluster(test_collection):
+    writer = BulkWriter.for_cluster(test_collection, "mila")
+    assert writer.batch_size == 1000
+    assert writer._executor is None
+
+
+@pytest.mark.parametrize("nbr_threads", [1, 3])
+def test_bulk_writer_spools_on_connection_failure(test_collection, nbr_threads):
+    class UnavailableCollection:
+        name = "test_bulk_writer"
+
+        def bulk_write(self, *args, **kwargs):
+            raise AutoReconnect("connection refused")
+
+    class ListSpool(list):
+        def append(self, collection_name, operation):
+            super().append((collection_name, operation))
+
+    spool = ListSpool()
+    writer = BulkWriter(
+        UnavailableCollection(), batch_size=10, nbr_threads=nbr_threads, spool=spool
+    )
+    for i in range(25):
+        writer.append(InsertOne({"i": i}))
+    summary = writer.close()
+
+    assert writer.spooling
+    assert summary["nbr_spooled"] == 25
+    assert summary["nbr_batches"] == 0
+    assert sorted(operation._doc["i"] for _, operation in spool) == list(range(25))
+
+    # Without a spool, the connection failure is raised
+    writer = BulkWriter(UnavailableCollection(), batch_size=10, nbr_threads=nbr_threads)
+    writer.append(InsertOne({"i": 0}))
+    with pytest.raises(AutoReconnect):
+        writer.close()
@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from slurm_state.helpers.dump_file import *
+
+LD_ENTITIES = [
+    {"slurm": {"job_id": "1", "name": "été"}, "cw": {"gpu": {}}},
+    {"slurm": {"job_id": "2", "name": None}, "cw": {}},
+]
+
+
+@pytest.mark.parametrize("file_name", ["dump.json", "dump.jsonl", "dump.jsonl.gz"])
+def test_dump_writer(tmp_path, file_name):
+    dump_file = str(tmp_path / file_name)
+    dump_writer = open_dump_writer(dump_file)
+    for D_entity in LD_ENTITIES:
+        dump_writer.append(D_entity)
+    assert len(dump_writer) == 2
+    # The dump file is only written once it is complete
+    assert not os.path.exists(dump_file)
+    dump_writer.close()
+
+    assert load_dump_file(dump_file) == LD_ENTITIES
+    assert os.listdir(tmp_path) == [file_name]
+
+
+def test_dump_writer_formats(tmp_path):
+    for file_name in ["dump.json", "dump.jsonl", "dump.jsonl.gz"]:
+        dump_writer = open_dump_writer(str(tmp_path / file_name))
+        for D_entity in LD_ENTITIES:
+            dump_writer.append(D_entity)
+        dump_writer.close()
+
+    # The JSON list format is unchanged
+    with open(tmp_path / "dump.json", "r") as f:
+        assert json.load(f) == LD_ENTITIES
+    # One entity per line
+    with open(tmp_path / "dump.jsonl", "r") as f:
+        assert [json.loads(line) for line in f] == LD_ENTITIES
+    with gzip.open(tmp_path / "dump.jsonl.gz", "rt") as f:
+        assert [json.loads(line) for line in f] == LD_ENTITIES
+
+
+def test_dump_writer_zstd(tmp_path):
+    pytest.importorskip("zstandard")
+    dump_file = str(tmp_path / "dump.jsonl.zst")
+    dump_writer = open_dump_writer(dump_file)
+    for D_entity in LD_ENTITIES:
+        dump_writer.append(D_entity)
+    dump_writer.close()
+    assert load_dump_file(dump_file) == LD_ENTITIES
+
+
+def test_dump_writer_abort(tmp_path):
+    dump_file = str(tmp_path / "dump.jsonl")
+    with open(dump_file, "w") as f:
+        f.write("previous\n")
+
+    dump_writer = open_dump_writer(dump_file)
+    dump_writer.append(LD_ENTITIES[0])
+    dump_writer.abort()
+
+    # The previous dump file is kept
+    with open(dump_file, "r") as f:
+        assert f.read() == "previous\n"
+    assert os.listdir(tmp_path) == ["dump.jsonl"]
+
+
+def test_counting_dump_writer():
+    dump_writer = open_dump_writer("")
+    for D_entity in LD_ENTITIES:
+        dump_writer.append(D_entity)
+    dump_writer.close()
+    assert len(dump_writer) == 2
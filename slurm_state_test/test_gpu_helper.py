@@ -8,6 +8,7 @@ from slurm_state.helpers.gpu_helper import (
     get_gres_dict,
     get_cw_gpu_name,
     get_cw_gres_description,
+    _get_cached_cw_gres_description,
 )
 
 
@@ -99,3 +100,61 @@ def test_get_cw_gres_description():
 
     # Case of an empty 'AvailableFeatures' field
     assert get_cw_gres_description("t4", "") == {}
+
+
+def test_get_gres_dict_with_several_types():
+    """
+    Test the parsing of a Gres field listing several resources.
+    """
+    assert get_gres_dict("gpu:a100:4,gpu:v100:2") == {
+        "name": "a100",
+        "number": 6,
+        "types": [
+            {"name": "a100", "number": 4},
+            {"name": "v100", "number": 2},
+        ],
+    }
+    # The commas between parentheses do not separate resources
+    assert get_gres_dict("gpu:a100:4(S:0,2),gpu:v100:2(S:1)") == {
+        "name": "a100",
+        "number": 6,
+        "types": [
+            {"name": "a100", "number": 4, "associated_sockets": "0,2"},
+            {"name": "v100", "number": 2, "associated_sockets": "1"},
+        ],
+    }
+    # The other resources are ignored
+    assert get_gres_dict("gpu:a100:4(S:0-1),shard:a100:16") == {
+        "name": "a100",
+        "number": 4,
+        "associated_sockets": "0-1",
+    }
+    assert get_gres_dict("shard:a100:16,tmpdisk:1000") == {}
+
+
+def test_get_cw_gres_description_with_several_types():
+    assert get_cw_gres_description("gpu:v100:4,gpu:p100:2", "aaaa,test,32gb") == {
+        "cw_name": "v100l",
+        "name": "v100",
+        "number": 6,
+        "types": [
+            {"cw_name": "v100l", "name": "v100", "number": 4},
+            {"cw_name": "p100", "name": "p100", "number": 2},
+        ],
+    }
+
+
+def test_get_cw_gres_description_is_cached():
+    """
+    Test that the descriptions are cached, and that each call
+    returns a new dictionary.
+    """
+    description_1 = get_cw_gres_description("gpu:a100:4,gpu:v100:2", "a,32gb")
+    description_1["number"] = 0
+    description_1["types"][0]["number"] = 0
+
+    nbr_hits = _get_cached_cw_gres_description.cache_info().hits
+    description_2 = get_cw_gres_description("gpu:a100:4,gpu:v100:2", "a,32gb")
+    assert _get_cached_cw_gres_description.cache_info().hits == nbr_hits + 1
+    assert description_2["number"] == 6
+    assert description_2["types"][0]["number"] == 4
@@ -0,0 +1,102 @@
+import json
+import time
+
+import pytest
+
+from slurm_state.ingest_metrics import *
+from slurm_state.mongo_update import main_read_report_and_update_collection
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.config import get_config
+
+
+def test_ingest_metrics_nested_stages():
+    metrics = IngestMetrics("jobs", "mila", sacct_window=(1000, 2000))
+
+    def slow_items():
+        for item in range(3):
+            time.sleep(0.01)
+            yield item
+
+    with metrics.stage("diff"):
+        time.sleep(0.01)
+        L_items = list(
+            filter(
+                metrics.timed("filter", lambda item: item != 1),
+                metrics.timed_iterator("parse", slow_items(), count="parsed"),
+            )
+        )
+    metrics.add_count("kept", len(L_items))
+
+    D_run = metrics.finish(True)
+    assert L_items == [0, 2]
+    assert D_run["counts"] == {"parsed": 3, "kept": 2}
+    assert D_run["sacct_window"] == [1000, 2000]
+    assert D_run["success"] and D_run["error"] is None
+    # The time is counted in the innermost stage
+    assert D_run["stages"]["parse"] >= 0.03
+    assert 0.01 <= D_run["stages"]["diff"] < 0.03
+    assert sum(D_run["stages"].values()) == pytest.approx(D_run["duration"])
+    assert D_run["peak_rss_bytes"] > 0
+    # The run report is a JSON line
+    assert json.loads(json.dumps(D_run)) == D_run
+
+
+def test_format_prometheus_metrics():
+    metrics = IngestMetrics("nodes", "mila")
+    metrics.add_count("parsed", 2)
+    text = format_prometheus_metrics(metrics.finish(False, error="Error"))
+
+    assert "# TYPE clockwork_ingest_stage_seconds gauge" in text
+    assert 'clockwork_ingest_success{cluster="mila",entity="nodes"} 0' in text
+    assert (
+        'clockwork_ingest_operations{cluster="mila",entity="nodes",operation="parsed"} 2'
+        in text
+    )
+    assert 'stage="other"' in text
+
+
+def test_main_read_writes_ingest_metrics(monkeypatch, tmp_path):
+    run_report_file = tmp_path / "runs.jsonl"
+    monkeypatch.setitem(
+        get_config("ingest_metrics"), "run_report_file", str(run_report_file)
+    )
+    monkeypatch.setitem(
+        get_config("ingest_metrics"), "prometheus_textfile_dir", str(tmp_path)
+    )
+
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+
+    for report_name in ["sacct_1", "sacct_2"]:
+        main_read_report_and_update_collection(
+            "jobs",
+            db.test_jobs,
+            db.test_users,
+            "cedar",
+            f"slurm_state_test/files/{report_name}",
+            from_file=True,
+        )
+
+    # One line is appended for each run
+    with open(run_report_file, "r") as f:
+        LD_runs = [json.loads(line) for line in f]
+    assert len(LD_runs) == 2
+    assert LD_runs[0]["cluster_name"] == "cedar"
+    assert LD_runs[0]["entity"] == "jobs"
+    assert LD_runs[0]["success"]
+    assert set(LD_runs[0]["stages"].keys()) == set(INGEST_STAGES) | {"other"}
+    assert LD_runs[0]["counts"]["inserted"] == 2
+    assert LD_runs[0]["counts"]["nInserted"] == 2
+    assert LD_runs[1]["counts"]["inserted"] == 1
+    assert not LD_runs[1]["short_circuited"]
+
+    # The Prometheus textfile contains the last run
+    with open(tmp_path / "clockwork_ingest_cedar_jobs.prom", "r") as f:
+        text = f.read()
+    assert (
+        'clockwork_ingest_operations{cluster="cedar",entity="jobs",operation="inserted"} 1'
+        in text
+    )
+
+    db.drop_collection("test_jobs")
@@ -0,0 +1,195 @@
+import time
+
+import pytest
+
+from slurm_state.ingestion_state import *
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.config import get_config
+
+
+def test_get_sacct_windows():
+    # Without watermark, the last 600 seconds are requested
+    assert get_sacct_windows(None, 10000, 60, 3600) == [(9400, 10000)]
+
+    # The overlap is added before the watermark
+    assert get_sacct_windows(9000, 10000, 60, 3600) == [(8940, 10000)]
+
+    # Long gaps are split into contiguous windows
+    assert get_sacct_windows(1060, 4000, 60, 1000) == [
+        (1000, 2000),
+        (2000, 3000),
+        (3000, 4000),
+    ]
+    assert get_sacct_windows(1060, 3500, 60, 1000) == [
+        (1000, 2000),
+        (2000, 3000),
+        (3000, 3500),
+    ]
+
+    # A watermark in the future still gives a window ending now
+    assert get_sacct_windows(20000, 10000, 60, 3600) == [(10000, 10000)]
+
+
+def test_sacct_watermark():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+
+    assert get_sacct_watermark(state_collection, "mila") is None
+
+    set_sacct_watermark(state_collection, "mila", 1000)
+    set_sacct_watermark(state_collection, "cedar", 500)
+    assert get_sacct_watermark(state_collection, "mila") == 1000
+    assert get_sacct_watermark(state_collection, "cedar") == 500
+
+    # The watermark is never moved backwards
+    set_sacct_watermark(state_collection, "mila", 900)
+    assert get_sacct_watermark(state_collection, "mila") == 1000
+    set_sacct_watermark(state_collection, "mila", 1100)
+    assert get_sacct_watermark(state_collection, "mila") == 1100
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_get_time_slices():
+    assert get_time_slices(1000, 4000, 1000) == [
+        (1000, 2000),
+        (2000, 3000),
+        (3000, 4000),
+    ]
+    # The last slice could be shorter
+    assert get_time_slices(1000, 3500, 1000) == [
+        (1000, 2000),
+        (2000, 3000),
+        (3000, 3500),
+    ]
+    assert get_time_slices(1000, 1000, 1000) == []
+
+
+def test_backfill_slices():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+
+    assert get_completed_backfill_slices(state_collection, "mila") == set()
+
+    mark_backfill_slice_completed(state_collection, "mila", (1000, 2000), 5000)
+    mark_backfill_slice_completed(state_collection, "mila", (2000, 3000), 5001)
+    mark_backfill_slice_completed(state_collection, "cedar", (1000, 2000), 5002)
+    # Completing a slice again does not duplicate it
+    mark_backfill_slice_completed(state_collection, "mila", (1000, 2000), 5003)
+
+    assert get_completed_backfill_slices(state_collection, "mila") == {
+        (1000, 2000),
+        (2000, 3000),
+    }
+    assert get_completed_backfill_slices(state_collection, "cedar") == {(1000, 2000)}
+    # The backfill slices are not mistaken for the watermark
+    assert get_sacct_watermark(state_collection, "mila") is None
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_last_report_digest():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+
+    assert get_last_report_digest(state_collection, "mila", "jobs") is None
+
+    set_last_report_digest(state_collection, "mila", "jobs", "abc", 1000)
+    set_last_report_digest(state_collection, "mila", "nodes", "def", 1000)
+    assert get_last_report_digest(state_collection, "mila", "jobs") == "abc"
+    assert get_last_report_digest(state_collection, "mila", "nodes") == "def"
+    assert get_last_report_digest(state_collection, "cedar", "jobs") is None
+
+    set_last_report_digest(
+        state_collection, "mila", "jobs", "abc", 1000, updated_since=900
+    )
+    D_state = get_last_report_state(state_collection, "mila", "jobs")
+    assert D_state["updated_since"] == 900
+    touch_last_report_digest(state_collection, "mila", "jobs", 2000)
+    D_state = get_last_report_state(state_collection, "mila", "jobs")
+    assert D_state["digest"] == "abc"
+    assert D_state["committed_at"] == 1000
+    assert D_state["checked_at"] == 2000
+    assert D_state["updated_since"] == 2000
+    assert get_last_report_state(state_collection, "cedar", "jobs") is None
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_ingestion_lease():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+
+    assert acquire_ingestion_lease(state_collection, "mila", "jobs", "a", 300, 1000)
+    # The lease is held by "a" until it expires, but the other leases are free
+    assert not acquire_ingestion_lease(state_collection, "mila", "jobs", "b", 300, 1100)
+    assert acquire_ingestion_lease(state_collection, "mila", "nodes", "b", 300, 1100)
+    assert acquire_ingestion_lease(state_collection, "mila", "jobs", "a", 300, 1100)
+
+    assert renew_ingestion_lease(state_collection, "mila", "jobs", "a", 300, 1200)
+    assert get_ingestion_lease(state_collection, "mila", "jobs")["expires_at"] == 1500
+    assert not acquire_ingestion_lease(state_collection, "mila", "jobs", "b", 300, 1450)
+
+    # Once expired, the lease can be acquired by another owner, and is lost by "a"
+    assert acquire_ingestion_lease(state_collection, "mila", "jobs", "b", 300, 1500)
+    assert not renew_ingestion_lease(state_collection, "mila", "jobs", "a", 300, 1600)
+    release_ingestion_lease(state_collection, "mila", "jobs", "a")
+    assert get_ingestion_lease(state_collection, "mila", "jobs")["owner"] == "b"
+
+    release_ingestion_lease(state_collection, "mila", "jobs", "b")
+    assert get_ingestion_lease(state_collection, "mila", "jobs") is None
+    assert acquire_ingestion_lease(state_collection, "mila", "jobs", "c", 300, 1600)
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_ingestion_lease_wait(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+    monkeypatch.setattr(
+        "slurm_state.ingestion_state.INGESTION_LEASE_POLL_INTERVAL", 0.05
+    )
+
+    lease = IngestionLease(state_collection, "mila", "jobs", duration=300)
+    assert lease.acquire()
+
+    # The second run gives up after waiting a bounded time
+    other_lease = IngestionLease(state_collection, "mila", "jobs", duration=300)
+    timestamp_start = time.time()
+    assert not other_lease.acquire(wait=0.2)
+    assert 0.2 <= time.time() - timestamp_start < 1
+
+    lease.release()
+    assert other_lease.acquire(wait=0.2)
+    other_lease.release()
+    assert not other_lease.lost
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_ingestion_lease_check():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.jobs)
+
+    lease = IngestionLease(state_collection, "mila", "jobs", duration=300)
+    assert lease.acquire()
+    lease.check()
+
+    lease.lost = True
+    with pytest.raises(IngestionLeaseLost):
+        lease.check()
+    lease.release()
+
+    db.drop_collection(INGESTION_STATE_COLLECTION)
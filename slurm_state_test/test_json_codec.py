@@ -0,0 +1,38 @@
+import io
+import json
+
+import pytest
+
+from slurm_state.helpers.json_codec import *
+
+
+@pytest.mark.parametrize("backend", get_available_json_backends())
+def test_json_codec(backend):
+    codec = get_json_codec(backend)
+    assert codec.name == backend
+
+    D_data = {"jobs": [{"job_id": "1", "name": "été", "time_limit": None}], "n": 1.5}
+
+    for indent in [False, True]:
+        data = codec.dumps(D_data, indent=indent)
+        assert isinstance(data, bytes)
+        # The documents can be read by the standard library
+        assert json.loads(data) == D_data
+        assert codec.loads(data) == D_data
+
+        f = io.BytesIO()
+        codec.dump(D_data, f, indent=indent)
+        f.seek(0)
+        assert codec.load(f) == D_data
+
+    assert b"\n" in codec.dumps(D_data, indent=True)
+    assert b"\n" not in codec.dumps(D_data)
+
+
+def test_get_json_codec():
+    assert get_json_codec("json").name == "json"
+    assert get_json_codec("auto").name == get_available_json_backends()[0]
+    # The backend is configured with "json.backend" (default: auto)
+    assert get_json_codec().name == get_available_json_backends()[0]
+    with pytest.raises(ValueError):
+        get_json_codec("simplejson")
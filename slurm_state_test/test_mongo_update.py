@@ -5,9 +5,12 @@ from slurm_state.config import get_config
 from datetime import datetime
 from slurm_state.sinfo_parser import node_parser
 from slurm_state.sacct_parser import job_parser
+from slurm_state.ingestion_state import *
+from slurm_state.helpers.dump_file import load_dump_file
 
 import pytest
 import pprint
+import time
 
 
 def test_fetch_slurm_report_jobs():
@@ -139,6 +142,20 @@ def test_fetch_slurm_report_nodes():
     ]
 
 
+@pytest.mark.parametrize(
+    "parser,cluster_name,report_path",
+    [
+        (job_parser, "cedar", "slurm_state_test/files/sacct_1"),
+        (node_parser, "mila", "slurm_state_test/files/sinfo_1"),
+    ],
+)
+def test_fetch_slurm_report_stream(parser, cluster_name, report_path):
+    with open(report_path, "rb") as f:
+        res = list(fetch_slurm_report_stream(parser, cluster_name, f))
+
+    assert res == list(fetch_slurm_report(parser, cluster_name, report_path))
+
+
 def test_slurm_job_to_clockwork_job():
     job = {
         "name": "sh",
@@ -270,3 +287,604 @@ def test_main_read_nodes_and_update_collection():
     assert db.test_nodes.count_documents({}) == 3
 
     db.drop_collection("test_nodes")
+
+
+def test_get_nodes_updates(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_nodes")
+    monkeypatch.setitem(
+        get_config("clusters")["mila"], "nbr_reports_before_node_missing", 2
+    )
+
+    def get_updates(report_name):
+        L_updates, L_dump, D_counts = get_nodes_updates(
+            map(
+                slurm_node_to_clockwork_node,
+                fetch_slurm_report(
+                    node_parser, "mila", f"slurm_state_test/files/{report_name}"
+                ),
+            ),
+            "mila",
+            db.test_nodes,
+        )
+        if L_updates:
+            db.test_nodes.bulk_write(L_updates)
+        return L_updates, D_counts
+
+    L_updates, D_counts = get_updates("sinfo_1")
+    assert len(L_updates) == 2
+    assert D_counts == {"inserted": 2, "updated": 0, "unchanged": 0, "missing": 0}
+
+    # Nothing changed: only the timestamps are updated, with one UpdateMany
+    D_node_before = db.test_nodes.find_one({"slurm.name": "test-node-1"})
+    L_updates, D_counts = get_updates("sinfo_1")
+    assert len(L_updates) == 1
+    assert set(L_updates[0]._doc["$set"].keys()) == {
+        "cw.last_slurm_update",
+        "cw.last_slurm_update_by_sacct",
+    }
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 2, "missing": 0}
+    D_node_after = db.test_nodes.find_one({"slurm.name": "test-node-1"})
+    assert (
+        D_node_after["cw"]["last_slurm_update"]
+        > D_node_before["cw"]["last_slurm_update"]
+    )
+    assert D_node_after["slurm"] == D_node_before["slurm"]
+
+    # Unless the cluster is configured to ignore the unchanged nodes
+    monkeypatch.setitem(get_config("clusters")["mila"], "touch_unchanged_nodes", False)
+    L_updates, D_counts = get_updates("sinfo_1")
+    assert L_updates == []
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 2, "missing": 0}
+
+    # Only the modified fields are written
+    db.test_nodes.update_one(
+        {"slurm.name": "test-node-1"}, {"$set": {"slurm.state": "idle"}}
+    )
+    db.test_nodes.update_one(
+        {"slurm.name": "test-node-1"}, {"$set": {"cw.slurm_fingerprint": "old"}}
+    )
+    L_updates, D_counts = get_updates("sinfo_1")
+    assert D_counts == {"inserted": 0, "updated": 1, "unchanged": 1, "missing": 0}
+    assert set(L_updates[0]._doc["$set"].keys()) == {
+        "slurm.state",
+        "cw.slurm_fingerprint",
+        "cw.last_slurm_update",
+        "cw.last_slurm_update_by_sacct",
+    }
+    assert db.test_nodes.find_one({"slurm.name": "test-node-1"})["slurm"]["state"] == (
+        "down"
+    )
+
+    # test-node-2 is missing from sinfo_2 (where test-node-1 is modified):
+    # it is marked as missing after 2 consecutive reports
+    L_updates, D_counts = get_updates("sinfo_2")
+    assert D_counts == {"inserted": 1, "updated": 1, "unchanged": 0, "missing": 0}
+    D_node_2 = db.test_nodes.find_one({"slurm.name": "test-node-2"})
+    assert D_node_2["cw"]["nbr_missing_reports"] == 1
+    assert "missing_since" not in D_node_2["cw"]
+
+    L_updates, D_counts = get_updates("sinfo_2")
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 2, "missing": 1}
+    assert len(L_updates) == 1
+    assert (
+        "missing_since" in db.test_nodes.find_one({"slurm.name": "test-node-2"})["cw"]
+    )
+
+    # A node already marked as missing is not written again
+    L_updates, D_counts = get_updates("sinfo_2")
+    assert L_updates == []
+
+    # An empty report does not mark the nodes as missing
+    L_updates, _, D_counts = get_nodes_updates(iter([]), "mila", db.test_nodes)
+    assert L_updates == []
+
+    # The node is not missing anymore when it appears again
+    L_updates, D_counts = get_updates("sinfo_1")
+    assert D_counts["updated"] == 2
+    D_node_2 = db.test_nodes.find_one({"slurm.name": "test-node-2"})
+    assert "missing_since" not in D_node_2["cw"]
+    assert "nbr_missing_reports" not in D_node_2["cw"]
+
+    db.drop_collection("test_nodes")
+
+
+def test_main_read_skips_identical_reports(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    monkeypatch.setitem(get_config("clusters")["cedar"], "skip_identical_reports", True)
+
+    def read_report(report_name):
+        main_read_report_and_update_collection(
+            "jobs",
+            db.test_jobs,
+            db.test_users,
+            "cedar",
+            f"slurm_state_test/files/{report_name}",
+            from_file=True,
+        )
+
+    # A job of the cluster which is not in the reports
+    db.test_jobs.insert_one(
+        {
+            "slurm": {"job_id": "1", "cluster_name": "cedar"},
+            "cw": {"last_slurm_update": 1000, "last_slurm_update_by_sacct": 1000},
+        }
+    )
+    read_report("sacct_1")
+    assert db.test_jobs.count_documents({}) == 3
+    D_job_before = db.test_jobs.find_one({"slurm.job_id": "20"})
+
+    # The identical report is not processed again: the deleted job is not restored,
+    # but the last committed report is marked as still up to date
+    db.test_jobs.delete_one({"slurm.job_id": "10"})
+    read_report("sacct_1")
+    assert db.test_jobs.count_documents({}) == 2
+    D_state = get_ingestion_state_collection(db.test_jobs).find_one(
+        {"_id": "report_digest:cedar:jobs"}
+    )
+    assert D_state["checked_at"] > D_state["committed_at"]
+    # The jobs of the report are still fresh, but not the other ones
+    D_job_after = db.test_jobs.find_one({"slurm.job_id": "20"})
+    assert D_job_after["cw"]["last_slurm_update"] == D_state["checked_at"]
+    assert D_job_after["cw"]["last_slurm_update_by_sacct"] == D_state["checked_at"]
+    assert (
+        D_job_after["cw"]["last_slurm_update"] > D_job_before["cw"]["last_slurm_update"]
+    )
+    assert D_job_after["slurm"] == D_job_before["slurm"]
+    assert (
+        db.test_jobs.find_one({"slurm.job_id": "1"})["cw"]["last_slurm_update"] == 1000
+    )
+
+    # Also during the next skips
+    read_report("sacct_1")
+    D_state = get_ingestion_state_collection(db.test_jobs).find_one(
+        {"_id": "report_digest:cedar:jobs"}
+    )
+    D_job = db.test_jobs.find_one({"slurm.job_id": "20"})
+    assert D_job["cw"]["last_slurm_update"] == D_state["checked_at"]
+    assert (
+        db.test_jobs.find_one({"slurm.job_id": "1"})["cw"]["last_slurm_update"] == 1000
+    )
+
+    # A different report is processed
+    read_report("sacct_2")
+    assert db.test_jobs.count_documents({}) == 4
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_main_read_skips_identical_nodes_reports(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_nodes")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    monkeypatch.setitem(get_config("clusters")["cedar"], "skip_identical_reports", True)
+    monkeypatch.setitem(
+        get_config("clusters")["cedar"], "nbr_reports_before_node_missing", 3
+    )
+
+    def read_report(report_name):
+        return main_read_report_and_update_collection(
+            "nodes",
+            db.test_nodes,
+            None,
+            "cedar",
+            f"slurm_state_test/files/{report_name}",
+            from_file=True,
+        )
+
+    def get_node_cw(name):
+        return db.test_nodes.find_one({"slurm.name": name})["cw"]
+
+    read_report("sinfo_1")
+    read_report("sinfo_2")
+    assert get_node_cw("test-node-2")["nbr_missing_reports"] == 1
+
+    # The skipped identical reports still count the missing nodes
+    read_report("sinfo_2")
+    assert get_node_cw("test-node-2")["nbr_missing_reports"] == 2
+    assert "missing_since" not in get_node_cw("test-node-2")
+    read_report("sinfo_2")
+    assert get_node_cw("test-node-2")["nbr_missing_reports"] == 3
+    assert "missing_since" in get_node_cw("test-node-2")
+    D_node_2_before = get_node_cw("test-node-2")
+    D_node_3_before = get_node_cw("test-node-3")
+    read_report("sinfo_2")
+    assert get_node_cw("test-node-2")["nbr_missing_reports"] == 3
+    # The nodes of the report are not counted as missing, but are still fresh
+    D_node_3_after = get_node_cw("test-node-3")
+    assert "nbr_missing_reports" not in D_node_3_after
+    assert D_node_3_after["last_slurm_update"] > D_node_3_before["last_slurm_update"]
+    assert (
+        D_node_3_after["last_slurm_update_by_sacct"]
+        == D_node_3_after["last_slurm_update"]
+    )
+    # Unlike the missing ones
+    assert get_node_cw("test-node-2") == D_node_2_before
+
+    # A report with write errors is not recorded as committed
+    original_close = BulkWriter.close
+
+    def close_with_write_error(self):
+        D_summary = original_close(self)
+        D_summary["nbr_write_errors"] += 1
+        return D_summary
+
+    monkeypatch.setattr(BulkWriter, "close", close_with_write_error)
+    assert not read_report("sinfo_1")
+    monkeypatch.setattr(BulkWriter, "close", original_close)
+    # The same report is then processed again instead of being skipped
+    db.test_nodes.delete_many({})
+    assert read_report("sinfo_1")
+    assert db.test_nodes.count_documents({}) == 2
+
+    db.drop_collection("test_nodes")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_main_read_dump_file_formats(tmp_path):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+
+    LD_dumps = []
+    for dump_file in ["jobs.json", "jobs.jsonl", "jobs.jsonl.gz"]:
+        db.drop_collection("test_jobs")
+        main_read_report_and_update_collection(
+            "jobs",
+            db.test_jobs,
+            db.test_users,
+            "cedar",
+            "slurm_state_test/files/sacct_1",
+            from_file=True,
+            dump_file=str(tmp_path / dump_file),
+        )
+        LD_dumps.append(
+            sorted(
+                load_dump_file(str(tmp_path / dump_file)),
+                key=lambda D_job: D_job["slurm"]["job_id"],
+            )
+        )
+
+    # The dumps contain the same jobs, apart from their timestamps
+    for LD_dump in LD_dumps:
+        assert [D_job["slurm"] for D_job in LD_dump] == [
+            D_job["slurm"] for D_job in LD_dumps[0]
+        ]
+        assert len(LD_dump) == 2
+
+    db.drop_collection("test_jobs")
+
+
+def test_lookup_user_accounts():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+
+    db.drop_collection("test_users")
+    db.test_users.insert_many(
+        [
+            {
+                "mila_email_username": "student00@mila.quebec",
+                "mila_cluster_username": "milauser00",
+                "cc_account_username": "ccuser00",
+            },
+            {
+                "mila_email_username": "student01@mila.quebec",
+                "mila_cluster_username": "milauser01",
+                "cc_account_username": "ccuser01",
+            },
+        ]
+    )
+
+    def make_job(cluster_name, username):
+        return slurm_job_to_clockwork_job(
+            {"cluster_name": cluster_name, "username": username}
+        )
+
+    LD_jobs = [
+        make_job("mila", "milauser00"),
+        make_job("cedar", "ccuser01"),
+        make_job("cedar", "ccuser01"),
+        make_job("beluga", "ccuser00"),
+        make_job("beluga", "unknown"),
+    ]
+
+    cache = UserAccountCache()
+    lookup_user_accounts(LD_jobs, db.test_users, cache)
+
+    assert [D_job["cw"]["mila_email_username"] for D_job in LD_jobs] == [
+        "student00@mila.quebec",
+        "student01@mila.quebec",
+        "student01@mila.quebec",
+        "student00@mila.quebec",
+        None,
+    ]
+    # One query for "mila_cluster_username" and one for "cc_account_username"
+    assert cache.nbr_queries == 2
+
+    # The usernames already resolved (even the unknown ones) are not queried again,
+    # even for another cluster sharing the same account field
+    lookup_user_accounts(
+        [make_job("graham", "ccuser00"), make_job("narval", "unknown")],
+        db.test_users,
+        cache,
+    )
+    assert cache.nbr_queries == 2
+
+    # The unknown usernames are queried again once their TTL has expired,
+    # so that the users added in the meantime are found
+    db.test_users.insert_one(
+        {"mila_email_username": "student02@mila.quebec", "mila_cluster_username": "new"}
+    )
+    cache = UserAccountCache(miss_ttl=-1)
+    cache.resolve(db.test_users, "mila_cluster_username", ["new", "unknown"])
+    db.test_users.insert_one(
+        {
+            "mila_email_username": "student03@mila.quebec",
+            "mila_cluster_username": "unknown",
+        }
+    )
+    assert cache.resolve(
+        db.test_users, "mila_cluster_username", ["new", "unknown"]
+    ) == {
+        "new": "student02@mila.quebec",
+        "unknown": "student03@mila.quebec",
+    }
+    # Only the username which was not found has been queried again
+    assert cache.nbr_queries == 2
+
+    db.drop_collection("test_users")
+
+
+def test_find_jobs_by_ids(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+
+    db.drop_collection("test_jobs")
+    db.test_jobs.insert_many(
+        [
+            {
+                "slurm": {"job_id": str(job_id), "cluster_name": cluster_name},
+                "cw": {},
+                "user": {},
+                "extra": "not needed to merge the jobs",
+            }
+            for job_id in range(10)
+            for cluster_name in ["mila", "cedar"]
+        ]
+    )
+
+    # Use small chunks to check that the queries are split
+    monkeypatch.setattr("slurm_state.mongo_update.JOB_IDS_QUERY_CHUNK_SIZE", 3)
+
+    LD_jobs = list(
+        find_jobs_by_ids(db.test_jobs, "cedar", ["1", "2", "3", "5", "8", "42"])
+    )
+    assert sorted(D_job["slurm"]["job_id"] for D_job in LD_jobs) == [
+        "1",
+        "2",
+        "3",
+        "5",
+        "8",
+    ]
+    for D_job in LD_jobs:
+        assert D_job["slurm"]["cluster_name"] == "cedar"
+        assert set(D_job.keys()) == {"_id", "slurm", "cw", "user"}
+
+    assert list(find_jobs_by_ids(db.test_jobs, "cedar", [])) == []
+
+    db.drop_collection("test_jobs")
+
+
+def test_get_jobs_updates_and_insertions_skips_unchanged_jobs(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+
+    db.drop_collection("test_jobs")
+
+    def get_updates(report_path):
+        (L_updates_to_do, _, _, D_counts) = get_jobs_updates_and_insertions(
+            map(
+                slurm_job_to_clockwork_job,
+                fetch_slurm_report(job_parser, "cedar", report_path),
+            ),
+            "cedar",
+            db.test_jobs,
+            db.test_users,
+        )
+        if L_updates_to_do:
+            db.test_jobs.bulk_write(L_updates_to_do)
+        return L_updates_to_do, D_counts
+
+    # Insert the jobs
+    L_updates_to_do, D_counts = get_updates("slurm_state_test/files/sacct_1")
+    assert D_counts == {"inserted": 2, "updated": 0, "unchanged": 0}
+    D_job_before = db.test_jobs.find_one({"slurm.job_id": "10"})
+    assert D_job_before["cw"]["slurm_fingerprint"] == get_fingerprint(
+        D_job_before["slurm"]
+    )
+
+    # Nothing changed: only the timestamps are updated
+    L_updates_to_do, D_counts = get_updates("slurm_state_test/files/sacct_1")
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 2}
+    for update in L_updates_to_do:
+        assert set(update._doc["$set"].keys()) == {
+            "cw.last_slurm_update",
+            "cw.last_slurm_update_by_sacct",
+        }
+
+    # Unless the cluster is configured to ignore the unchanged jobs
+    monkeypatch.setitem(get_config("clusters")["cedar"], "touch_unchanged_jobs", False)
+    L_updates_to_do, D_counts = get_updates("slurm_state_test/files/sacct_1")
+    assert D_counts == {"inserted": 0, "updated": 0, "unchanged": 2}
+    assert L_updates_to_do == []
+
+    # A job changed in the report: only its modified fields are written
+    L_updates_to_do, D_counts = get_updates("slurm_state_test/files/sacct_2")
+    assert D_counts["updated"] == 1
+    D_job_after = db.test_jobs.find_one({"slurm.job_id": "10"})
+    D_modified_fields = {
+        k
+        for k in D_job_after["slurm"].keys()
+        if D_job_after["slurm"][k] != D_job_before["slurm"][k]
+    }
+    assert D_modified_fields
+    [update] = [
+        update
+        for update in L_updates_to_do
+        if isinstance(update, UpdateOne)
+        and update._filter == {"_id": D_job_before["_id"]}
+    ]
+    assert {
+        k[len("slurm.") :] for k in update._doc["$set"].keys() if k.startswith("slurm.")
+    } == D_modified_fields
+    assert D_job_after["cw"]["slurm_fingerprint"] == get_fingerprint(
+        D_job_after["slurm"]
+    )
+
+    db.drop_collection("test_jobs")
+
+
+def test_main_read_jobs_by_sacct_windows(monkeypatch, tmp_path):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.test_jobs)
+
+    monkeypatch.setitem(get_config("clusters")["cedar"], "sacct_incremental", True)
+    monkeypatch.setitem(get_config("clusters")["cedar"], "sacct_max_window", 100)
+    monkeypatch.setitem(get_config("clusters")["cedar"], "sacct_window_overlap", 60)
+
+    L_windows = []
+    D_failures = {"window_index": 2}
+
+    def fake_generate_job_report(cluster_name, file_name, window=None):
+        L_windows.append(window)
+        if len(L_windows) - 1 == D_failures["window_index"]:
+            # The cluster is not reachable anymore
+            return False
+        with open("slurm_state_test/files/sacct_1") as f_in:
+            with open(file_name, "w") as f_out:
+                f_out.write(f_in.read())
+        return True
+
+    monkeypatch.setattr(
+        "slurm_state.mongo_update.generate_job_report", fake_generate_job_report
+    )
+
+    now = time.time()
+    set_sacct_watermark(state_collection, "cedar", now - 250)
+
+    # The third window fails: the watermark stops at the end of the second one
+    assert not main_read_report_and_update_collection(
+        "jobs", db.test_jobs, db.users, "cedar", str(tmp_path / "sacct_report.json")
+    )
+    assert len(L_windows) == 3
+    assert L_windows[0][0] == now - 310
+    assert L_windows[0][1] == L_windows[1][0]
+    assert get_sacct_watermark(state_collection, "cedar") == L_windows[1][1]
+    assert db.test_jobs.count_documents({}) > 0
+
+    # The next run resumes from the watermark
+    watermark = L_windows[1][1]
+    L_windows.clear()
+    D_failures["window_index"] = None
+    assert main_read_report_and_update_collection(
+        "jobs", db.test_jobs, db.users, "cedar", str(tmp_path / "sacct_report.json")
+    )
+    assert L_windows[0][0] == watermark - 60
+    assert get_sacct_watermark(state_collection, "cedar") == L_windows[-1][1]
+    assert L_windows[-1][1] >= now
+
+    # A window whose jobs could not all be written does not advance the watermark
+    watermark = L_windows[-1][1]
+    L_windows.clear()
+    original_close = BulkWriter.close
+
+    def close_with_write_error(self):
+        D_summary = original_close(self)
+        if self.collection.name == "test_jobs":
+            D_summary["nbr_write_errors"] += 1
+        return D_summary
+
+    monkeypatch.setattr(BulkWriter, "close", close_with_write_error)
+    assert not main_read_report_and_update_collection(
+        "jobs", db.test_jobs, db.users, "cedar", str(tmp_path / "sacct_report.json")
+    )
+    assert len(L_windows) == 1
+    assert get_sacct_watermark(state_collection, "cedar") == watermark
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_main_read_ingestion_lease():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+    state_collection = get_ingestion_state_collection(db.test_jobs)
+
+    def read_report():
+        return main_read_report_and_update_collection(
+            "jobs",
+            db.test_jobs,
+            db.test_users,
+            "cedar",
+            "slurm_state_test/files/sacct_1",
+            from_file=True,
+        )
+
+    # Another run is ingesting the jobs of the cluster: this run is skipped
+    assert acquire_ingestion_lease(
+        state_collection, "cedar", "jobs", "other run", 300, time.time()
+    )
+    with pytest.raises(IngestionLeaseHeld):
+        read_report()
+    assert db.test_jobs.count_documents({}) == 0
+
+    # The lease is released at the end of the run
+    release_ingestion_lease(state_collection, "cedar", "jobs", "other run")
+    assert read_report()
+    assert db.test_jobs.count_documents({}) == 2
+    assert get_ingestion_lease(state_collection, "cedar", "jobs") is None
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+
+def test_main_read_stops_writing_when_the_lease_is_lost(monkeypatch):
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
+
+    # The lease is acquired by another run as soon as this run holds it
+    acquire = IngestionLease.acquire
+
+    def acquire_then_lose(lease, *args, **kwargs):
+        acquired = acquire(lease, *args, **kwargs)
+        lease.lost = True
+        return acquired
+
+    monkeypatch.setattr(IngestionLease, "acquire", acquire_then_lose)
+
+    with pytest.raises(IngestionLeaseLost):
+        main_read_report_and_update_collection(
+            "jobs",
+            db.test_jobs,
+            db.test_users,
+            "cedar",
+            "slurm_state_test/files/sacct_1",
+            from_file=True,
+        )
+    # No batch has been written
+    assert db.test_jobs.count_documents({}) == 0
+
+    db.drop_collection("test_jobs")
+    db.drop_collection(INGESTION_STATE_COLLECTION)
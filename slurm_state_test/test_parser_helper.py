@@ -0,0 +1,123 @@
+"""
+Tests for slurm_state.helpers.parser_helper
+"""
+
+import io
+import json
+
+import pytest
+
+from slurm_state.helpers.parser_helper import (
+    compile_field_map,
+    iter_json_array_items,
+    iter_text_lines,
+    translate_with_field_map,
+)
+from slurm_state.sacct_parser import JOB_FIELD_MAP
+from slurm_state.sinfo_parser import NODE_FIELD_MAP
+
+
+@pytest.mark.parametrize(
+    "report_path,key",
+    [
+        ("slurm_state_test/files/sacct_1", "jobs"),
+        ("slurm_state_test/files/sacct_2", "jobs"),
+        ("slurm_state_test/files/sinfo_1", "nodes"),
+        ("slurm_state_test/files/sinfo_2", "nodes"),
+    ],
+)
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_iter_json_array_items(report_path, key, chunk_size):
+    """
+    Check that streaming the elements of a report gives the same elements
+    as loading the whole report, whatever the size of the chunks read.
+    """
+    with open(report_path, "r") as f:
+        expected = json.load(f)[key]
+
+    with open(report_path, "r") as f:
+        assert list(iter_json_array_items(f, key, chunk_size=chunk_size)) == expected
+
+    # Binary streams (such as the stdout of a SSH channel) are also handled
+    with open(report_path, "rb") as f:
+        assert list(iter_json_array_items(f, key, chunk_size=chunk_size)) == expected
+
+
+def test_iter_json_array_items_edge_cases():
+    # Empty array
+    f = io.StringIO('{"meta": {"a": [1, 2]}, "jobs": []}')
+    assert list(iter_json_array_items(f, "jobs")) == []
+
+    # Array which is not the last value of the object, with numbers
+    # split between chunks
+    f = io.StringIO('{"jobs": [12345, "é", {"a": 1}], "errors": []}')
+    assert list(iter_json_array_items(f, "jobs", chunk_size=2)) == [
+        12345,
+        "é",
+        {"a": 1},
+    ]
+
+    # Missing key
+    with pytest.raises(KeyError):
+        list(iter_json_array_items(io.StringIO('{"nodes": []}'), "jobs"))
+    with pytest.raises(KeyError):
+        list(iter_json_array_items(io.StringIO("{}"), "jobs"))
+
+    # Truncated report
+    with pytest.raises(ValueError):
+        list(iter_json_array_items(io.StringIO('{"jobs": [{"a": 1}, {"b"'), "jobs"))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 8])
+def test_iter_json_array_items_split_character(chunk_size):
+    # The chunks end in the middle of the 2-byte and 3-byte characters
+    report = '{"a": ["é", "€uro", "x"]}'.encode("utf-8")
+    assert list(iter_json_array_items(io.BytesIO(report), "a", chunk_size)) == [
+        "é",
+        "€uro",
+        "x",
+    ]
+
+    # A report ending with an incomplete character is an error
+    with pytest.raises(UnicodeDecodeError):
+        list(iter_json_array_items(io.BytesIO(report[:9]), "a", chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4096])
+def test_iter_text_lines(chunk_size):
+    text = "a|b|c\r\n\nnon-ascii: é\nlast line without line break"
+    L_expected = ["a|b|c", "", "non-ascii: é", "last line without line break"]
+
+    assert list(iter_text_lines(io.StringIO(text), chunk_size)) == L_expected
+    assert (
+        list(iter_text_lines(io.BytesIO(text.encode("utf-8")), chunk_size))
+        == L_expected
+    )
+    assert list(iter_text_lines(io.StringIO(""), chunk_size)) == []
+
+
+@pytest.mark.parametrize(
+    "report_path,key,field_map",
+    [
+        ("slurm_state_test/files/sacct_1", "jobs", JOB_FIELD_MAP),
+        ("slurm_state_test/files/sacct_2", "jobs", JOB_FIELD_MAP),
+        ("slurm_state_test/files/sinfo_1", "nodes", NODE_FIELD_MAP),
+        ("slurm_state_test/files/sinfo_2", "nodes", NODE_FIELD_MAP),
+    ],
+)
+def test_compile_field_map(report_path, key, field_map):
+    translate = compile_field_map(field_map)
+    with open(report_path, "r") as f:
+        L_entities = json.load(f)[key]
+
+    for D_entity in L_entities:
+        D_expected = translate_with_field_map(D_entity, field_map)
+        assert translate(D_entity) == D_expected
+
+        # The missing fields are ignored in both cases
+        D_entity_without_field = {
+            k: v for k, v in D_entity.items() if k != list(field_map.keys())[0]
+        }
+        assert translate(D_entity_without_field) == translate_with_field_map(
+            D_entity_without_field, field_map
+        )
@@ -0,0 +1,67 @@
+"""
+Tests for slurm_state.read_report_commit_to_db
+"""
+
+import pytest
+
+from slurm_state import read_report_commit_to_db
+from slurm_state.read_report_commit_to_db import main
+from slurm_state.mongo_client import get_mongo_client
+
+DATABASE_NAME = "test_read_report_commit_to_db"
+
+
+@pytest.fixture
+def db():
+    client = get_mongo_client()
+    client.drop_database(DATABASE_NAME)
+    yield client[DATABASE_NAME]
+    client.drop_database(DATABASE_NAME)
+
+
+def get_argv(*extra_args):
+    return [
+        "read_report_commit_to_db.py",
+        "--cluster_name",
+        "cedar",
+        "--slurm_jobs_file",
+        "slurm_state_test/files/sacct_1",
+        "--from_existing_jobs_file",
+        "--slurm_nodes_file",
+        "slurm_state_test/files/sinfo_1",
+        "--from_existing_nodes_file",
+        "--store_in_db",
+        "--mongodb_collection",
+        DATABASE_NAME,
+        *extra_args,
+    ]
+
+
+@pytest.mark.parametrize("concurrent", ["--concurrent", "--no-concurrent"])
+def test_main(db, concurrent):
+    main(get_argv(concurrent))
+    assert db.jobs.count_documents({}) == 2
+    assert db.nodes.count_documents({}) == 2
+
+
+def test_main_failure_does_not_interrupt_other_entity(db, monkeypatch):
+    main_read_report_and_update_collection = (
+        read_report_commit_to_db.main_read_report_and_update_collection
+    )
+
+    def failing_main_read(entity, *args, **kwargs):
+        if entity == "jobs":
+            raise RuntimeError("sacct failed")
+        return main_read_report_and_update_collection(entity, *args, **kwargs)
+
+    monkeypatch.setattr(
+        read_report_commit_to_db,
+        "main_read_report_and_update_collection",
+        failing_main_read,
+    )
+
+    # The nodes are committed, but the run fails
+    with pytest.raises(SystemExit):
+        main(get_argv())
+    assert db.jobs.count_documents({}) == 0
+    assert db.nodes.count_documents({}) == 2
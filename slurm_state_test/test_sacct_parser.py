@@ -5,6 +5,12 @@
 # the file sacct_1 was obtained from cedar with the command:
 # /opt/software/slurm/bin/sacct -A rrg-bengioy-ad_gpu,rrg-bengioy-ad_cpu,def-bengioy_gpu,def-bengioy_cpu -X -S 2023-03-30T00:00 -E 2023-03-31T00:00 --json
 
+import io
+import json
+import zoneinfo
+
+import pytest
+
 from slurm_state.sacct_parser import *
 
 
@@ -47,3 +53,184 @@ def test_job_parser():
     }
     assert jobs[0] == job_0
     assert jobs[1]["job_id"] == "20"
+
+
+class SyntheticSacctReport:
+    """
+    File-like object producing a sacct report containing nbr_jobs jobs,
+    without ever holding the whole report in memory.
+    """
+
+    def __init__(self, nbr_jobs):
+        with open("slurm_state_test/files/sacct_1") as f:
+            self.job_template = json.dumps(
+                json.load(f)["jobs"][0], separators=(",", ":")
+            )
+        self.chunks = self._generate_chunks(nbr_jobs)
+        self.pending = ""
+
+    def _generate_chunks(self, nbr_jobs):
+        yield '{"meta": {}, "errors": [], "jobs": ['
+        for i in range(nbr_jobs):
+            yield ("," if i else "") + self.job_template
+        yield "]}"
+
+    def read(self, size):
+        while len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def get_job_parser_peak_memory(nbr_jobs):
+    """
+    Parse a synthetic report of nbr_jobs jobs, and return the peak size
+    (in bytes) of the memory allocated while parsing it.
+    """
+    import tracemalloc
+
+    report = SyntheticSacctReport(nbr_jobs)
+    nbr_parsed_jobs = 0
+    tracemalloc.start()
+    try:
+        for job in job_parser(report):
+            nbr_parsed_jobs += 1
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert nbr_parsed_jobs == nbr_jobs
+    assert job["job_id"] == "10"
+    return peak_memory
+
+
+def test_job_parser_memory_is_bounded():
+    """
+    Check that the memory allocated while parsing a report does not depend
+    on its size: parsing 10 times more jobs (about 15MB of JSON) must not
+    need more memory.
+    """
+    report_size = len(SyntheticSacctReport(1).job_template) * 10_000
+    peak_memory_small = get_job_parser_peak_memory(1_000)
+    peak_memory_large = get_job_parser_peak_memory(10_000)
+
+    assert peak_memory_large < 2 * peak_memory_small
+    # Loading the whole report would have cost several times its size
+    assert peak_memory_large < report_size / 10
+
+
+def test_format_sacct_time():
+    tz = zoneinfo.ZoneInfo("America/Montreal")
+    # 2023-03-30 16:24:39 UTC
+    assert format_sacct_time(1680193479, tz) == "2023-03-30T12:24:39"
+
+
+# The files sacct_1_parsable2 and sacct_2_parsable2 contain the jobs of sacct_1
+# and sacct_2, in the format returned by sacct with the --parsable2 option and
+# the fields of PARSABLE2_JOB_FIELD_MAP (with SLURM_TIME_FORMAT=%s). They have
+# been written from the JSON reports, not captured on a cluster, so the values
+# which these jobs do not contain (signals, special time limits) are tested
+# explicitly by test_job_parser_parsable2_special_values.
+@pytest.mark.parametrize("report_name", ["sacct_1", "sacct_2"])
+@pytest.mark.parametrize("mode", ["r", "rb"])
+def test_job_parser_parsable2_equivalence(report_name, mode):
+    with open(f"slurm_state_test/files/{report_name}") as f:
+        L_jobs_from_json = list(job_parser(f))
+
+    with open(f"slurm_state_test/files/{report_name}_parsable2", mode) as f:
+        L_jobs_from_parsable2 = list(job_parser_parsable2(f))
+
+    assert L_jobs_from_parsable2 == L_jobs_from_json
+
+
+def test_job_parser_parsable2_values():
+    report = io.StringIO(
+        "Account|JobID|ExitCode|JobIDRaw|State|TimelimitRaw|Start|End|AllocTRES|ReqTRES|JobName\n"
+        "acc|1234|1:0|1234|CANCELLED by 42|UNLIMITED|Unknown|0||billing=2,cpu=2,gres/gpu:a100=2,mem=1.50G,node=1|a|b\n"
+        "acc|1234_[1-10%2]|0:9|1235|PENDING|60|1680127992|1680215981|cpu=1,gres/gpu=1,mem=512M,energy=10|cpu=1,mem=2048K|c\n"
+    )
+    L_jobs = list(job_parser_parsable2(report))
+
+    assert L_jobs[0] == {
+        "account": "acc",
+        "array_job_id": "0",
+        "array_task_id": "None",
+        "exit_code": "ERROR:1",
+        "job_id": "1234",
+        "job_state": "CANCELLED",
+        "time_limit": 4294967295,
+        "start_time": None,
+        "end_time": None,
+        "tres_allocated": {},
+        "tres_requested": {
+            "billing": 2,
+            "num_cpus": 2,
+            "gres": 2,
+            "mem": 1536,
+            "num_nodes": 1,
+        },
+        # The job name contains the separator
+        "name": "a|b",
+    }
+    assert L_jobs[1]["array_job_id"] == "1234"
+    assert L_jobs[1]["array_task_id"] == "None"
+    assert L_jobs[1]["exit_code"] == "SIGNALED:-127:{'signal_id': 9, 'name': 'Killed'}"
+    assert L_jobs[1]["time_limit"] == 60
+    assert L_jobs[1]["start_time"] == 1680127992
+    assert L_jobs[1]["tres_allocated"] == {"num_cpus": 1, "num_gpus": 1, "mem": 512}
+    assert L_jobs[1]["tres_requested"] == {"num_cpus": 1, "mem": 2}
+
+
+@pytest.mark.parametrize(
+    "D_json_values,D_parsable2_values",
+    [
+        # Killed by SIGKILL
+        (
+            {
+                "exit_code": {
+                    "status": "SIGNALED",
+                    "return_code": -127,
+                    "signal": {"signal_id": 9, "name": "Killed"},
+                }
+            },
+            {"ExitCode": "0:9"},
+        ),
+        ({"exit_code": {"status": "ERROR", "return_code": 2}}, {"ExitCode": "2:0"}),
+        # Time limits INFINITE and NO_VAL of Slurm
+        ({"time": {"limit": 4294967295}}, {"TimelimitRaw": "UNLIMITED"}),
+        ({"time": {"limit": 4294967294}}, {"TimelimitRaw": "Partition_Limit"}),
+        # Not started yet
+        ({"time": {"start": 0, "end": 0}}, {"Start": "Unknown", "End": "Unknown"}),
+    ],
+)
+def test_job_parser_parsable2_special_values(D_json_values, D_parsable2_values):
+    """
+    Compare the parsers on a job of sacct_1 whose values are replaced by the
+    ones of the JSON reports, and the ones printed by sacct --parsable2.
+    """
+    with open("slurm_state_test/files/sacct_1") as f:
+        D_json_report = json.load(f)
+    D_json_job = D_json_report["jobs"][0]
+    for key, value in D_json_values.items():
+        if key == "time":
+            D_json_job["time"].update(value)
+        else:
+            D_json_job[key] = value
+    D_json_report["jobs"] = [D_json_job]
+    [D_job_from_json] = job_parser(io.StringIO(json.dumps(D_json_report)))
+
+    with open("slurm_state_test/files/sacct_1_parsable2") as f:
+        header, line = f.readline().rstrip("\n"), f.readline().rstrip("\n")
+    L_field_names = header.split("|")
+    # JobName is the last field, and could contain the separator
+    L_values = line.split("|", len(L_field_names) - 1)
+    for field_name, value in D_parsable2_values.items():
+        L_values[L_field_names.index(field_name)] = value
+    [D_job_from_parsable2] = job_parser_parsable2(
+        io.StringIO(header + "\n" + "|".join(L_values) + "\n")
+    )
+
+    assert D_job_from_parsable2 == D_job_from_json
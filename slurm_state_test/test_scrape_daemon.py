@@ -0,0 +1,131 @@
+"""
+Tests for slurm_state.scrape_daemon
+"""
+
+import json
+import threading
+import time
+
+from slurm_state.ingestion_state import IngestionLeaseHeld
+from slurm_state.scrape_daemon import (
+    ScrapeStatus,
+    ScrapeTask,
+    get_scrape_tasks,
+    run_scrape_tasks,
+)
+
+
+def test_scrape_status(tmp_path):
+    status_file = tmp_path / "status.json"
+    status = ScrapeStatus(str(status_file))
+
+    start = time.time() - 10
+    status.record("mila", "jobs", start, 2.0)
+    status.record("mila", "nodes", start, 1.0, error="ValueError: oops")
+
+    with open(status_file) as f:
+        DD_status = json.load(f)
+
+    assert DD_status["mila"]["jobs"]["last_success"] == start + 2.0
+    assert DD_status["mila"]["jobs"]["last_duration"] == 2.0
+    assert 7.0 <= DD_status["mila"]["jobs"]["lag"] < 60
+    assert DD_status["mila"]["jobs"]["nbr_successes"] == 1
+    assert DD_status["mila"]["nodes"]["last_success"] is None
+    assert DD_status["mila"]["nodes"]["lag"] is None
+    assert DD_status["mila"]["nodes"]["last_error"] == "ValueError: oops"
+    assert DD_status["mila"]["nodes"]["nbr_failures"] == 1
+    assert DD_status["mila"]["nodes"]["nbr_skipped"] == 0
+
+
+def test_scrape_skipped_when_lease_held(monkeypatch, tmp_path):
+    def fake_main_read_report_and_update_collection(*args, **kwargs):
+        raise IngestionLeaseHeld("the jobs are being ingested by another run")
+
+    monkeypatch.setattr(
+        "slurm_state.scrape_daemon.main_read_report_and_update_collection",
+        fake_main_read_report_and_update_collection,
+    )
+
+    status = ScrapeStatus()
+    task = ScrapeTask(
+        "jobs",
+        "mila",
+        None,
+        None,
+        str(tmp_path / "report"),
+        interval=600,
+        jitter=0,
+        status=status,
+    )
+    task.run_once()
+
+    # Lease contention is neither a success nor a failure
+    D_status = status.snapshot()["mila"]["jobs"]
+    assert D_status["nbr_skipped"] == 1
+    assert D_status["nbr_successes"] == 0
+    assert D_status["nbr_failures"] == 0
+    assert D_status["last_error"] is None
+    assert D_status["last_skipped"].startswith("IngestionLeaseHeld: ")
+
+    # The next scrape which is not skipped clears the reason
+    status.record("mila", "jobs", time.time(), 1.0)
+    assert status.snapshot()["mila"]["jobs"]["last_skipped"] is None
+
+
+def test_get_scrape_tasks(tmp_path):
+    status = ScrapeStatus()
+    client = {"db": {"jobs": None, "users": None, "nodes": None}}
+    L_tasks = get_scrape_tasks(["mila", "cedar"], client, "db", str(tmp_path), status)
+    # sacct is only enabled on the Mila cluster in the test configuration
+    assert sorted((task.cluster_name, task.entity) for task in L_tasks) == [
+        ("cedar", "nodes"),
+        ("mila", "jobs"),
+        ("mila", "nodes"),
+    ]
+    assert (tmp_path / "mila").is_dir()
+
+
+def test_slow_cluster_does_not_delay_the_others(monkeypatch, tmp_path):
+    D_nbr_runs = {"slow": 0, "fast": 0}
+
+    def fake_main_read_report_and_update_collection(
+        entity, collection, users_collection, cluster_name, *args, **kwargs
+    ):
+        D_nbr_runs[cluster_name] += 1
+        if cluster_name == "slow":
+            time.sleep(1.0)
+            return True
+        else:
+            raise ValueError("the report could not be generated")
+
+    monkeypatch.setattr(
+        "slurm_state.scrape_daemon.main_read_report_and_update_collection",
+        fake_main_read_report_and_update_collection,
+    )
+
+    status = ScrapeStatus()
+    L_tasks = [
+        ScrapeTask(
+            "jobs",
+            cluster_name,
+            None,
+            None,
+            str(tmp_path / f"{cluster_name}_report"),
+            interval=0.05,
+            jitter=0,
+            status=status,
+        )
+        for cluster_name in ["slow", "fast"]
+    ]
+
+    stop_event = threading.Event()
+    threading.Timer(0.5, stop_event.set).start()
+    run_scrape_tasks(L_tasks, stop_event, status_refresh_interval=0.1)
+
+    assert D_nbr_runs["slow"] == 1
+    assert D_nbr_runs["fast"] >= 5
+
+    DD_status = status.snapshot()
+    assert DD_status["slow"]["jobs"]["nbr_successes"] == 1
+    assert DD_status["fast"]["jobs"]["nbr_successes"] == 0
+    assert DD_status["fast"]["jobs"]["nbr_failures"] == D_nbr_runs["fast"]
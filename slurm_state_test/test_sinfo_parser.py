@@ -2,7 +2,7 @@
 Test the node parser contained in slurm_state.sinfo_parser.
 """
 
-from slurm_state.sinfo_parser import node_parser
+from slurm_state.sinfo_parser import node_parser, generate_node_report
 
 
 def test_node_parser():
@@ -37,3 +37,30 @@ def test_node_parser():
 
     # Do a lighter check by only verifying the node ID of the second node
     assert nodes[1]["name"] == "test-node-2"
+
+
+def test_generate_node_report(monkeypatch, tmp_path):
+    class FakeReportStream:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def drain(self):
+            pass
+
+        def transfer_summary(self):
+            return "0 bytes"
+
+    # The sinfo command could not be launched
+    monkeypatch.setattr(
+        "slurm_state.sinfo_parser.open_node_report", lambda *args, **kwargs: None
+    )
+    assert generate_node_report("mila", str(tmp_path / "report")) is False
+
+    monkeypatch.setattr(
+        "slurm_state.sinfo_parser.open_node_report",
+        lambda *args, **kwargs: FakeReportStream(),
+    )
+    assert generate_node_report("mila", str(tmp_path / "report")) is True
@@ -0,0 +1,258 @@
+"""
+Tests for slurm_state.spool
+"""
+
+import os
+
+import pytest
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany
+from pymongo.errors import AutoReconnect
+
+from slurm_state.spool import *
+from slurm_state.mongo_update import main_read_report_and_update_collection
+from slurm_state.mongo_client import get_mongo_client
+from slurm_state.config import get_config
+
+
+@pytest.fixture
+def spool_directory(tmp_path, monkeypatch):
+    monkeypatch.setitem(get_config("spool"), "directory", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def db():
+    client = get_mongo_client()
+    db = client[get_config("mongo.database_name")]
+    db.drop_collection("test_jobs")
+    db.drop_collection("test_spool")
+    yield db
+    db.drop_collection("test_jobs")
+    db.drop_collection("test_spool")
+
+
+class UnavailableCollection:
+    """
+    Collection whose writes fail as if the database was unreachable,
+    while its reads succeed.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, *args, **kwargs):
+        raise AutoReconnect("connection refused")
+
+
+class UnreachableCollection:
+    """
+    Collection whose reads and writes fail as if the database was unreachable.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    @property
+    def name(self):
+        return self._collection.name
+
+    @property
+    def database(self):
+        return UnreachableDatabase(self._collection.database)
+
+    def __getattr__(self, name):
+        def unreachable(*args, **kwargs):
+            raise AutoReconnect("connection refused")
+
+        return unreachable
+
+
+class UnreachableDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, collection_name):
+        return UnreachableCollection(self._database[collection_name])
+
+
+def test_spool_record_round_trip():
+    for operation in [
+        InsertOne({"_id": ObjectId(), "slurm": {"job_id": "1"}}),
+        UpdateOne({"slurm.job_id": "1"}, {"$set": {"slurm.job_state": "RUNNING"}}),
+        UpdateMany(
+            {"slurm.name": {"$in": ["a", "b"]}},
+            {"$inc": {"cw.nbr_missing_reports": 1}},
+            upsert=True,
+        ),
+    ]:
+        D_record = operation_to_spool_record("test_spool", operation)
+        assert D_record["collection"] == "test_spool"
+        assert spool_record_to_operation(D_record) == operation
+
+
+def test_spool_segments_and_replay(spool_directory, db):
+    assert get_spool_stats("cedar", "jobs") == {
+        "nbr_segments": 0,
+        "size_bytes": 0,
+        "oldest_age": None,
+    }
+
+    # A segment is only created when an operation is spooled
+    SpoolSegment("cedar", "jobs").close()
+    assert list_spool_segments("cedar", "jobs") == []
+
+    for i in range(2):
+        spool = SpoolSegment("cedar", "jobs")
+        spool.append("test_spool", InsertOne({"i": i}))
+        spool.append("test_spool", UpdateOne({"i": i}, {"$set": {"segment": i}}))
+        # The segment is not replayed before it is complete
+        assert len(list_spool_segments("cedar", "jobs")) == i
+        spool.close()
+    assert len(spool) == 2
+
+    L_segment_paths = list_spool_segments("cedar", "jobs")
+    assert len(L_segment_paths) == 2
+    assert L_segment_paths[0] < L_segment_paths[1]
+    D_stats = get_spool_stats("cedar", "jobs")
+    assert D_stats["nbr_segments"] == 2
+    assert D_stats["size_bytes"] == sum(map(os.path.getsize, L_segment_paths))
+    assert D_stats["oldest_age"] >= 0
+    # The spool of the other entities is distinct
+    assert list_spool_segments("cedar", "nodes") == []
+
+    assert replay_spool(db, "cedar", "jobs") == (4, True)
+    assert sorted(
+        (D["i"], D["segment"]) for D in db.test_spool.find({}, {"_id": False})
+    ) == [(0, 0), (1, 1)]
+    assert list_spool_segments("cedar", "jobs") == []
+
+
+def test_replay_spool_database_unavailable(spool_directory, db):
+    spool = SpoolSegment("cedar", "jobs")
+    spool.append("test_spool", InsertOne({"i": 0}))
+    spool.close()
+
+    class UnavailableDatabase:
+        def __getitem__(self, collection_name):
+            return UnavailableCollection(db[collection_name])
+
+    # The segment is kept for the next replay
+    assert replay_spool(UnavailableDatabase(), "cedar", "jobs") == (0, False)
+    assert len(list_spool_segments("cedar", "jobs")) == 1
+
+
+def test_main_read_spools_when_database_unavailable(spool_directory, db):
+    def read_report(report_name, collection):
+        main_read_report_and_update_collection(
+            "jobs",
+            collection,
+            db.test_users,
+            "cedar",
+            f"slurm_state_test/files/{report_name}",
+            from_file=True,
+        )
+
+    # The operations of the run are spooled instead of being lost
+    read_report("sacct_1", UnavailableCollection(db.test_jobs))
+    assert db.test_jobs.count_documents({}) == 0
+    assert get_spool_stats("cedar", "jobs")["nbr_segments"] == 1
+
+    # The next run replays them before processing its own report
+    read_report("sacct_2", db.test_jobs)
+    assert sorted(D["slurm"]["job_id"] for D in db.test_jobs.find()) == [
+        "10",
+        "20",
+        "30",
+    ]
+    assert get_spool_stats("cedar", "jobs")["nbr_segments"] == 0
+
+
+def test_replay_spool_report(spool_directory, db, tmp_path):
+    report_file_path = tmp_path / "report"
+    report_file_path.write_text("report content")
+    segment_path = spool_report("cedar", "jobs", str(report_file_path))
+    assert list_spool_segments("cedar", "jobs") == [segment_path]
+
+    # Without a function to process them, the reports stay in the spool
+    assert replay_spool(db, "cedar", "jobs") == (0, False)
+
+    L_replayed_reports = []
+
+    def replay_report(path):
+        with open(path) as f:
+            L_replayed_reports.append(f.read())
+        return True
+
+    assert replay_spool(db, "cedar", "jobs", replay_report=replay_report) == (0, True)
+    assert L_replayed_reports == ["report content"]
+    assert os.listdir(spool_directory / "cedar" / "jobs") == []
+
+
+def test_main_read_spools_report_when_database_unreachable(spool_directory, db):
+    def read_report(report_name, collection, users_collection):
+        return main_read_report_and_update_collection(
+            "jobs",
+            collection,
+            users_collection,
+            "cedar",
+            f"slurm_state_test/files/{report_name}",
+            from_file=True,
+        )
+
+    # The lease and the jobs cannot be read: the report is spooled
+    assert read_report(
+        "sacct_1",
+        UnreachableCollection(db.test_jobs),
+        UnreachableCollection(db.test_users),
+    )
+    # The spool cannot be replayed: the next report is spooled after it
+    assert read_report(
+        "sacct_2",
+        UnreachableCollection(db.test_jobs),
+        UnreachableCollection(db.test_users),
+    )
+    L_segment_paths = list_spool_segments("cedar", "jobs")
+    assert len(L_segment_paths) == 2
+    assert all(path.endswith(SPOOL_REPORT_EXTENSION) for path in L_segment_paths)
+    assert db.test_jobs.count_documents({}) == 0
+
+    # The next run processes the spooled reports in order, then its own
+    assert read_report("sacct_2", db.test_jobs, db.test_users)
+    D_jobs = {D["slurm"]["job_id"]: D for D in db.test_jobs.find()}
+    assert sorted(D_jobs) == ["10", "20", "30"]
+    assert D_jobs["10"]["slurm"]["name"] == "new_name"
+    assert get_spool_stats("cedar", "jobs")["nbr_segments"] == 0
+
+
+def test_sacct_windows_spooled_when_database_unreachable(
+    spool_directory, db, monkeypatch, tmp_path
+):
+    monkeypatch.setitem(get_config("clusters")["cedar"], "sacct_incremental", True)
+    L_windows = []
+
+    def fake_generate_job_report(cluster_name, file_name, window=None):
+        L_windows.append(window)
+        with open("slurm_state_test/files/sacct_1") as f_in:
+            with open(file_name, "w") as f_out:
+                f_out.write(f_in.read())
+        return True
+
+    monkeypatch.setattr(
+        "slurm_state.mongo_update.generate_job_report", fake_generate_job_report
+    )
+
+    # The watermark cannot be read: the last window is retrieved and spooled
+    assert main_read_report_and_update_collection(
+        "jobs",
+        UnreachableCollection(db.test_jobs),
+        UnreachableCollection(db.test_users),
+        "cedar",
+        str(tmp_path / "sacct_report.json"),
+    )
+    assert len(L_windows) == 1
+    assert L_windows[0][1] - L_windows[0][0] == pytest.approx(600)
+    assert len(list_spool_segments("cedar", "jobs")) == 1
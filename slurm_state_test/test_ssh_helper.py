@@ -0,0 +1,308 @@
+"""
+Tests for slurm_state.helpers.ssh_helper, against a local SSH server
+implemented with paramiko as a stand-in for sshd.
+"""
+
+import gzip
+import io
+import os
+import socket
+import threading
+import time
+
+import paramiko
+import pytest
+
+from slurm_state.helpers.ssh_helper import (
+    RemoteCommandStream,
+    compress_remote_command,
+    SSHSessionPool,
+    get_ssh_session_pool,
+    open_connection,
+)
+
+
+class StubSSHServer(paramiko.ServerInterface):
+    """
+    Accept any public key, and answer to each command with its own text.
+    """
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def answer():
+            # Let the server acknowledge the exec request first
+            time.sleep(0.02)
+            channel.sendall(b"output of " + command + b"\n")
+            channel.send_exit_status(0)
+            channel.close()
+
+        threading.Thread(target=answer, daemon=True).start()
+        return True
+
+
+class LocalSSHD:
+    """
+    SSH server listening on a local port, counting the handshakes.
+    """
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=StubSSHServer())
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+@pytest.fixture
+def sshd():
+    server = LocalSSHD()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def ssh_key_path(tmp_path):
+    path = str(tmp_path / "id_test")
+    paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    return path
+
+
+def run(ssh_streams):
+    ssh_stdin, ssh_stdout, ssh_stderr = ssh_streams
+    output = ssh_stdout.read()
+    ssh_stdout.channel.close()
+    return output
+
+
+def test_ssh_session_pool_reuses_the_connection(sshd, ssh_key_path):
+    nbr_commands = 5
+
+    # Without the pool: one handshake per command
+    timestamp_start = time.time()
+    for i in range(nbr_commands):
+        ssh_client = open_connection(
+            "127.0.0.1", "tester", ssh_key_path=ssh_key_path, port=sshd.port
+        )
+        assert run(ssh_client.exec_command(f"cmd{i}")) == f"output of cmd{i}\n".encode()
+        ssh_client.close()
+    duration_without_pool = time.time() - timestamp_start
+    assert len(sshd.transports) == nbr_commands
+
+    # With the pool: only one handshake
+    pool = SSHSessionPool()
+    timestamp_start = time.time()
+    for i in range(nbr_commands):
+        ssh_streams = pool.exec_command(
+            "127.0.0.1",
+            "tester",
+            ssh_key_path=ssh_key_path,
+            command=f"cmd{i}",
+            port=sshd.port,
+        )
+        assert run(ssh_streams) == f"output of cmd{i}\n".encode()
+    duration_with_pool = time.time() - timestamp_start
+    pool.close()
+
+    assert pool.nbr_connections == 1
+    assert len(sshd.transports) == nbr_commands + 1
+    print(
+        f"{nbr_commands} commands took {duration_without_pool} seconds without the pool "
+        f"and {duration_with_pool} seconds with the pool."
+    )
+    assert duration_with_pool < duration_without_pool
+
+
+def test_ssh_session_pool_reconnects(sshd, ssh_key_path):
+    pool = SSHSessionPool()
+
+    def run_command():
+        return run(
+            pool.exec_command(
+                "127.0.0.1",
+                "tester",
+                ssh_key_path=ssh_key_path,
+                command="sinfo",
+                port=sshd.port,
+            )
+        )
+
+    assert run_command() == b"output of sinfo\n"
+
+    # The server closes the connection
+    sshd.transports[0].close()
+    time.sleep(0.1)
+
+    assert run_command() == b"output of sinfo\n"
+    assert pool.nbr_connections == 2
+    pool.close()
+
+
+def test_ssh_session_pool_connection_failure(ssh_key_path):
+    # Nothing listens on this port
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    pool = SSHSessionPool()
+    assert (
+        pool.exec_command(
+            "127.0.0.1", "tester", ssh_key_path=ssh_key_path, command="ls", port=port
+        )
+        is None
+    )
+    assert pool.nbr_connections == 0
+
+
+class FakeChannel:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStdout(io.BytesIO):
+    def __init__(self, data, max_read_size=None):
+        super().__init__(data)
+        self.channel = FakeChannel()
+        self.max_read_size = max_read_size
+
+    def read(self, size=-1):
+        # Simulate a slow network returning a few bytes at a time
+        if self.max_read_size is not None:
+            size = self.max_read_size
+        return super().read(size)
+
+
+def test_get_ssh_session_pool_concurrent(monkeypatch):
+    class SlowSSHSessionPool(SSHSessionPool):
+        def __init__(self):
+            # Leave the time to the other threads to check for the pool
+            time.sleep(0.1)
+            super().__init__()
+
+    monkeypatch.setattr(
+        "slurm_state.helpers.ssh_helper.SSHSessionPool", SlowSSHSessionPool
+    )
+    monkeypatch.setattr(get_ssh_session_pool, "value", None)
+
+    L_pools = []
+    L_threads = [
+        threading.Thread(target=lambda: L_pools.append(get_ssh_session_pool()))
+        for _ in range(4)
+    ]
+    for thread in L_threads:
+        thread.start()
+    for thread in L_threads:
+        thread.join()
+
+    # All the scrapes share the same pool
+    assert len(L_pools) == 4
+    assert all(pool is L_pools[0] for pool in L_pools)
+
+
+def test_remote_command_stream_tee(tmp_path):
+    data = b'{"jobs": [' + b",".join(b'{"job_id": %d}' % i for i in range(1000)) + b"]}"
+    tee_file_path = str(tmp_path / "report.json")
+
+    stdout = FakeStdout(data)
+    with RemoteCommandStream(stdout, tee_file_path=tee_file_path) as report_stream:
+        assert report_stream.read(10) == data[:10]
+        # The copy is not visible until the whole output has been read
+        assert not os.path.exists(tee_file_path)
+        report_stream.drain(chunk_size=100)
+    assert report_stream.nbr_bytes == len(data)
+    assert stdout.channel.closed
+    with open(tee_file_path, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(f"{tee_file_path}.tmp")
+
+
+def test_remote_command_stream_incomplete_output(tmp_path):
+    tee_file_path = str(tmp_path / "report.json")
+    with RemoteCommandStream(FakeStdout(b"0123456789"), tee_file_path) as report_stream:
+        report_stream.read(5)
+    # A partial output does not replace the report
+    assert not os.path.exists(tee_file_path)
+    assert not os.path.exists(f"{tee_file_path}.tmp")
+
+
+def test_compress_remote_command():
+    assert compress_remote_command("sinfo --json", "none") == "sinfo --json"
+    assert compress_remote_command("sinfo --json", "gzip") == "sinfo --json | gzip -c"
+    assert "gzip -c" in compress_remote_command("sinfo --json", "auto")
+    with pytest.raises(ValueError):
+        compress_remote_command("sinfo --json", "bzip2")
+
+
+@pytest.mark.parametrize("max_read_size", [None, 3])
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 64 * 1024])
+def test_remote_command_stream_gzip(tmp_path, chunk_size, max_read_size):
+    data = b'{"jobs": [' + b",".join(b'{"job_id": %d}' % i for i in range(1000)) + b"]}"
+    tee_file_path = str(tmp_path / "report.json")
+
+    with RemoteCommandStream(
+        FakeStdout(gzip.compress(data), max_read_size=max_read_size),
+        tee_file_path=tee_file_path,
+        compression="gzip",
+    ) as report_stream:
+        L_chunks = []
+        while True:
+            chunk = report_stream.read(chunk_size)
+            if not chunk:
+                break
+            assert len(chunk) <= chunk_size
+            L_chunks.append(chunk)
+
+    assert b"".join(L_chunks) == data
+    assert report_stream.nbr_bytes == len(data)
+    assert report_stream.nbr_transferred_bytes < len(data) / 2
+    assert "transferred with compression gzip" in report_stream.transfer_summary()
+    with open(tee_file_path, "rb") as f:
+        assert f.read() == data
+
+
+def test_remote_command_stream_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    data = b'{"nodes": []}' * 100
+
+    with RemoteCommandStream(
+        FakeStdout(zstandard.ZstdCompressor().compress(data)), compression="auto"
+    ) as report_stream:
+        assert report_stream.read() == data
+
+
+def test_remote_command_stream_not_compressed():
+    with RemoteCommandStream(
+        FakeStdout(b'{"nodes": []}'), compression="gzip"
+    ) as report_stream:
+        with pytest.raises(ValueError):
+            report_stream.read(10)